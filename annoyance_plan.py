@@ -0,0 +1,120 @@
+# annoyance_plan.py
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+from database import METHOD_FLAGS
+from message_template import MessageTemplate, compile_template
+from selection import Picker, build_picker
+from target_settings import TargetSettings, pack_settings, shared_values
+from throttle import TriggerGate, build_gate
+
+
+class AnnoyancePlan(NamedTuple):
+    """Precompiled annoyance settings for a single target.
+
+    Built once whenever a target's settings change, so on_message only has to
+    look the plan up and pick from it.
+    """
+    reply_picker: Optional[Picker]
+    reaction_picker: Optional[Picker]
+    # (method, picker) pairs for every method that can currently fire
+    methods: Tuple[Tuple[str, Picker], ...]
+    # Cooldown/probability/rate state, or None when the target has no limits
+    gate: Optional[TriggerGate] = None
+    # Reactions per triggering message; above 1, a reply is sent alongside them
+    burst: int = 1
+
+    def burst_actions(self) -> Tuple[Tuple[str, Union[str, MessageTemplate]], ...]:
+        """Picks the (outbound kind, payload) pairs for one burst.
+
+        A reply if messages are enabled, plus up to `burst` distinct reactions,
+        since Discord only counts each emoji once per message. Replies with
+        placeholders come back as MessageTemplates, to be rendered by the caller.
+        """
+        actions = []
+        for method, picker in self.methods:
+            if method == 'message':
+                actions.append(('reply', picker.pick()))
+                continue
+            reactions: list = []
+            # A small pool can't fill the burst; give up after a few duplicate picks
+            for _ in range(self.burst * 2):
+                emoji = picker.pick()
+                if emoji not in reactions:
+                    reactions.append(emoji)
+                    if len(reactions) == self.burst:
+                        break
+            actions.extend(('reaction', emoji) for emoji in reactions)
+        return tuple(actions)
+
+
+def _compile_replies(pool: Tuple[str, ...]) -> Tuple[Union[str, MessageTemplate], ...]:
+    # Each distinct reply is parsed once, however many targets and recompiles use it
+    if not any('{' in reply or '}' in reply for reply in pool):
+        return pool
+    return tuple(shared_values.shared('template', reply, lambda: compile_template(reply)) for reply in pool)
+
+
+def _picker(
+    pool: Tuple[Union[str, MessageTemplate], ...], weights: Optional[Sequence[float]], mode: str, previous: Optional[Picker]
+) -> Optional[Picker]:
+    # Weighted pickers hold no state, so targets with the same pool share one
+    if mode == 'shuffle' or not pool:
+        return build_picker(pool, weights, mode, previous)
+    key = (pool, tuple(weights) if weights is not None else None)
+    return shared_values.shared('picker', key, lambda: build_picker(pool, weights, mode))
+
+
+def compile_plan(
+    settings: Union[Dict[str, Any], TargetSettings],
+    random_messages: Sequence[str],
+    emojis: Sequence[str],
+    previous: Optional[AnnoyancePlan] = None
+) -> AnnoyancePlan:
+    """Compiles a target's settings (a TargetSettings or a settings dict) into an AnnoyancePlan.
+
+    Passing the target's previous plan carries its trigger state and shuffle
+    positions over when the relevant settings are unchanged.
+    """
+    settings = pack_settings(settings)
+    specific_replies = settings.specific_reply
+    specific_reactions = settings.specific_reaction
+    message_mode = settings.message_mode
+    selection_mode = settings.selection_mode
+
+    # Random fallbacks always weigh 1, next to the target's own weighted items
+    if message_mode == 'specific_only':
+        reply_pool, weights = specific_replies, settings.reply_weights
+    elif message_mode == 'random_only':
+        reply_pool, weights = tuple(random_messages), None
+    else:
+        reply_pool = specific_replies + tuple(random_messages)
+        weights = settings.reply_weights + (1.0,) * len(random_messages)
+
+    # Specific reactions replace the random fallback list entirely
+    if specific_reactions:
+        reaction_pool, reaction_pool_weights = specific_reactions, settings.reaction_weights
+    else:
+        reaction_pool, reaction_pool_weights = tuple(emojis), None
+
+    reply_picker = _picker(
+        _compile_replies(reply_pool), weights, selection_mode, previous.reply_picker if previous is not None else None
+    )
+    reaction_picker = _picker(
+        reaction_pool, reaction_pool_weights, selection_mode, previous.reaction_picker if previous is not None else None
+    )
+
+    methods = []
+    if settings.method_flags & METHOD_FLAGS['message'] and reply_picker is not None:
+        methods.append(('message', reply_picker))
+    if settings.method_flags & METHOD_FLAGS['reaction'] and reaction_picker is not None:
+        methods.append(('reaction', reaction_picker))
+
+    gate = build_gate(settings.limits, previous.gate if previous is not None else None)
+    burst = max(1, settings.burst_size)
+    if gate is None and selection_mode != 'shuffle':
+        # Nothing per-target left in the plan, so identical ones are shared too
+        return shared_values.shared(
+            'plan', (reply_picker, reaction_picker, tuple(methods), burst),
+            lambda: AnnoyancePlan(reply_picker, reaction_picker, tuple(methods), None, burst)
+        )
+    return AnnoyancePlan(reply_picker, reaction_picker, tuple(methods), gate, burst)
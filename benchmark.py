@@ -0,0 +1,416 @@
+# benchmark.py
+"""Micro-benchmarks for the on_message hot path and AnnoyanceDB.
+
+Runs entirely offline: on_message is driven with stub Message/Member/Channel
+objects whose reply/add_reaction are no-ops, and the database benchmarks use
+a throwaway SQLite file. Example:
+
+    python benchmark.py --targets 10,1000,100000,1000000 --messages 50000
+"""
+import argparse
+import asyncio
+import gc
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Sequence
+
+# main.py refuses to import without a token and opens its DB at import time,
+# so point both somewhere harmless before importing it.
+_BENCH_DIR = tempfile.mkdtemp(prefix="annoy-bench-")
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark')
+os.environ['DB_PATH'] = os.path.join(_BENCH_DIR, 'main.db')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import main  # noqa: E402
+from database import AnnoyanceDB  # noqa: E402
+from metrics import process_rss_bytes  # noqa: E402
+from content_rules import compile_rules  # noqa: E402
+from selection import build_picker  # noqa: E402
+from target_settings import MESSAGE_MODES  # noqa: E402
+
+GUILD_ID = 1
+METHOD_MIXES = (('message',), ('reaction',), ('message', 'reaction'))
+
+
+class FakeChannel:
+    __slots__ = ('id', 'name')
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+
+
+class FakeGuild:
+    __slots__ = ('id', 'shard_id')
+
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.shard_id = 0
+
+
+class FakeMember:
+    __slots__ = ('id', 'display_name', 'bot')
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.display_name = f"user-{user_id}"
+        self.bot = False
+
+
+class FakeMessage:
+    __slots__ = ('id', 'author', 'guild', 'channel', 'content')
+
+    def __init__(self, message_id: int, author: FakeMember, guild: FakeGuild, channel: FakeChannel):
+        self.id = message_id
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.content = "hello"
+
+    async def reply(self, content: str):
+        pass
+
+    async def add_reaction(self, emoji: str):
+        pass
+
+
+def make_settings(mode: str, methods: Sequence[str], replies: int = 3, reactions: int = 2) -> Dict:
+    reaction_list = ["😂", "🙄", "👍"][:reactions]
+    return {
+        "specific_reply": [f"reply {i}" for i in range(replies)],
+        "specific_reaction": reaction_list,
+        "annoy_methods": list(methods),
+        "message_mode": mode,
+        "cooldown_seconds": 0,
+        "trigger_probability": 1,
+        "max_actions": 0,
+        "action_window_seconds": 60,
+        "reply_weights": [1.0] * replies,
+        "reaction_weights": [1.0] * len(reaction_list),
+        "selection_mode": 'weighted',
+    }
+
+
+def reset_caches():
+    main.target_settings_cache.clear()
+    main.target_plans.clear()
+    gc.collect()
+
+
+def populate(count: int, mode: str, methods: Sequence[str]) -> Optional[float]:
+    """Fills the caches with `count` targets and returns the RSS cost per target."""
+    reset_caches()
+    before = process_rss_bytes()
+    for user_id in range(1, count + 1):
+        main.cache_target(GUILD_ID, user_id, make_settings(mode, methods))
+    after = process_rss_bytes()
+    if before is None or after is None:
+        return None
+    return (after - before) / count
+
+
+def percentile(sorted_values: List[int], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def bench_on_message(count: int, messages: int, mode: str, methods: Sequence[str]) -> Dict:
+    rss_per_target = populate(count, mode, methods)
+    guild = FakeGuild(GUILD_ID)
+    channels = [FakeChannel(i) for i in range(1, 51)]
+    # Mostly targets, with some non-target traffic like a real channel
+    authors = [FakeMember(random.randint(1, count)) if i % 4 else FakeMember(count + 1 + i) for i in range(1024)]
+    batch = [FakeMessage(i, authors[i % 1024], guild, channels[i % 50]) for i in range(messages)]
+
+    latencies = []
+    on_message = main.on_message
+    perf = time.perf_counter_ns
+    start = perf()
+    for message in batch:
+        t0 = perf()
+        await on_message(message)
+        latencies.append(perf() - t0)
+    elapsed = (perf() - start) / 1e9
+
+    latencies.sort()
+    return {
+        "targets": count,
+        "mode": mode,
+        "methods": '+'.join(methods),
+        "msgs_per_sec": messages / elapsed,
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+        "rss_per_target": rss_per_target,
+    }
+
+
+def bench_cache_memory(count: int) -> Dict:
+    """Measures the settings cache and the compiled plans in traced bytes per target.
+
+    Targets cycle through every message mode and method mix, with a few
+    different reply lists and a cooldown on every fifth one, like a real guild.
+    """
+    reset_caches()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for user_id in range(1, count + 1):
+            variant = user_id % (len(MESSAGE_MODES) * len(METHOD_MIXES))
+            settings = make_settings(
+                MESSAGE_MODES[variant % len(MESSAGE_MODES)], METHOD_MIXES[variant // len(MESSAGE_MODES)], replies=user_id % 4
+            )
+            if user_id % 5 == 0:
+                settings["cooldown_seconds"] = 30
+            main.cache_target(GUILD_ID, user_id, settings)
+        del settings
+        gc.collect()
+        total = tracemalloc.get_traced_memory()[0] - before
+        main.target_plans.clear()
+        gc.collect()
+        settings_bytes = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        reset_caches()
+    return {"targets": count, "settings": settings_bytes / count, "plans": (total - settings_bytes) / count}
+
+
+def bench_selection(size: int, picks: int) -> Dict:
+    """Nanoseconds per pick for each picker over a pool of `size` items."""
+    items = tuple(f"message {i}" for i in range(size))
+    weights = [float(i % 10 + 1) for i in range(size)]
+    pickers = {
+        'uniform': build_picker(items),
+        'weighted': build_picker(items, weights),
+        'shuffle': build_picker(items, weights, 'shuffle'),
+    }
+    result: Dict = {"size": size}
+    perf = time.perf_counter_ns
+    for name, picker in pickers.items():
+        pick = picker.pick
+        start = perf()
+        for _ in range(picks):
+            pick()
+        result[name] = (perf() - start) / picks
+    return result
+
+
+def bench_rules(count: int, matches: int) -> Dict:
+    """Microseconds per RuleMatcher.match on a message that matches no rule, and on one that does."""
+    rng = random.Random(count)
+    keywords = {''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 10))) for _ in range(count)}
+    rows = [
+        {"id": i, "user_id": None, "pattern": keyword, "is_regex": False, "action": "reply", "payload": "x"}
+        for i, keyword in enumerate(sorted(keywords))
+    ]
+    started = time.perf_counter()
+    matcher = compile_rules(rows)
+    compile_s = time.perf_counter() - started
+    miss = "the quick brown fox jumps over the lazy dog while everyone watches from the other side of the road"
+    hit = miss + " " + rows[-1]["pattern"]
+    result: Dict = {"rules": len(rows), "compile_s": compile_s}
+    for name, text in (("miss_us", miss), ("hit_us", hit)):
+        started = time.perf_counter()
+        for _ in range(matches):
+            matcher.match(text, 1)
+        result[name] = (time.perf_counter() - started) / matches * 1e6
+    return result
+
+
+def bench_database(count: int, updates: int) -> Dict:
+    path = os.path.join(_BENCH_DIR, f"bench-{count}.db")
+    db = AnnoyanceDB(path)
+    targets = [dict(make_settings('both', ('message', 'reaction')), user_id=user_id) for user_id in range(1, count + 1)]
+
+    t0 = time.perf_counter()
+    db.bulk_upsert(GUILD_ID, targets)
+    upsert_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    loaded = db.get_all_targets()
+    load_s = time.perf_counter() - t0
+    assert len(loaded.get(GUILD_ID, {})) == count
+
+    results = {"targets": count, "bulk_upsert_s": upsert_s, "get_all_targets_s": load_s}
+    update_calls = {
+        "update_specific_reply": lambda uid: db.update_specific_reply(GUILD_ID, uid, ["a", "b", "c"]),
+        "update_specific_reaction": lambda uid: db.update_specific_reaction(GUILD_ID, uid, ["😂"]),
+        "update_annoy_methods": lambda uid: db.update_annoy_methods(GUILD_ID, uid, ["message"]),
+        "update_message_mode": lambda uid: db.update_message_mode(GUILD_ID, uid, "random_only"),
+        "update_trigger_limits": lambda uid: db.update_trigger_limits(GUILD_ID, uid, 5, 0.5, 3, 60),
+    }
+    for name, call in update_calls.items():
+        t0 = time.perf_counter()
+        for _ in range(updates):
+            call(random.randint(1, count))
+        results[f"{name}_per_sec"] = updates / (time.perf_counter() - t0)
+    db.close()
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+    return results
+
+
+def _user_payload(user_id: int) -> Dict:
+    return {'id': str(user_id), 'username': f"user{user_id}", 'discriminator': '0',
+            'global_name': f"User {user_id}", 'avatar': 'a' * 32}
+
+
+async def bench_gateway_cache(members: int, messages: int) -> Optional[Dict]:
+    """Bytes per cached member and per cached message, as discord.py builds them.
+
+    This is what LOW_MEMORY and MAX_MESSAGES save per object. It relies on
+    discord.py internals, so it returns None if they have changed.
+    """
+    from collections import deque
+
+    import discord
+    from discord.http import HTTPClient
+    from discord.state import ConnectionState
+
+    http = HTTPClient(asyncio.get_running_loop())
+    try:
+        state = ConnectionState(
+            dispatch=lambda *args, **kwargs: None, handlers={}, hooks={}, http=http,
+            intents=discord.Intents.all(), max_messages=messages, member_cache_flags=discord.MemberCacheFlags.all(),
+        )
+        guild = discord.Guild(state=state, data={
+            'id': str(GUILD_ID), 'name': 'bench', 'features': [], 'emojis': [], 'member_count': members,
+            'roles': [{'id': str(GUILD_ID), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                       'hoist': False, 'managed': False, 'mentionable': False}],
+            'channels': [{'id': '2', 'type': 0, 'name': 'general', 'position': 0, 'permission_overwrites': []}],
+        })
+        channel = guild.get_channel(2)
+        member_data = {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for user_id in range(10**17, 10**17 + members):
+            guild._add_member(discord.Member(data=dict(member_data, user=_user_payload(user_id)), guild=guild, state=state))
+        gc.collect()
+        per_member = (tracemalloc.get_traced_memory()[0] - before) / members
+
+        cache = deque(maxlen=messages)
+        before = tracemalloc.get_traced_memory()[0]
+        for message_id in range(messages):
+            cache.append(discord.Message(state=state, channel=channel, data={
+                'id': str(2 * 10**17 + message_id), 'channel_id': '2', 'guild_id': str(GUILD_ID),
+                'author': _user_payload(10**17 + message_id), 'member': member_data,
+                'content': "a typical chat message of moderate length, nothing special",
+                'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'tts': False,
+                'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'attachments': [],
+                'embeds': [], 'pinned': False, 'type': 0,
+            }))
+        gc.collect()
+        per_message = (tracemalloc.get_traced_memory()[0] - before) / messages
+    except Exception as e:
+        print(f"Gateway cache benchmark unavailable with this discord.py version: {e!r}")
+        return None
+    finally:
+        tracemalloc.stop()
+        await http.close()
+    return {"members": members, "bytes_per_member": per_member, "messages": messages, "bytes_per_message": per_message}
+
+
+def format_bytes(value: Optional[float]) -> str:
+    return "n/a" if value is None else f"{value:,.0f} B"
+
+
+async def _skip_commands(message):
+    # There are no prefix commands; skip discord.py's context building
+    pass
+
+
+async def run(args: argparse.Namespace):
+    # Outbound sends are not started, so submitted actions only exercise the queue
+    main.bot.process_commands = _skip_commands
+    random.seed(args.seed)
+
+    print(f"{'targets':>9} {'mode':>13} {'methods':>16} {'msgs/s':>11} {'p50 us':>8} {'p99 us':>8} {'RSS/target':>12}")
+    for count in args.targets:
+        for mode in MESSAGE_MODES:
+            for methods in METHOD_MIXES:
+                result = await bench_on_message(count, args.messages, mode, methods)
+                print(
+                    f"{result['targets']:>9} {result['mode']:>13} {result['methods']:>16} "
+                    f"{result['msgs_per_sec']:>11,.0f} {result['p50_us']:>8.2f} {result['p99_us']:>8.2f} "
+                    f"{format_bytes(result['rss_per_target']):>12}"
+                )
+    reset_caches()
+
+    print()
+    print(f"{'targets':>9} {'settings B':>11} {'plans B':>8} {'total B':>8}  (per target)")
+    for count in args.targets:
+        result = bench_cache_memory(count)
+        print(f"{result['targets']:>9} {result['settings']:>11,.0f} {result['plans']:>8,.0f} "
+              f"{result['settings'] + result['plans']:>8,.0f}")
+
+    print()
+    print(f"{'pool size':>9} {'uniform ns':>11} {'weighted ns':>12} {'shuffle ns':>11}")
+    for size in args.pool_sizes:
+        result = bench_selection(size, args.picks)
+        print(f"{result['size']:>9} {result['uniform']:>11.0f} {result['weighted']:>12.0f} {result['shuffle']:>11.0f}")
+
+    print()
+    print(f"{'rules':>9} {'compile s':>10} {'miss us':>8} {'hit us':>8}")
+    for count in args.rule_counts:
+        result = bench_rules(count, args.matches)
+        print(f"{result['rules']:>9} {result['compile_s']:>10.3f} {result['miss_us']:>8.1f} {result['hit_us']:>8.1f}")
+
+    if not args.skip_gateway:
+        result = await bench_gateway_cache(args.gateway_members, args.gateway_messages)
+        if result is not None:
+            print()
+            print(f"Gateway cache: {format_bytes(result['bytes_per_member'])} per cached member "
+                  f"({result['members']:,} members), {format_bytes(result['bytes_per_message'])} per cached message "
+                  f"({result['messages']:,} messages)")
+
+    if args.skip_db:
+        return
+    print()
+    for count in args.db_targets:
+        result = bench_database(count, args.updates)
+        print(f"AnnoyanceDB with {count} targets:")
+        for name, value in result.items():
+            if name != "targets":
+                print(f"  {name:<34} {value:,.4f}" if name.endswith('_s') else f"  {name:<34} {value:,.0f}")
+
+
+def parse_counts(text: str) -> List[int]:
+    return [int(part) for part in text.split(',') if part.strip()]
+
+
+def main_cli(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', type=parse_counts, default=parse_counts('10,1000,100000,1000000'),
+                        help="Comma-separated target counts for on_message (default: 10,1000,100000,1000000)")
+    parser.add_argument('--messages', type=int, default=20000, help="Messages per on_message run")
+    parser.add_argument('--db-targets', type=parse_counts, default=parse_counts('10,1000,100000'),
+                        help="Comma-separated target counts for the database benchmarks")
+    parser.add_argument('--updates', type=int, default=200, help="Calls per update_* method")
+    parser.add_argument('--pool-sizes', type=parse_counts, default=parse_counts('10,1000,100000'),
+                        help="Comma-separated reply pool sizes for the selection benchmark")
+    parser.add_argument('--picks', type=int, default=200000, help="Picks per selection benchmark run")
+    parser.add_argument('--rule-counts', type=parse_counts, default=parse_counts('10,1000,10000'),
+                        help="Comma-separated keyword rule counts for the content-rule benchmark")
+    parser.add_argument('--matches', type=int, default=5000, help="Messages matched per content-rule benchmark run")
+    parser.add_argument('--skip-db', action='store_true', help="Skip the database benchmarks")
+    parser.add_argument('--gateway-members', type=int, default=20000, help="Members for the gateway cache benchmark")
+    parser.add_argument('--gateway-messages', type=int, default=1000, help="Messages for the gateway cache benchmark")
+    parser.add_argument('--skip-gateway', action='store_true', help="Skip the gateway cache benchmark")
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    finally:
+        main.db.close()
+
+
+if __name__ == '__main__':
+    main_cli(sys.argv[1:])
@@ -0,0 +1,93 @@
+# cache_sync.py
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from database import AsyncAnnoyanceDB
+
+log = logging.getLogger(__name__)
+
+ChangedTargets = Dict[Tuple[int, int], Optional[Dict[str, Any]]]
+
+
+class CacheSync:
+    """Keeps the in-memory target cache in step with writes from other processes.
+
+    Polls PRAGMA data_version, which only changes when another connection has
+    committed. Only then does it read the target_changes log and hand the
+    changed targets to apply_changes, so an idle poll is a single PRAGMA. If
+    the log was pruned past what this process has seen, reload_all is called
+    instead.
+    """
+
+    def __init__(
+        self,
+        db: AsyncAnnoyanceDB,
+        apply_changes: Callable[[ChangedTargets], Awaitable[Any]],
+        reload_all: Callable[[], Awaitable[Any]],
+        interval: float = 1.0,
+        retention: float = 86400.0,
+        prune_interval: float = 3600.0,
+    ):
+        self.db = db
+        self.apply_changes = apply_changes
+        self.reload_all = reload_all
+        self.interval = interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.seq = 0
+        self._data_version: Optional[int] = None
+        self._last_prune = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    async def mark(self):
+        """Records the current position in the change log.
+
+        Call before the initial load, so changes committed during the load are
+        replayed rather than missed.
+        """
+        self._data_version = await self.db.data_version()
+        self.seq = await self.db.latest_change_seq()
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def poll(self) -> int:
+        """Applies any new changes. Returns the number of targets reloaded."""
+        version = await self.db.data_version()
+        if version == self._data_version:
+            return 0
+        self._data_version = version
+
+        result = await self.db.get_changed_targets(self.seq)
+        if result is None:
+            log.warning("Change log was pruned past seq %s; reloading every cached guild", self.seq)
+            self.seq = await self.db.latest_change_seq()
+            await self.reload_all()
+            return -1
+        self.seq, changed = result
+        if changed:
+            await self.apply_changes(changed)
+            log.debug("Reloaded %s changed target(s) up to seq %s", len(changed), self.seq)
+        return len(changed)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+                if time.monotonic() - self._last_prune >= self.prune_interval:
+                    self._last_prune = time.monotonic()
+                    pruned = await self.db.prune_changes(self.retention)
+                    if pruned:
+                        log.info("Pruned %s old change-log row(s)", pruned)
+            except Exception:
+                log.exception("Cache sync poll failed")
@@ -0,0 +1,292 @@
+# content_rules.py
+import logging
+import re
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+try:
+    from re import _constants as _sre, _parser as _sre_parse  # Python 3.11+
+except ImportError:
+    import sre_constants as _sre  # type: ignore
+    import sre_parse as _sre_parse  # type: ignore
+
+log = logging.getLogger(__name__)
+
+# Longest keyword or regex a rule may use
+MAX_PATTERN_LENGTH = 200
+RULE_ACTIONS = ('reply', 'reaction')
+# Regex rules one guild may have; each one adds to the cost of every message
+MAX_REGEX_RULES = 10
+# Regex rules only look at the start of a message. Even a safe pattern can
+# take time quadratic in the text it searches, and this keeps that bounded.
+MAX_REGEX_SCAN = 256
+# A repeat allowed more than this many times counts as open-ended
+_OPEN_ENDED = 10
+
+_REPEATS = {_sre.MAX_REPEAT, _sre.MIN_REPEAT, getattr(_sre, 'POSSESSIVE_REPEAT', _sre.MAX_REPEAT)}
+_ZERO_WIDTH = {_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT}
+
+# Backreferences would point at the wrong group once patterns are combined
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class ContentRule(NamedTuple):
+    id: int
+    # None for a guild-wide rule that applies to every author
+    user_id: Optional[int]
+    pattern: str
+    is_regex: bool
+    action: str  # 'reply' or 'reaction'
+    payload: str
+
+
+def _children(op, av) -> List[Any]:
+    """The subpatterns directly inside one parsed regex item."""
+    if op is _sre.SUBPATTERN:
+        return [av[3]]
+    if op is _sre.BRANCH:
+        return list(av[1])
+    if op in _REPEATS:
+        return [av[2]]
+    if op in (_sre.ASSERT, _sre.ASSERT_NOT):
+        return [av[1]]
+    if op is getattr(_sre, 'ATOMIC_GROUP', None):
+        return [av]
+    if op is _sre.GROUPREF_EXISTS:
+        return [child for child in av[1:] if child is not None]
+    return []
+
+
+def _chars(items) -> Optional[FrozenSet[str]]:
+    """Every (lowercased) character the items can consume, or None if that's too broad to list."""
+    chars = set()
+    for op, av in items:
+        if op is _sre.LITERAL:
+            chars.add(chr(av).lower())
+        elif op is _sre.IN:
+            for item_op, item_av in av:
+                if item_op is _sre.LITERAL:
+                    chars.add(chr(item_av).lower())
+                elif item_op is _sre.RANGE and item_av[1] - item_av[0] < 256:
+                    chars.update(chr(code).lower() for code in range(item_av[0], item_av[1] + 1))
+                else:
+                    # Categories such as \w, negated sets and wide ranges
+                    return None
+        elif op in (_sre.ANY, _sre.NOT_LITERAL, _sre.CATEGORY):
+            return None
+        else:
+            for child in _children(op, av):
+                child_chars = _chars(child)
+                if child_chars is None:
+                    return None
+                chars |= child_chars
+    return frozenset(chars)
+
+
+def _first_chars(items) -> Optional[FrozenSet[str]]:
+    """The characters a match of the items can start with, or None if unknown or it can be empty."""
+    for op, av in items:
+        if op in _ZERO_WIDTH:
+            continue
+        if op is _sre.SUBPATTERN:
+            return _first_chars(av[3])
+        if op is _sre.BRANCH:
+            firsts = [_first_chars(alternative) for alternative in av[1]]
+            return None if None in firsts else frozenset().union(*firsts)
+        if op in _REPEATS:
+            return _first_chars(av[2]) if av[0] > 0 else None
+        if op in (_sre.LITERAL, _sre.IN, _sre.ANY, _sre.NOT_LITERAL, _sre.CATEGORY):
+            return _chars([(op, av)])
+        return None
+    return None
+
+
+def _backtracking_risk(items, in_repeat: bool, open_ended: List[Optional[FrozenSet[str]]]) -> Optional[str]:
+    """Why the items could backtrack catastrophically, or None. Collects the open-ended repeats' characters."""
+    for op, av in items:
+        if op in _REPEATS:
+            if in_repeat:
+                return "Regex rules can't repeat a group that contains another repeat, like (a+)+."
+            low, high, body = av
+            if high > _OPEN_ENDED:
+                open_ended.append(_chars(body))
+            error = _backtracking_risk(body, high > 1, open_ended)
+        elif op is _sre.BRANCH and in_repeat:
+            firsts = [_first_chars(alternative) for alternative in av[1]]
+            seen: set = set()
+            for first in firsts:
+                if first is None or seen & first:
+                    return "Alternatives inside a repeated group must each start with a different character, unlike (a|ab)+."
+                seen |= first
+            error = None
+            for alternative in av[1]:
+                error = error or _backtracking_risk(alternative, in_repeat, open_ended)
+        else:
+            error = None
+            for child in _children(op, av):
+                error = error or _backtracking_risk(child, in_repeat, open_ended)
+        if error:
+            return error
+    return None
+
+
+def backtracking_risk(pattern: str) -> Optional[str]:
+    """Returns why a regex could take exponential or high polynomial time to search, or None.
+
+    Conservative rather than exact: a repeat may not contain another repeat
+    or alternatives that can start the same way, and no two open-ended
+    repeats may be able to match the same characters (as in .*.* or \\w+\\w+).
+    Some harmless patterns are turned away too.
+    """
+    open_ended: List[Optional[FrozenSet[str]]] = []
+    error = _backtracking_risk(_sre_parse.parse(pattern, re.IGNORECASE), False, open_ended)
+    if error:
+        return error
+    for i, chars in enumerate(open_ended):
+        for other in open_ended[i + 1:]:
+            if chars is None or other is None or chars & other:
+                return "Regex rules can't have two open-ended repeats (+, * or {n,}) that could match the same characters, like .*.* or \\w+ \\w+."
+    return None
+
+
+def validate_pattern(pattern: str, is_regex: bool) -> Optional[str]:
+    """Returns why the pattern can't be used, or None if it's fine."""
+    if not pattern.strip():
+        return "The pattern can't be empty."
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        return f"The pattern can be at most {MAX_PATTERN_LENGTH} characters."
+    if not is_regex:
+        return None
+    try:
+        # Compiled the way RuleMatcher embeds it, which also rejects mid-pattern global flags
+        compiled = re.compile(f"(?:{pattern})")
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    if compiled.groupindex or _BACKREFERENCE.search(pattern):
+        return "Regex rules can't use named groups or backreferences."
+    if compiled.match(''):
+        return "The regex must not match an empty message."
+    return backtracking_risk(pattern)
+
+
+def _trie_pattern(keywords: Iterable[str]) -> str:
+    """Builds a regex matching any keyword, shaped like a trie of the keywords.
+
+    re then walks the trie from each position instead of trying every keyword
+    in turn, so a search costs about the same with ten keywords or ten
+    thousand. Optional tails are greedy, so the longest keyword wins.
+    """
+    trie: Dict[str, dict] = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node: Dict[str, dict]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+class _ScopeMatcher:
+    """Rules that all apply to one author, compiled into one case-insensitive regex for keywords and one for regexes.
+
+    Keywords match as whole words through one trie-shaped group; each regex
+    rule becomes its own named alternative. Keywords are looked for in the
+    whole message, regex rules only in its first MAX_REGEX_SCAN characters.
+    """
+    __slots__ = ('_keywords', '_regexes', '_keyword_rules', '_regex_rules')
+
+    def __init__(self, rules: Iterable[ContentRule]):
+        self._keyword_rules: Dict[str, ContentRule] = {}
+        self._regex_rules: Dict[str, ContentRule] = {}
+        alternatives = []
+        for rule in rules:
+            if rule.is_regex:
+                name = f"r{rule.id}"
+                self._regex_rules[name] = rule
+                alternatives.append(f"(?P<{name}>{rule.pattern})")
+            else:
+                # The first rule for a keyword wins
+                self._keyword_rules.setdefault(rule.pattern.strip().lower(), rule)
+        self._keywords = re.compile(
+            rf"(?<!\w)(?:{_trie_pattern(self._keyword_rules)})(?!\w)", re.IGNORECASE
+        ) if self._keyword_rules else None
+        self._regexes = re.compile('|'.join(alternatives), re.IGNORECASE) if alternatives else None
+
+    def match(self, text: str) -> Optional[ContentRule]:
+        start, rule = len(text), None
+        if self._keywords is not None:
+            found = self._keywords.search(text)
+            if found is not None:
+                start, rule = found.start(), self._keyword_rules[found.group().lower()]
+        if self._regexes is not None:
+            found = self._regexes.search(text, 0, MAX_REGEX_SCAN)
+            # Only a match starting before the keyword wins
+            if found is not None and found.start() < start:
+                rule = self._regex_rules[found.lastgroup]
+        return rule
+
+
+class RuleMatcher:
+    """All content rules of one guild, compiled per author scope.
+
+    Guild-wide rules are compiled once. An author with rules of their own
+    gets a matcher of the guild-wide rules plus theirs, compiled on their
+    first message. Every rule in a scope applies, so a longer keyword or an
+    earlier regex alternative belonging to someone else can't hide a rule
+    that matches at the same position. Built once per rule change.
+    """
+    __slots__ = ('rule_count', 'regex_count', '_rules', '_user_ids', '_guild_wide', '_scopes')
+
+    def __init__(self, rules: Iterable[ContentRule]):
+        self._rules = tuple(rules)
+        self.rule_count = len(self._rules)
+        self.regex_count = sum(1 for rule in self._rules if rule.is_regex)
+        self._user_ids = frozenset(rule.user_id for rule in self._rules if rule.user_id is not None)
+        self._guild_wide = _ScopeMatcher(rule for rule in self._rules if rule.user_id is None)
+        self._scopes: Dict[int, _ScopeMatcher] = {}
+
+    def _scope(self, author_id: int) -> _ScopeMatcher:
+        if author_id not in self._user_ids:
+            return self._guild_wide
+        scope = self._scopes.get(author_id)
+        if scope is None:
+            scope = self._scopes[author_id] = _ScopeMatcher(
+                rule for rule in self._rules if rule.user_id is None or rule.user_id == author_id
+            )
+        return scope
+
+    def match(self, text: str, author_id: int) -> Optional[ContentRule]:
+        """Returns the first rule in text that applies to author_id, if any.
+
+        A keyword wins over a regex matching at the same position.
+        """
+        return self._scope(author_id).match(text)
+
+
+def compile_rules(rows: Iterable[Dict[str, Any]]) -> Optional[RuleMatcher]:
+    """Compiles a guild's rule rows from AnnoyanceDB, or returns None if there are none.
+
+    Rows the commands would have rejected (e.g. inserted by a script) are
+    skipped with a warning rather than breaking the whole guild's matcher.
+    """
+    rules = []
+    regex_count = 0
+    for row in rows:
+        error = validate_pattern(row["pattern"], bool(row["is_regex"]))
+        if error is None and row["is_regex"]:
+            regex_count += 1
+            if regex_count > MAX_REGEX_RULES:
+                error = f"more than {MAX_REGEX_RULES} regex rules"
+        if error or row["action"] not in RULE_ACTIONS:
+            log.warning("Skipping trigger rule %s: %s", row["id"], error or f"unknown action {row['action']!r}")
+            continue
+        rules.append(
+            ContentRule(row["id"], row["user_id"], row["pattern"], bool(row["is_regex"]), row["action"], row["payload"])
+        )
+    return RuleMatcher(rules) if rules else None
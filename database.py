@@ -1,278 +1,1686 @@
 # database.py
+import asyncio
+import functools
+import logging
 import sqlite3
+import time
 import json # Import json to handle lists of strings
-from typing import Optional, Dict, Any, List
-from json import JSONDecodeError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Callable, Iterable, Sequence, Tuple
+
+from metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+# Targets created before guild scoping existed were migrated into this
+# pseudo-guild. They keep applying in every guild the bot is in.
+LEGACY_GUILD_ID = 0
+
+# target_changes rows with this user_id mean a guild's content rules changed
+RULES_CHANGE_USER_ID = 0
+# ...and with this one, that a guild's scheduled annoyances were added, edited or removed
+SCHEDULES_CHANGE_USER_ID = -1
+
+# Bits of targets.method_flags
+METHOD_FLAGS = {'message': 1, 'reaction': 2}
+
+
+def methods_to_flags(methods: Iterable[str]) -> int:
+    flags = 0
+    for method in methods:
+        flags |= METHOD_FLAGS.get(method, 0)
+    return flags
+
+
+def flags_to_methods(flags: int) -> List[str]:
+    return [method for method, bit in METHOD_FLAGS.items() if flags & bit]
+
+
+# --- SCHEMA MIGRATIONS --- #
+# Each step runs inside one transaction and bumps PRAGMA user_version, so a
+# database only ever runs the steps it hasn't seen yet.
+
+def _migration_1_guild_scoped_targets(cursor: sqlite3.Cursor):
+    """Brings any pre-versioning 'targets' table to the guild-scoped JSON layout."""
+    cursor.execute("PRAGMA table_info(targets)")
+    columns = {column[1] for column in cursor.fetchall()}
+    create_sql = '''
+        CREATE TABLE targets (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            specific_reply TEXT,
+            specific_reaction TEXT,
+            annoy_methods TEXT DEFAULT 'message,reaction',
+            message_mode TEXT DEFAULT 'both',
+            cooldown_seconds REAL DEFAULT 0,
+            trigger_probability REAL DEFAULT 1,
+            max_actions INTEGER DEFAULT 0,
+            action_window_seconds REAL DEFAULT 60,
+            PRIMARY KEY (guild_id, user_id)
+        )
+    '''
+    if not columns:
+        cursor.execute(create_sql)
+        return
+
+    # Columns that were added one release at a time before versioning existed
+    for column, definition in (
+        ('specific_reaction', 'TEXT'),
+        ('annoy_methods', "TEXT DEFAULT 'message,reaction'"),
+        ('message_mode', "TEXT DEFAULT 'both'"),
+        ('cooldown_seconds', 'REAL DEFAULT 0'),
+        ('trigger_probability', 'REAL DEFAULT 1'),
+        ('max_actions', 'INTEGER DEFAULT 0'),
+        ('action_window_seconds', 'REAL DEFAULT 60'),
+    ):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE targets ADD COLUMN {column} {definition}")
+
+    if 'guild_id' not in columns:
+        # Rows from before guild scoping keep applying everywhere
+        cursor.execute("ALTER TABLE targets RENAME TO targets_unscoped")
+        cursor.execute(create_sql)
+        cursor.execute(
+            "INSERT INTO targets SELECT ?, user_id, specific_reply, specific_reaction, annoy_methods, message_mode, "
+            "cooldown_seconds, trigger_probability, max_actions, action_window_seconds FROM targets_unscoped",
+            (LEGACY_GUILD_ID,)
+        )
+        cursor.execute("DROP TABLE targets_unscoped")
+
+
+def _migration_2_normalized_items(cursor: sqlite3.Cursor):
+    """Moves replies and reactions into child tables and methods into a bitmask."""
+    cursor.execute("ALTER TABLE targets RENAME TO targets_json")
+    cursor.execute('''
+        CREATE TABLE targets (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message_mode TEXT NOT NULL DEFAULT 'both', -- 'specific_only', 'random_only', 'both'
+            method_flags INTEGER NOT NULL DEFAULT 3,   -- Bitmask of METHOD_FLAGS
+            cooldown_seconds REAL NOT NULL DEFAULT 0,       -- Minimum gap between annoyances
+            trigger_probability REAL NOT NULL DEFAULT 1,    -- Chance (0-1) that a message triggers at all
+            max_actions INTEGER NOT NULL DEFAULT 0,         -- Max annoyances per window, 0 = unlimited
+            action_window_seconds REAL NOT NULL DEFAULT 60, -- Window length for max_actions
+            PRIMARY KEY (guild_id, user_id)
+        )
+    ''')
+    # Ordered by position; the primary key doubles as the per-target index
+    for table, column in (('target_replies', 'content'), ('target_reactions', 'emoji')):
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                guild_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                {column} TEXT NOT NULL,
+                PRIMARY KEY (guild_id, user_id, position),
+                FOREIGN KEY (guild_id, user_id) REFERENCES targets (guild_id, user_id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        ''')
+
+    cursor.execute(
+        "SELECT guild_id, user_id, specific_reply, specific_reaction, annoy_methods, message_mode, "
+        "cooldown_seconds, trigger_probability, max_actions, action_window_seconds FROM targets_json"
+    )
+    targets, replies, reactions = [], [], []
+    for row in cursor.fetchall():
+        guild_id, user_id = row[0], row[1]
+        methods = row[4].split(',') if row[4] else []
+        targets.append((
+            guild_id, user_id, row[5] or 'both', methods_to_flags(methods),
+            row[6] if row[6] is not None else 0, row[7] if row[7] is not None else 1,
+            row[8] if row[8] is not None else 0, row[9] if row[9] is not None else 60,
+        ))
+        for items, blob in ((replies, row[2]), (reactions, row[3])):
+            try:
+                decoded = json.loads(blob) if blob else []
+            except json.JSONDecodeError:
+                log.warning("Dropping unreadable items for target %s in guild %s", user_id, guild_id)
+                decoded = []
+            items.extend((guild_id, user_id, position, item) for position, item in enumerate(decoded))
+
+    cursor.executemany("INSERT INTO targets VALUES (?, ?, ?, ?, ?, ?, ?, ?)", targets)
+    cursor.executemany("INSERT INTO target_replies VALUES (?, ?, ?, ?)", replies)
+    cursor.executemany("INSERT INTO target_reactions VALUES (?, ?, ?, ?)", reactions)
+    cursor.execute("DROP TABLE targets_json")
+
+
+def _migration_3_change_log(cursor: sqlite3.Cursor):
+    """Adds the target_changes log, filled by triggers on every target table."""
+    # AUTOINCREMENT so a sequence number is never reused after pruning
+    cursor.execute('''
+        CREATE TABLE target_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            changed_at REAL NOT NULL -- Unix time, used for pruning
+        )
+    ''')
+    # Triggers rather than application code, so edits from scripts or other
+    # tools reach every process too
+    for table in ('targets', 'target_replies', 'target_reactions'):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER {table}_{event.lower()}_log AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO target_changes (guild_id, user_id, changed_at)
+                    VALUES ({row}.guild_id, {row}.user_id, (julianday('now') - 2440587.5) * 86400.0);
+                END
+            ''')
+
+
+def _migration_4_bot_state(cursor: sqlite3.Cursor):
+    """Adds the bot_state key/value table and a random instance_id for this database."""
+    cursor.execute('''
+        CREATE TABLE bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # Tells cache snapshots apart when the database file is replaced, e.g. by a restore
+    cursor.execute("INSERT INTO bot_state (key, value) VALUES ('instance_id', lower(hex(randomblob(16))))")
+
+
+def _migration_5_selection(cursor: sqlite3.Cursor):
+    """Adds per-item weights and a per-target selection mode."""
+    for table in ('target_replies', 'target_reactions'):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN weight REAL NOT NULL DEFAULT 1")
+    # 'weighted' draws by weight; 'shuffle' cycles through every item before repeating any
+    cursor.execute("ALTER TABLE targets ADD COLUMN selection_mode TEXT NOT NULL DEFAULT 'weighted'")
+
+
+def _migration_6_event_log(cursor: sqlite3.Cursor):
+    """Adds the raw annoyance event log and its hourly rollups."""
+    cursor.execute('''
+        CREATE TABLE annoyance_events (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL, -- Unix time
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            item TEXT NOT NULL,
+            latency REAL NOT NULL, -- Seconds from submit to send (or drop)
+            outcome TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX annoyance_events_created_at ON annoyance_events (created_at)")
+    # Kept current as events are appended, so stats never scan the raw log
+    cursor.execute('''
+        CREATE TABLE annoyance_rollups (
+            guild_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL, -- Unix time // 3600
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            latency_sum REAL NOT NULL,
+            latency_max REAL NOT NULL,
+            PRIMARY KEY (guild_id, hour, user_id, method, outcome)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_7_burst_size(cursor: sqlite3.Cursor):
+    """Adds how many actions one triggering message may get at once."""
+    cursor.execute("ALTER TABLE targets ADD COLUMN burst_size INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_8_trigger_rules(cursor: sqlite3.Cursor):
+    """Adds keyword/regex content rules, logged to target_changes like target edits."""
+    cursor.execute('''
+        CREATE TABLE trigger_rules (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER, -- NULL applies to every author in the guild
+            pattern TEXT NOT NULL,
+            is_regex INTEGER NOT NULL DEFAULT 0,
+            action TEXT NOT NULL, -- 'reply' or 'reaction'
+            payload TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX trigger_rules_guild ON trigger_rules (guild_id)")
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        cursor.execute(f'''
+            CREATE TRIGGER trigger_rules_{event.lower()}_log AFTER {event} ON trigger_rules
+            BEGIN
+                INSERT INTO target_changes (guild_id, user_id, changed_at)
+                VALUES ({row}.guild_id, {RULES_CHANGE_USER_ID}, (julianday('now') - 2440587.5) * 86400.0);
+            END
+        ''')
+
+
+def _migration_9_scheduled_annoyances(cursor: sqlite3.Cursor):
+    """Adds scheduled annoyances, read by the scheduler through the next_run index."""
+    cursor.execute('''
+        CREATE TABLE scheduled_annoyances (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            interval_seconds REAL, -- NULL for a one-off
+            next_run REAL, -- Unix time; NULL once a one-off has run
+            FOREIGN KEY (guild_id, user_id) REFERENCES targets (guild_id, user_id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute("CREATE INDEX scheduled_annoyances_next_run ON scheduled_annoyances (next_run)")
+    # Also serves the cascade when a target is removed
+    cursor.execute("CREATE INDEX scheduled_annoyances_target ON scheduled_annoyances (guild_id, user_id)")
+    # The scheduler moving next_run along is not a change other processes need to hear about
+    for event, row, condition in (
+        ('INSERT', 'NEW', ''),
+        ('UPDATE OF channel_id, user_id, message, interval_seconds', 'NEW', ''),
+        ('DELETE', 'OLD', 'WHEN OLD.next_run IS NOT NULL'),
+    ):
+        cursor.execute(f'''
+            CREATE TRIGGER scheduled_annoyances_{event.split()[0].lower()}_log AFTER {event} ON scheduled_annoyances
+            {condition}
+            BEGIN
+                INSERT INTO target_changes (guild_id, user_id, changed_at)
+                VALUES ({row}.guild_id, {SCHEDULES_CHANGE_USER_ID}, (julianday('now') - 2440587.5) * 86400.0);
+            END
+        ''')
+
+
+MIGRATIONS: Sequence[Callable[[sqlite3.Cursor], None]] = (
+    _migration_1_guild_scoped_targets,
+    _migration_2_normalized_items,
+    _migration_3_change_log,
+    _migration_4_bot_state,
+    _migration_5_selection,
+    _migration_6_event_log,
+    _migration_7_burst_size,
+    _migration_8_trigger_rules,
+    _migration_9_scheduled_annoyances,
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Scalar columns read for every target, in the order _row_to_settings expects
+TARGET_COLUMNS = (
+    "message_mode, method_flags, cooldown_seconds, trigger_probability, max_actions, action_window_seconds, "
+    "selection_mode, burst_size"
+)
+# (table, item column, settings key, settings key of the parallel weight list)
+ITEM_TABLES = (
+    ('target_replies', 'content', 'specific_reply', 'reply_weights'),
+    ('target_reactions', 'emoji', 'specific_reaction', 'reaction_weights'),
+)
+
+
+def _row_to_settings(row) -> Dict[str, Any]:
+    """Decodes a row of TARGET_COLUMNS into a settings dict with empty item lists."""
+    return {
+        "specific_reply": [],
+        "specific_reaction": [],
+        "reply_weights": [],
+        "reaction_weights": [],
+        "annoy_methods": flags_to_methods(row[1]),
+        "message_mode": row[0],
+        "cooldown_seconds": row[2],
+        "trigger_probability": row[3],
+        "max_actions": row[4],
+        "action_window_seconds": row[5],
+        "selection_mode": row[6],
+        "burst_size": row[7],
+    }
+
+
+def _item_rows(guild_id: int, user_id: int, items: Sequence[str], weights: Optional[Sequence[float]]) -> List[tuple]:
+    if weights is None:
+        weights = [1.0] * len(items)
+    return [(guild_id, user_id, position, item, weight) for position, (item, weight) in enumerate(zip(items, weights))]
+
+
+def _guild_filter(guild_ids: Optional[Sequence[int]]) -> Tuple[str, List[int]]:
+    if guild_ids is None:
+        return "", []
+    return f" WHERE guild_id IN ({','.join('?' * len(guild_ids))})", list(guild_ids)
+
 
 class AnnoyanceDB:
-    def __init__(self, db_name: str = 'annoy_o_matic.db'):
+    def __init__(self, db_name: str = 'annoy_o_matic.db', read_only: bool = False, synchronous: Optional[str] = None):
         self.db_name = db_name
+        self.read_only = read_only
+        # e.g. 'NORMAL': in WAL mode this can lose the last commits on power loss but never corrupts the file
+        if synchronous is not None and synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"Invalid synchronous setting: {synchronous}")
+        self.synchronous = synchronous.upper() if synchronous else None
         self.conn: Optional[sqlite3.Connection] = None
         self.cursor: Optional[sqlite3.Cursor] = None
+        self._in_batch = False
         self._connect()
-        self._create_table()
-        self._add_missing_columns() # New: Add this to handle schema changes
+        if not read_only:
+            self._migrate()
 
     def _connect(self):
         """Establishes a connection to the SQLite database."""
         try:
             self.conn = sqlite3.connect(self.db_name)
             self.cursor = self.conn.cursor()
-            print(f"Connected to database: {self.db_name}")
+            # Needed for ON DELETE CASCADE from targets to their replies/reactions
+            self.cursor.execute("PRAGMA foreign_keys = ON")
+            if self.read_only:
+                # Reader connections must never take the write lock
+                self.cursor.execute("PRAGMA query_only = ON")
+            else:
+                # Only takes effect on a new, empty database; lets maintenance free pages without a full VACUUM
+                self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                # WAL lets the reader connection run while the writer commits
+                self.cursor.execute("PRAGMA journal_mode = WAL")
+                if self.synchronous:
+                    self.cursor.execute(f"PRAGMA synchronous = {self.synchronous}")
+            log.info("Connected to database: %s", self.db_name)
         except sqlite3.Error as e:
-            print(f"Error connecting to database: {e}")
+            log.error("Error connecting to database: %s", e)
             self.conn = None
             self.cursor = None
 
-    def _create_table(self):
-        """Creates the 'targets' table if it doesn't exist."""
+    def _migrate(self):
+        """Runs the schema migrations this database hasn't applied yet."""
         if not self.conn or not self.cursor:
-            print("Cannot create table: No database connection.")
+            log.error("Cannot migrate schema: No database connection.")
             return
-        try:
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS targets (
-                    user_id INTEGER PRIMARY KEY,
-                    specific_reply TEXT,          -- Stores JSON string of messages
-                    specific_reaction TEXT,       -- Stores JSON string of emojis
-                    annoy_methods TEXT DEFAULT 'message,reaction', -- Comma-separated: message,reaction
-                    message_mode TEXT DEFAULT 'both' -- 'specific_only', 'random_only', 'both'
-                )
-            ''')
-            self.conn.commit()
-            print("Table 'targets' ensured.")
-        except sqlite3.Error as e:
-            print(f"Error creating table: {e}")
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for step_version, step in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                self.cursor.execute("BEGIN")
+                step(self.cursor)
+                self.cursor.execute(f"PRAGMA user_version = {step_version}")
+                self.conn.commit()
+                log.info("Applied schema migration %s: %s", step_version, step.__doc__)
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                log.error("Error applying schema migration %s: %s", step_version, e)
+                return
 
-    def _add_missing_columns(self):
-        """Adds new columns if they don't exist (for schema evolution)."""
-        if not self.conn or not self.cursor:
-            return
+    @contextmanager
+    def _transaction(self):
+        """Commits the enclosed statements, or rolls them back on error.
 
-        # Check for 'specific_reaction' (already added in previous version, keeping for context)
+        Inside run_batch each operation becomes a savepoint instead, so a failing
+        operation is undone on its own and the batch still commits once.
+        """
+        if not self._in_batch:
+            with self.conn:
+                yield
+            return
+        self.cursor.execute("SAVEPOINT batch_operation")
         try:
-            self.cursor.execute("SELECT specific_reaction FROM targets LIMIT 1")
-        except sqlite3.OperationalError:
-            self.cursor.execute("ALTER TABLE targets ADD COLUMN specific_reaction TEXT")
-            self.conn.commit()
-            print("Added 'specific_reaction' column.")
+            yield
+        except BaseException:
+            self.cursor.execute("ROLLBACK TO batch_operation")
+            self.cursor.execute("RELEASE batch_operation")
+            raise
+        self.cursor.execute("RELEASE batch_operation")
 
-        # Check for 'annoy_methods' (already added)
+    def run_batch(self, operations: List[Tuple[str, tuple]]) -> bool:
+        """Runs many write methods, given as (method name, args), in one transaction."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot run batch: No database connection.")
+            return False
         try:
-            self.cursor.execute("SELECT annoy_methods FROM targets LIMIT 1")
-        except sqlite3.OperationalError:
-            self.cursor.execute("ALTER TABLE targets ADD COLUMN annoy_methods TEXT DEFAULT 'message,reaction'")
+            self.cursor.execute("BEGIN")
+            self._in_batch = True
+            try:
+                for name, args in operations:
+                    getattr(self, name)(*args)
+            finally:
+                self._in_batch = False
             self.conn.commit()
-            print("Added 'annoy_methods' column.")
+            return True
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            log.error("Error running batch of %s write(s): %s", len(operations), e)
+            return False
 
-        # Check for 'message_mode' (already added)
-        try:
-            self.cursor.execute("SELECT message_mode FROM targets LIMIT 1")
-        except sqlite3.OperationalError:
-            self.cursor.execute("ALTER TABLE targets ADD COLUMN message_mode TEXT DEFAULT 'both'")
-            self.conn.commit()
-            print("Added 'message_mode' column.")
+    def _target_exists(self, guild_id: int, user_id: int) -> bool:
+        self.cursor.execute("SELECT 1 FROM targets WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        return self.cursor.fetchone() is not None
 
-    def add_target(self, user_id: int) -> bool:
+    def _replace_items(
+        self, table: str, column: str, guild_id: int, user_id: int, items: List[str], weights: Optional[List[float]] = None
+    ):
+        self.cursor.execute(f"DELETE FROM {table} WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        self.cursor.executemany(
+            f"INSERT INTO {table} (guild_id, user_id, position, {column}, weight) VALUES (?, ?, ?, ?, ?)",
+            _item_rows(guild_id, user_id, items, weights)
+        )
+
+    def add_target(self, guild_id: int, user_id: int) -> bool:
         """Adds a target user without a specific reply/reaction (initial setup)."""
         if not self.conn or not self.cursor:
-            print("Cannot add target: No database connection.")
+            log.error("Cannot add target: No database connection.")
             return False
         try:
-            self.cursor.execute(
-                "INSERT OR IGNORE INTO targets (user_id, specific_reply, specific_reaction) VALUES (?, ?, ?)",
-                (user_id, json.dumps([]), json.dumps([]))
-            )
-            self.conn.commit()
-            if self.cursor.rowcount > 0:
-                print(f"Added new target: {user_id}")
+            with self._transaction():
+                self.cursor.execute(
+                    "INSERT OR IGNORE INTO targets (guild_id, user_id) VALUES (?, ?)",
+                    (guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            if changed > 0:
+                log.info("Added new target: %s in guild %s", user_id, guild_id)
                 return True
             else:
-                print(f"Target {user_id} already exists.")
+                log.debug("Target %s already exists in guild %s.", user_id, guild_id)
                 return False # Already exists, but consider it successful if it's just about existence
         except sqlite3.Error as e:
-            print(f"Error adding target: {e}")
+            log.error("Error adding target: %s", e)
             return False
 
-    def remove_target(self, user_id: int) -> bool:
-        """Removes a target user from the database."""
+    def remove_target(self, guild_id: int, user_id: int) -> bool:
+        """Removes a target user, and their replies, reactions and schedules, from the database."""
         if not self.conn or not self.cursor:
-            print("Cannot remove target: No database connection.")
+            log.error("Cannot remove target: No database connection.")
             return False
         try:
-            self.cursor.execute("DELETE FROM targets WHERE user_id = ?", (user_id,))
-            self.conn.commit()
-            if self.cursor.rowcount > 0:
-                print(f"Removed target: {user_id}")
+            with self._transaction():
+                self.cursor.execute("DELETE FROM targets WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+                changed = self.cursor.rowcount
+            if changed > 0:
+                log.info("Removed target: %s from guild %s", user_id, guild_id)
                 return True
             else:
-                print(f"Target {user_id} not found.")
+                log.debug("Target %s not found in guild %s.", user_id, guild_id)
                 return False
         except sqlite3.Error as e:
-            print(f"Error removing target: {e}")
+            log.error("Error removing target: %s", e)
             return False
 
-    def update_specific_reply(self, user_id: int, specific_replies: List[str]) -> bool:
-        """Updates the specific text replies for a target user."""
+    def adopt_legacy_target(self, guild_id: int, user_id: int) -> bool:
+        """Moves a target's legacy row, with its replies and reactions, into guild_id.
+
+        The target then stops applying in every other guild. If guild_id
+        already has the target, its own settings win and the legacy row is
+        just deleted. Returns False if the user had no legacy row.
+        """
         if not self.conn or not self.cursor:
-            print("Cannot update specific reply: No database connection.")
+            log.error("Cannot adopt legacy target: No database connection.")
             return False
         try:
-            self.cursor.execute(
-                "UPDATE targets SET specific_reply = ? WHERE user_id = ?",
-                (json.dumps(specific_replies), user_id)
-            )
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            with self._transaction():
+                if not self._target_exists(LEGACY_GUILD_ID, user_id):
+                    return False
+                self.cursor.execute(
+                    f"INSERT OR IGNORE INTO targets (guild_id, user_id, {TARGET_COLUMNS}) "
+                    f"SELECT ?, user_id, {TARGET_COLUMNS} FROM targets WHERE guild_id = ? AND user_id = ?",
+                    (guild_id, LEGACY_GUILD_ID, user_id)
+                )
+                if self.cursor.rowcount > 0:
+                    for table, column, _, _ in ITEM_TABLES:
+                        self.cursor.execute(
+                            f"INSERT INTO {table} (guild_id, user_id, position, {column}, weight) "
+                            f"SELECT ?, user_id, position, {column}, weight FROM {table} WHERE guild_id = ? AND user_id = ?",
+                            (guild_id, LEGACY_GUILD_ID, user_id)
+                        )
+                self.cursor.execute("DELETE FROM targets WHERE guild_id = ? AND user_id = ?", (LEGACY_GUILD_ID, user_id))
+            log.info("Moved legacy target %s into guild %s", user_id, guild_id)
+            return True
         except sqlite3.Error as e:
-            print(f"Error updating specific reply: {e}")
+            log.error("Error adopting legacy target: %s", e)
             return False
 
-    def update_specific_reaction(self, user_id: int, specific_reactions: List[str]) -> bool:
-        """Updates the specific emoji reactions for a target user."""
+    def update_specific_reply(
+        self, guild_id: int, user_id: int, specific_replies: List[str], weights: Optional[List[float]] = None
+    ) -> bool:
+        """Replaces the specific text replies for a target user. Weights default to 1."""
         if not self.conn or not self.cursor:
-            print("Cannot update specific reaction: No database connection.")
+            log.error("Cannot update specific reply: No database connection.")
             return False
         try:
-            self.cursor.execute(
-                "UPDATE targets SET specific_reaction = ? WHERE user_id = ?",
-                (json.dumps(specific_reactions), user_id)
-            )
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            with self._transaction():
+                if not self._target_exists(guild_id, user_id):
+                    return False
+                self._replace_items('target_replies', 'content', guild_id, user_id, specific_replies, weights)
+            return True
+        except sqlite3.Error as e:
+            log.error("Error updating specific reply: %s", e)
+            return False
+
+    def update_specific_reaction(
+        self, guild_id: int, user_id: int, specific_reactions: List[str], weights: Optional[List[float]] = None
+    ) -> bool:
+        """Replaces the specific emoji reactions for a target user. Weights default to 1."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot update specific reaction: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                if not self._target_exists(guild_id, user_id):
+                    return False
+                self._replace_items('target_reactions', 'emoji', guild_id, user_id, specific_reactions, weights)
+            return True
         except sqlite3.Error as e:
-            print(f"Error updating specific reaction: {e}")
+            log.error("Error updating specific reaction: %s", e)
             return False
 
-    def update_annoy_methods(self, user_id: int, methods: List[str]) -> bool:
+    def _append_item(self, table: str, column: str, guild_id: int, user_id: int, item: str, weight: float = 1.0) -> bool:
+        if not self.conn or not self.cursor:
+            log.error("Cannot add to %s: No database connection.", table)
+            return False
+        try:
+            with self._transaction():
+                if not self._target_exists(guild_id, user_id):
+                    return False
+                # MAX(position) is answered from the primary key index
+                self.cursor.execute(
+                    f"INSERT INTO {table} (guild_id, user_id, position, {column}, weight) "
+                    f"SELECT ?, ?, COALESCE(MAX(position) + 1, 0), ?, ? FROM {table} WHERE guild_id = ? AND user_id = ?",
+                    (guild_id, user_id, item, weight, guild_id, user_id)
+                )
+            return True
+        except sqlite3.Error as e:
+            log.error("Error adding to %s: %s", table, e)
+            return False
+
+    def _delete_item(self, table: str, column: str, guild_id: int, user_id: int, item: str) -> bool:
+        if not self.conn or not self.cursor:
+            log.error("Cannot remove from %s: No database connection.", table)
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    f"DELETE FROM {table} WHERE guild_id = ? AND user_id = ? AND {column} = ?",
+                    (guild_id, user_id, item)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error removing from %s: %s", table, e)
+            return False
+
+    def _set_item_weight(self, table: str, column: str, guild_id: int, user_id: int, item: str, weight: float) -> bool:
+        if not self.conn or not self.cursor:
+            log.error("Cannot update weights in %s: No database connection.", table)
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    f"UPDATE {table} SET weight = ? WHERE guild_id = ? AND user_id = ? AND {column} = ?",
+                    (weight, guild_id, user_id, item)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error updating weights in %s: %s", table, e)
+            return False
+
+    def add_specific_reply(self, guild_id: int, user_id: int, reply: str, weight: float = 1.0) -> bool:
+        """Appends one specific reply without touching the target's other replies."""
+        return self._append_item('target_replies', 'content', guild_id, user_id, reply, weight)
+
+    def remove_specific_reply(self, guild_id: int, user_id: int, reply: str) -> bool:
+        """Removes every copy of one specific reply. Returns False if there was none."""
+        return self._delete_item('target_replies', 'content', guild_id, user_id, reply)
+
+    def add_specific_reaction(self, guild_id: int, user_id: int, emoji: str, weight: float = 1.0) -> bool:
+        """Appends one specific reaction without touching the target's other reactions."""
+        return self._append_item('target_reactions', 'emoji', guild_id, user_id, emoji, weight)
+
+    def remove_specific_reaction(self, guild_id: int, user_id: int, emoji: str) -> bool:
+        """Removes every copy of one specific reaction. Returns False if there was none."""
+        return self._delete_item('target_reactions', 'emoji', guild_id, user_id, emoji)
+
+    def set_reply_weight(self, guild_id: int, user_id: int, reply: str, weight: float) -> bool:
+        """Sets the weight of every copy of one specific reply. Returns False if there was none."""
+        return self._set_item_weight('target_replies', 'content', guild_id, user_id, reply, weight)
+
+    def set_reaction_weight(self, guild_id: int, user_id: int, emoji: str, weight: float) -> bool:
+        """Sets the weight of every copy of one specific reaction. Returns False if there was none."""
+        return self._set_item_weight('target_reactions', 'emoji', guild_id, user_id, emoji, weight)
+
+    def update_selection_mode(self, guild_id: int, user_id: int, mode: str) -> bool:
+        """Updates how replies and reactions are picked ('weighted' or 'shuffle')."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot update selection mode: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "UPDATE targets SET selection_mode = ? WHERE guild_id = ? AND user_id = ?",
+                    (mode, guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error updating selection mode: %s", e)
+            return False
+
+    def update_burst_size(self, guild_id: int, user_id: int, burst_size: int) -> bool:
+        """Updates how many actions one triggering message gets (1 = a single reply or reaction)."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot update burst size: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "UPDATE targets SET burst_size = ? WHERE guild_id = ? AND user_id = ?",
+                    (burst_size, guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error updating burst size: %s", e)
+            return False
+
+    def update_annoy_methods(self, guild_id: int, user_id: int, methods: List[str]) -> bool:
         """Updates the annoyance methods for a target user."""
         if not self.conn or not self.cursor:
-            print("Cannot update annoy methods: No database connection.")
+            log.error("Cannot update annoy methods: No database connection.")
             return False
         try:
-            methods_str = ','.join(methods)
-            self.cursor.execute(
-                "UPDATE targets SET annoy_methods = ? WHERE user_id = ?",
-                (methods_str, user_id)
-            )
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            with self._transaction():
+                self.cursor.execute(
+                    "UPDATE targets SET method_flags = ? WHERE guild_id = ? AND user_id = ?",
+                    (methods_to_flags(methods), guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
         except sqlite3.Error as e:
-            print(f"Error updating annoy methods: {e}")
+            log.error("Error updating annoy methods: %s", e)
             return False
 
-    def update_message_mode(self, user_id: int, mode: str) -> bool:
+    def update_message_mode(self, guild_id: int, user_id: int, mode: str) -> bool:
         """Updates the message mode for a target user ('specific_only', 'random_only', 'both')."""
         if not self.conn or not self.cursor:
-            print("Cannot update message mode: No database connection.")
+            log.error("Cannot update message mode: No database connection.")
             return False
         try:
-            self.cursor.execute(
-                "UPDATE targets SET message_mode = ? WHERE user_id = ?",
-                (mode, user_id)
-            )
-            self.conn.commit()
-            return self.cursor.rowcount > 0
+            with self._transaction():
+                self.cursor.execute(
+                    "UPDATE targets SET message_mode = ? WHERE guild_id = ? AND user_id = ?",
+                    (mode, guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error updating message mode: %s", e)
+            return False
+
+    def update_trigger_limits(
+        self,
+        guild_id: int,
+        user_id: int,
+        cooldown_seconds: float,
+        trigger_probability: float,
+        max_actions: int,
+        action_window_seconds: float
+    ) -> bool:
+        """Updates how often a target's messages are allowed to trigger an annoyance."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot update trigger limits: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "UPDATE targets SET cooldown_seconds = ?, trigger_probability = ?, max_actions = ?, "
+                    "action_window_seconds = ? WHERE guild_id = ? AND user_id = ?",
+                    (cooldown_seconds, trigger_probability, max_actions, action_window_seconds, guild_id, user_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
         except sqlite3.Error as e:
-            print(f"Error updating message mode: {e}")
+            log.error("Error updating trigger limits: %s", e)
             return False
 
-    def get_target_settings(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Fetches all settings for a specific target user."""
+    def bulk_upsert(self, guild_id: int, targets: List[Dict[str, Any]]) -> int:
+        """Inserts or replaces many targets of one guild in a single transaction.
+
+        Each entry is a full settings dict plus "user_id". Returns the number of
+        targets written, or -1 if the transaction was rolled back.
+        """
         if not self.conn or not self.cursor:
-            print("Cannot get target settings: No database connection.")
+            log.error("Cannot bulk upsert targets: No database connection.")
+            return -1
+        target_rows, keys, reply_rows, reaction_rows = [], [], [], []
+        for target in targets:
+            user_id = target["user_id"]
+            keys.append((guild_id, user_id))
+            target_rows.append((
+                guild_id,
+                user_id,
+                target.get("message_mode") or 'both',
+                methods_to_flags(target.get("annoy_methods") or ['message', 'reaction']),
+                target.get("cooldown_seconds", 0),
+                target.get("trigger_probability", 1),
+                target.get("max_actions", 0),
+                target.get("action_window_seconds", 60),
+                target.get("selection_mode") or 'weighted',
+                target.get("burst_size") or 1,
+            ))
+            reply_rows.extend(_item_rows(guild_id, user_id, target.get("specific_reply") or [], target.get("reply_weights")))
+            reaction_rows.extend(_item_rows(guild_id, user_id, target.get("specific_reaction") or [], target.get("reaction_weights")))
+        try:
+            with self._transaction():
+                self.cursor.executemany(
+                    f"INSERT INTO targets (guild_id, user_id, {TARGET_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (guild_id, user_id) DO UPDATE SET "
+                    "message_mode = excluded.message_mode, method_flags = excluded.method_flags, "
+                    "cooldown_seconds = excluded.cooldown_seconds, trigger_probability = excluded.trigger_probability, "
+                    "max_actions = excluded.max_actions, action_window_seconds = excluded.action_window_seconds, "
+                    "selection_mode = excluded.selection_mode, burst_size = excluded.burst_size",
+                    target_rows
+                )
+                for table, column, rows in (('target_replies', 'content', reply_rows), ('target_reactions', 'emoji', reaction_rows)):
+                    self.cursor.executemany(f"DELETE FROM {table} WHERE guild_id = ? AND user_id = ?", keys)
+                    self.cursor.executemany(
+                        f"INSERT INTO {table} (guild_id, user_id, position, {column}, weight) VALUES (?, ?, ?, ?, ?)", rows
+                    )
+            log.info("Bulk upserted %s target(s) in guild %s", len(target_rows), guild_id)
+            return len(target_rows)
+        except sqlite3.Error as e:
+            log.error("Error bulk upserting targets: %s", e)
+            return -1
+
+    def get_target_settings(self, guild_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        """Fetches all settings for a specific target user in a guild."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot get target settings: No database connection.")
             return None
         try:
             self.cursor.execute(
-                "SELECT user_id, specific_reply, specific_reaction, annoy_methods, message_mode FROM targets WHERE user_id = ?",
-                (user_id,)
+                f"SELECT {TARGET_COLUMNS} FROM targets WHERE guild_id = ? AND user_id = ?",
+                (guild_id, user_id)
             )
             row = self.cursor.fetchone()
-            if row:
-                methods_list = row[3].split(',') if row[3] else []
-                specific_replies = json.loads(row[1]) if row[1] else []
-                specific_reactions = json.loads(row[2]) if row[2] else []
-                return {
-                    "user_id": row[0],
-                    "specific_reply": specific_replies, # Now a list
-                    "specific_reaction": specific_reactions, # Now a list
-                    "annoy_methods": methods_list,
-                    "message_mode": row[4]
-                }
+            if not row:
+                return None
+            settings = {"guild_id": guild_id, "user_id": user_id, **_row_to_settings(row)}
+            for table, column, key, weight_key in ITEM_TABLES:
+                self.cursor.execute(
+                    f"SELECT {column}, weight FROM {table} WHERE guild_id = ? AND user_id = ? ORDER BY position",
+                    (guild_id, user_id)
+                )
+                for item, weight in self.cursor.fetchall():
+                    settings[key].append(item)
+                    settings[weight_key].append(weight)
+            return settings
+        except sqlite3.Error as e:
+            log.error("Error fetching target settings: %s", e)
             return None
-        except (sqlite3.Error, JSONDecodeError) as e:
-            print(f"Error fetching target settings: {e}")
+
+    def get_all_targets(self, guild_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[int, Dict[str, Any]]]:
+        """Fetches target users and their detailed settings, partitioned by guild.
+
+        Returns {guild_id: {user_id: settings}}. When guild_ids is given only
+        those guilds are read, which lets each shard load just its own rows.
+        """
+        if not self.conn or not self.cursor:
+            log.error("Cannot get all targets: No database connection.")
+            return {}
+        if guild_ids is not None:
+            guild_ids = list(guild_ids)
+            if not guild_ids:
+                return {}
+        where, params = _guild_filter(guild_ids)
+        try:
+            all_targets_settings: Dict[int, Dict[int, Dict[str, Any]]] = {}
+            self.cursor.execute(f"SELECT guild_id, user_id, {TARGET_COLUMNS} FROM targets{where}", params)
+            for row in self.cursor.fetchall():
+                all_targets_settings.setdefault(row[0], {})[row[1]] = _row_to_settings(row[2:])
+
+            for table, column, key, weight_key in ITEM_TABLES:
+                self.cursor.execute(
+                    f"SELECT guild_id, user_id, {column}, weight FROM {table}{where} ORDER BY guild_id, user_id, position", params
+                )
+                for guild_id, user_id, item, weight in self.cursor.fetchall():
+                    settings = all_targets_settings[guild_id][user_id]
+                    settings[key].append(item)
+                    settings[weight_key].append(weight)
+            return all_targets_settings
+        except sqlite3.Error as e:
+            log.error("Error fetching all targets: %s", e)
+            return {}
+
+    def data_version(self) -> int:
+        """SQLite's PRAGMA data_version: changes whenever another connection commits."""
+        return self.cursor.execute("PRAGMA data_version").fetchone()[0]
+
+    def latest_change_seq(self) -> int:
+        """The newest target_changes sequence number, or 0 if the log is empty."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot read the change log: No database connection.")
+            return 0
+        try:
+            self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'target_changes'")
+            row = self.cursor.fetchone()
+            return row[0] if row else 0
+        except sqlite3.Error as e:
+            log.error("Error reading the change log: %s", e)
+            return 0
+
+    def get_changed_targets(self, since_seq: int) -> Optional[Tuple[int, Dict[Tuple[int, int], Optional[Dict[str, Any]]]]]:
+        """Current settings of every target changed after since_seq.
+
+        Returns (latest seq, {(guild_id, user_id): settings}), where settings is
+        None for targets that no longer exist. Returns None if the log has been
+        pruned past since_seq, in which case the caller has to reload in full.
+        """
+        if not self.conn or not self.cursor:
+            log.error("Cannot read the change log: No database connection.")
+            return since_seq, {}
+        try:
+            # One read transaction, so every query sees the same snapshot
+            self.cursor.execute("BEGIN")
+            try:
+                self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'target_changes'")
+                row = self.cursor.fetchone()
+                latest = row[0] if row else 0
+                if latest <= since_seq:
+                    return latest, {}
+                oldest = self.cursor.execute("SELECT MIN(seq) FROM target_changes").fetchone()[0]
+                if oldest is None or oldest > since_seq + 1:
+                    return None
+
+                changed = (
+                    "SELECT DISTINCT guild_id, user_id FROM target_changes WHERE seq > ? AND seq <= ?"
+                )
+                params = (since_seq, latest)
+                self.cursor.execute(changed, params)
+                targets: Dict[Tuple[int, int], Optional[Dict[str, Any]]] = dict.fromkeys(
+                    (guild_id, user_id) for guild_id, user_id in self.cursor.fetchall()
+                )
+                self.cursor.execute(
+                    f"SELECT guild_id, user_id, {TARGET_COLUMNS} FROM targets JOIN ({changed}) USING (guild_id, user_id)",
+                    params
+                )
+                for row in self.cursor.fetchall():
+                    targets[(row[0], row[1])] = _row_to_settings(row[2:])
+                for table, column, key, weight_key in ITEM_TABLES:
+                    self.cursor.execute(
+                        f"SELECT guild_id, user_id, {column}, weight FROM {table} JOIN ({changed}) USING (guild_id, user_id) "
+                        "ORDER BY guild_id, user_id, position",
+                        params
+                    )
+                    for guild_id, user_id, item, weight in self.cursor.fetchall():
+                        settings = targets[(guild_id, user_id)]
+                        settings[key].append(item)
+                        settings[weight_key].append(weight)
+                return latest, targets
+            finally:
+                self.conn.rollback()
+        except sqlite3.Error as e:
+            log.error("Error reading changed targets: %s", e)
+            return since_seq, {}
+
+    def prune_changes(self, max_age_seconds: float) -> int:
+        """Deletes change-log rows older than max_age_seconds. Returns how many were deleted."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot prune the change log: No database connection.")
+            return 0
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "DELETE FROM target_changes WHERE changed_at < (julianday('now') - 2440587.5) * 86400.0 - ?",
+                    (max_age_seconds,)
+                )
+                return self.cursor.rowcount
+        except sqlite3.Error as e:
+            log.error("Error pruning the change log: %s", e)
+            return 0
+
+    def get_state(self, key: str) -> Optional[str]:
+        """Reads a value from the bot_state table."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot read bot state: No database connection.")
             return None
+        try:
+            self.cursor.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+            row = self.cursor.fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            log.error("Error reading bot state %s: %s", key, e)
+            return None
+
+    def set_state(self, key: str, value: str) -> bool:
+        """Writes a value to the bot_state table."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot write bot state: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                    (key, value)
+                )
+            return True
+        except sqlite3.Error as e:
+            log.error("Error writing bot state %s: %s", key, e)
+            return False
+
+    def add_trigger_rule(
+        self, guild_id: int, user_id: Optional[int], pattern: str, is_regex: bool, action: str, payload: str
+    ) -> Optional[int]:
+        """Adds a content rule. Returns its id, or None on error."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot add trigger rule: No database connection.")
+            return None
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "INSERT INTO trigger_rules (guild_id, user_id, pattern, is_regex, action, payload) VALUES (?, ?, ?, ?, ?, ?)",
+                    (guild_id, user_id, pattern, int(is_regex), action, payload)
+                )
+                rule_id = self.cursor.lastrowid
+            return rule_id
+        except sqlite3.Error as e:
+            log.error("Error adding trigger rule: %s", e)
+            return None
+
+    def remove_trigger_rule(self, guild_id: int, rule_id: int) -> bool:
+        """Removes one of a guild's content rules. Returns False if it didn't exist."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot remove trigger rule: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute("DELETE FROM trigger_rules WHERE guild_id = ? AND id = ?", (guild_id, rule_id))
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error removing trigger rule: %s", e)
+            return False
 
-    def get_all_targets(self) -> Dict[int, Dict[str, Any]]:
-        """Fetches all target users and their detailed settings."""
+    def get_trigger_rules(self, guild_ids: Optional[Sequence[int]] = None) -> Dict[int, List[Dict[str, Any]]]:
+        """Fetches content rules as guild_id -> [rule dict], optionally only for some guilds."""
         if not self.conn or not self.cursor:
-            print("Cannot get all targets: No database connection.")
+            log.error("Cannot get trigger rules: No database connection.")
             return {}
+        where, params = _guild_filter(guild_ids)
         try:
             self.cursor.execute(
-                "SELECT user_id, specific_reply, specific_reaction, annoy_methods, message_mode FROM targets"
+                f"SELECT id, guild_id, user_id, pattern, is_regex, action, payload FROM trigger_rules{where} ORDER BY id",
+                params
             )
-            rows = self.cursor.fetchall()
-            all_targets_settings: Dict[int, Dict[str, Any]] = {}
-            for row in rows:
-                methods_list = row[3].split(',') if row[3] else []
-                specific_replies = json.loads(row[1]) if row[1] else []
-                specific_reactions = json.loads(row[2]) if row[2] else []
-                all_targets_settings[row[0]] = {
-                    "specific_reply": specific_replies, # Now a list
-                    "specific_reaction": specific_reactions, # Now a list
-                    "annoy_methods": methods_list,
-                    "message_mode": row[4]
-                }
-            return all_targets_settings
-        except (sqlite3.Error, JSONDecodeError) as e:
-            print(f"Error fetching all targets: {e}")
+            rules: Dict[int, List[Dict[str, Any]]] = {}
+            for rule_id, guild_id, user_id, pattern, is_regex, action, payload in self.cursor.fetchall():
+                rules.setdefault(guild_id, []).append({
+                    "id": rule_id, "user_id": user_id, "pattern": pattern,
+                    "is_regex": bool(is_regex), "action": action, "payload": payload,
+                })
+            return rules
+        except sqlite3.Error as e:
+            log.error("Error fetching trigger rules: %s", e)
             return {}
 
+    def add_schedule(
+        self, guild_id: int, channel_id: int, user_id: int, message: str, interval_seconds: Optional[float], next_run: float
+    ) -> Optional[int]:
+        """Adds a scheduled annoyance for an existing target. Returns its id, or None on error."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot add schedule: No database connection.")
+            return None
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "INSERT INTO scheduled_annoyances (guild_id, channel_id, user_id, message, interval_seconds, next_run) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (guild_id, channel_id, user_id, message, interval_seconds, next_run)
+                )
+                schedule_id = self.cursor.lastrowid
+            return schedule_id
+        except sqlite3.Error as e:
+            log.error("Error adding schedule: %s", e)
+            return None
+
+    def remove_schedule(self, guild_id: int, schedule_id: int) -> bool:
+        """Removes one of a guild's pending scheduled annoyances. Returns False if it didn't exist."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot remove schedule: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "DELETE FROM scheduled_annoyances WHERE guild_id = ? AND id = ? AND next_run IS NOT NULL",
+                    (guild_id, schedule_id)
+                )
+                changed = self.cursor.rowcount
+            return changed > 0
+        except sqlite3.Error as e:
+            log.error("Error removing schedule: %s", e)
+            return False
+
+    def get_schedules(self, guild_id: int) -> List[Dict[str, Any]]:
+        """A guild's pending scheduled annoyances, soonest first."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot get schedules: No database connection.")
+            return []
+        try:
+            self.cursor.execute(
+                "SELECT id, channel_id, user_id, message, interval_seconds, next_run FROM scheduled_annoyances "
+                "WHERE guild_id = ? AND next_run IS NOT NULL ORDER BY next_run, id",
+                (guild_id,)
+            )
+            return [
+                {"id": schedule_id, "channel_id": channel_id, "user_id": user_id, "message": message,
+                 "interval_seconds": interval_seconds, "next_run": next_run}
+                for schedule_id, channel_id, user_id, message, interval_seconds, next_run in self.cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            log.error("Error fetching schedules: %s", e)
+            return []
+
+    def count_schedules(self, guild_id: int) -> int:
+        """How many pending scheduled annoyances a guild has."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot count schedules: No database connection.")
+            return 0
+        try:
+            self.cursor.execute(
+                "SELECT COUNT(*) FROM scheduled_annoyances WHERE guild_id = ? AND next_run IS NOT NULL", (guild_id,)
+            )
+            return self.cursor.fetchone()[0]
+        except sqlite3.Error as e:
+            log.error("Error counting schedules: %s", e)
+            return 0
+
+    def get_due_schedules(
+        self, after: Tuple[float, int], until: float, guild_ids: Optional[Sequence[int]] = None, limit: int = 1000
+    ) -> List[tuple]:
+        """Pending schedules past the (next_run, id) position `after` and due by `until`, in that order.
+
+        Returns (id, guild_id, channel_id, user_id, message, interval_seconds,
+        next_run) rows. Walks the next_run index, so the cost depends on the
+        rows returned, not on how many schedules exist.
+        """
+        if not self.conn or not self.cursor:
+            log.error("Cannot get due schedules: No database connection.")
+            return []
+        if guild_ids is not None and not guild_ids:
+            return []
+        after_run, after_id = after
+        where = ""
+        params: List[Any] = [after_run, until, after_run, after_id]
+        if guild_ids is not None:
+            # The unary + keeps the planner on the next_run index
+            where = f" AND +guild_id IN ({','.join('?' * len(guild_ids))})"
+            params.extend(guild_ids)
+        params.append(limit)
+        try:
+            self.cursor.execute(
+                "SELECT id, guild_id, channel_id, user_id, message, interval_seconds, next_run FROM scheduled_annoyances "
+                f"WHERE next_run >= ? AND next_run <= ? AND NOT (next_run = ? AND id <= ?){where} "
+                "ORDER BY next_run, id LIMIT ?",
+                params
+            )
+            return self.cursor.fetchall()
+        except sqlite3.Error as e:
+            log.error("Error fetching due schedules: %s", e)
+            return []
+
+    def reschedule(self, runs: List[Tuple[Optional[float], int]]) -> bool:
+        """Sets next_run for (next_run, id) pairs in one transaction; None marks a one-off as done."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot reschedule: No database connection.")
+            return False
+        try:
+            with self._transaction():
+                self.cursor.executemany("UPDATE scheduled_annoyances SET next_run = ? WHERE id = ?", runs)
+            return True
+        except sqlite3.Error as e:
+            log.error("Error rescheduling %s schedule(s): %s", len(runs), e)
+            return False
+
+    def purge_finished_schedules(self) -> int:
+        """Deletes one-offs that have already run. Returns how many were deleted."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot purge schedules: No database connection.")
+            return 0
+        try:
+            with self._transaction():
+                self.cursor.execute("DELETE FROM scheduled_annoyances WHERE next_run IS NULL")
+                return self.cursor.rowcount
+        except sqlite3.Error as e:
+            log.error("Error purging finished schedules: %s", e)
+            return 0
+
+    def append_events(self, events: List[tuple]) -> bool:
+        """Appends (created_at, guild, channel, user, method, item, latency, outcome) rows and updates the rollups."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot append events: No database connection.")
+            return False
+        # Fold the batch into one rollup row per hour/target/method/outcome first
+        rollups: Dict[tuple, List[float]] = {}
+        for created_at, guild_id, _, user_id, method, _, latency, outcome in events:
+            key = (guild_id, int(created_at // 3600), user_id, method, outcome)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = [1, latency, latency]
+            else:
+                rollup[0] += 1
+                rollup[1] += latency
+                rollup[2] = max(rollup[2], latency)
+        try:
+            with self._transaction():
+                self.cursor.executemany(
+                    "INSERT INTO annoyance_events "
+                    "(created_at, guild_id, channel_id, user_id, method, item, latency, outcome) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    events
+                )
+                self.cursor.executemany(
+                    "INSERT INTO annoyance_rollups "
+                    "(guild_id, hour, user_id, method, outcome, count, latency_sum, latency_max) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (guild_id, hour, user_id, method, outcome) DO UPDATE SET "
+                    "count = count + excluded.count, latency_sum = latency_sum + excluded.latency_sum, "
+                    "latency_max = MAX(latency_max, excluded.latency_max)",
+                    [key + tuple(rollup) for key, rollup in rollups.items()]
+                )
+            return True
+        except sqlite3.Error as e:
+            log.error("Error appending %s event(s): %s", len(events), e)
+            return False
+
+    def compact_events(self, event_retention_seconds: float, rollup_retention_seconds: float) -> Tuple[int, int]:
+        """Deletes raw events and hourly rollups past their retention. Returns (events, rollups) deleted."""
+        if not self.conn or not self.cursor:
+            log.error("Cannot compact events: No database connection.")
+            return 0, 0
+        now = time.time()
+        try:
+            with self._transaction():
+                self.cursor.execute(
+                    "DELETE FROM annoyance_events WHERE created_at < ?", (now - event_retention_seconds,)
+                )
+                events = self.cursor.rowcount
+                self.cursor.execute(
+                    "DELETE FROM annoyance_rollups WHERE hour < ?", (int((now - rollup_retention_seconds) // 3600),)
+                )
+                rollups = self.cursor.rowcount
+            return events, rollups
+        except sqlite3.Error as e:
+            log.error("Error compacting events: %s", e)
+            return 0, 0
+
+    def get_event_stats(
+        self, guild_id: int, since_hour: int, user_id: Optional[int] = None, top: int = 5
+    ) -> Optional[Dict[str, Any]]:
+        """Summarizes a guild's rollups from since_hour on, optionally for one target.
+
+        Returns {"outcomes": [(method, outcome, count, latency_sum, latency_max)],
+        "top_targets": [(user_id, sent count)]}.
+        """
+        if not self.conn or not self.cursor:
+            log.error("Cannot read event stats: No database connection.")
+            return None
+        where = "guild_id = ? AND hour >= ?"
+        params: List[Any] = [guild_id, since_hour]
+        if user_id is not None:
+            where += " AND user_id = ?"
+            params.append(user_id)
+        try:
+            self.cursor.execute(
+                "SELECT method, outcome, SUM(count), SUM(latency_sum), MAX(latency_max) "
+                f"FROM annoyance_rollups WHERE {where} GROUP BY method, outcome ORDER BY method, outcome",
+                params
+            )
+            outcomes = self.cursor.fetchall()
+            self.cursor.execute(
+                f"SELECT user_id, SUM(count) AS sent FROM annoyance_rollups WHERE {where} AND outcome = 'sent' "
+                "GROUP BY user_id ORDER BY sent DESC LIMIT ?",
+                params + [top]
+            )
+            return {"outcomes": outcomes, "top_targets": self.cursor.fetchall()}
+        except sqlite3.Error as e:
+            log.error("Error reading event stats: %s", e)
+            return None
+
+    # Maintenance. Unlike the methods above these raise sqlite3.Error, so the
+    # maintenance runner can report what went wrong.
+
+    def page_stats(self) -> Dict[str, int]:
+        """Page size, page count, free pages and auto_vacuum mode (0 none, 1 full, 2 incremental)."""
+        return {
+            pragma: self.cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum')
+        }
+
+    def backup_to(
+        self, path: str, pages: int = 256, pause: float = 0.0, progress: Optional[Callable[[int, int], None]] = None
+    ) -> int:
+        """Copies the database to path with the online backup API, `pages` pages per step.
+
+        One read transaction is held for the whole copy, so the backup is a
+        consistent snapshot and commits from other connections, which WAL
+        lets through meanwhile, don't make it start over. progress(remaining,
+        total) is called after every step, followed by a `pause` second sleep.
+        Returns the number of pages copied.
+        """
+        total = 0
+
+        def step(status: int, remaining: int, page_count: int):
+            nonlocal total
+            total = page_count
+            if progress is not None:
+                progress(remaining, page_count)
+            if pause and remaining:
+                time.sleep(pause)
+
+        target = sqlite3.connect(path)
+        try:
+            self.cursor.execute("BEGIN")
+            try:
+                # The snapshot is only taken on the first read
+                self.cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                self.conn.backup(target, pages=pages, progress=step)
+            finally:
+                self.conn.rollback()
+        finally:
+            target.close()
+        return total
+
+    def integrity_check(self, quick: bool = True, max_errors: int = 20) -> List[str]:
+        """Runs PRAGMA quick_check (or the slower, index-verifying integrity_check). ['ok'] means no problems."""
+        pragma = 'quick_check' if quick else 'integrity_check'
+        return [row[0] for row in self.cursor.execute(f"PRAGMA {pragma}({int(max_errors)})").fetchall()]
+
+    def optimize(self, analysis_limit: int = 400):
+        """Runs PRAGMA optimize, which re-analyzes only the tables whose statistics look stale.
+
+        analysis_limit caps the rows each ANALYZE looks at, which keeps the
+        write lock short on large tables.
+        """
+        self.cursor.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        self.cursor.execute("PRAGMA optimize")
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """Returns up to `pages` free pages to the filesystem. Returns how many free pages are left.
+
+        Only does anything with auto_vacuum = INCREMENTAL, which new databases
+        get; older ones need one vacuum() to switch.
+        """
+        self.cursor.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def vacuum(self):
+        """Rebuilds the whole file and switches it to incremental auto_vacuum. Blocks all writes meanwhile."""
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cursor.execute("VACUUM")
+
     def close(self):
         """Closes the database connection."""
         if self.conn:
             self.conn.close()
-            print("Database connection closed.")
+            log.info("Database connection closed.")
+
+
+class AsyncAnnoyanceDB:
+    """Awaitable front-end for AnnoyanceDB that keeps sqlite off the event loop.
+
+    All writes are serialized on one dedicated writer thread with its own
+    connection. Reads use a second, query-only connection on a separate thread,
+    so they never queue behind a commit. Backups and integrity checks, which
+    can take a while, get a third thread and connection, opened on first use.
+
+    With write_behind enabled, the update_* methods return immediately and are
+    coalesced per (method, target). They are flushed in a single transaction
+    every flush_interval seconds, or once flush_threshold distinct updates are
+    pending. Any other write or read flushes first, so callers always observe
+    their own writes. close() flushes whatever is left.
+
+    If a latency histogram is given, every call is observed in it under the
+    AnnoyanceDB method's name, including the time spent queued for its thread.
+
+    record_event() only appends to an in-memory buffer. The buffer is written
+    in one transaction every event_flush_interval seconds, or once it holds
+    event_flush_threshold events, and close() writes whatever is left.
+    """
+
+    def __init__(
+        self,
+        db_name: str = 'annoy_o_matic.db',
+        write_behind: bool = False,
+        flush_interval: float = 2.0,
+        flush_threshold: int = 500,
+        synchronous: Optional[str] = None,
+        latency: Optional[Histogram] = None,
+        event_flush_interval: float = 5.0,
+        event_flush_threshold: int = 1000
+    ):
+        self.db_name = db_name
+        self.latency = latency
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending: Dict[Tuple[str, int, int], tuple] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.event_flush_interval = event_flush_interval
+        self.event_flush_threshold = event_flush_threshold
+        self._events: List[tuple] = []
+        self._event_flush_handle: Optional[asyncio.TimerHandle] = None
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="annoydb-writer")
+        self._reader_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="annoydb-reader")
+        # sqlite3 connections are bound to the thread that created them, so each
+        # one is opened on the thread that will use it. The writer goes first so
+        # the schema exists before the reader connects.
+        self._writer: AnnoyanceDB = self._writer_executor.submit(AnnoyanceDB, db_name, False, synchronous).result()
+        self._reader: AnnoyanceDB = self._reader_executor.submit(AnnoyanceDB, db_name, True).result()
+        self._maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="annoydb-maintenance")
+        self._maintenance: Optional[AnnoyanceDB] = None
+
+    async def _run(self, executor: ThreadPoolExecutor, func: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.latency is None:
+            return await loop.run_in_executor(executor, functools.partial(func, *args))
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(executor, functools.partial(func, *args))
+        finally:
+            self.latency.observe(time.perf_counter() - started, func.__name__)
+
+    async def _write(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._pending:
+            await self.flush()
+        return await self._run(self._writer_executor, func, *args)
+
+    async def _read(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._pending:
+            await self.flush()
+        return await self._run(self._reader_executor, func, *args)
+
+    async def _update(self, name: str, guild_id: int, user_id: int, *args: Any) -> bool:
+        """Runs an update_* method now, or queues it when write-behind is on."""
+        if not self.write_behind:
+            return await self._write(getattr(self._writer, name), guild_id, user_id, *args)
+        # A newer update to the same field of the same target replaces the queued one
+        self._pending[(name, guild_id, user_id)] = (guild_id, user_id, *args)
+        if len(self._pending) >= self.flush_threshold:
+            await self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+        return True
+
+    def _take_pending(self) -> List[Tuple[str, tuple]]:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        operations = [(name, args) for (name, _, _), args in self._pending.items()]
+        self._pending = {}
+        return operations
+
+    async def flush(self) -> bool:
+        """Writes all queued updates in one transaction."""
+        operations = self._take_pending()
+        if not operations:
+            return True
+        return await self._run(self._writer_executor, self._writer.run_batch, operations)
+
+    def record_event(
+        self, guild_id: int, channel_id: int, user_id: int, method: str, item: str, latency: float, outcome: str
+    ):
+        """Buffers one annoyance event. Never touches the database itself."""
+        self._events.append((time.time(), guild_id, channel_id, user_id, method, item, latency, outcome))
+        loop = asyncio.get_running_loop()
+        if len(self._events) >= self.event_flush_threshold:
+            loop.create_task(self.flush_events())
+        elif self._event_flush_handle is None:
+            self._event_flush_handle = loop.call_later(
+                self.event_flush_interval, lambda: loop.create_task(self.flush_events())
+            )
+
+    @property
+    def buffered_events(self) -> int:
+        return len(self._events)
+
+    def _take_events(self) -> List[tuple]:
+        if self._event_flush_handle is not None:
+            self._event_flush_handle.cancel()
+            self._event_flush_handle = None
+        events, self._events = self._events, []
+        return events
+
+    async def flush_events(self) -> bool:
+        """Writes all buffered events and their rollups in one transaction."""
+        events = self._take_events()
+        if not events:
+            return True
+        return await self._run(self._writer_executor, self._writer.append_events, events)
+
+    async def add_target(self, guild_id: int, user_id: int) -> bool:
+        return await self._write(self._writer.add_target, guild_id, user_id)
+
+    async def remove_target(self, guild_id: int, user_id: int) -> bool:
+        return await self._write(self._writer.remove_target, guild_id, user_id)
+
+    async def adopt_legacy_target(self, guild_id: int, user_id: int) -> bool:
+        return await self._write(self._writer.adopt_legacy_target, guild_id, user_id)
+
+    async def update_specific_reply(
+        self, guild_id: int, user_id: int, specific_replies: List[str], weights: Optional[List[float]] = None
+    ) -> bool:
+        return await self._update('update_specific_reply', guild_id, user_id, specific_replies, weights)
+
+    async def update_specific_reaction(
+        self, guild_id: int, user_id: int, specific_reactions: List[str], weights: Optional[List[float]] = None
+    ) -> bool:
+        return await self._update('update_specific_reaction', guild_id, user_id, specific_reactions, weights)
+
+    async def add_specific_reply(self, guild_id: int, user_id: int, reply: str, weight: float = 1.0) -> bool:
+        return await self._write(self._writer.add_specific_reply, guild_id, user_id, reply, weight)
+
+    async def remove_specific_reply(self, guild_id: int, user_id: int, reply: str) -> bool:
+        return await self._write(self._writer.remove_specific_reply, guild_id, user_id, reply)
+
+    async def add_specific_reaction(self, guild_id: int, user_id: int, emoji: str, weight: float = 1.0) -> bool:
+        return await self._write(self._writer.add_specific_reaction, guild_id, user_id, emoji, weight)
+
+    async def remove_specific_reaction(self, guild_id: int, user_id: int, emoji: str) -> bool:
+        return await self._write(self._writer.remove_specific_reaction, guild_id, user_id, emoji)
+
+    async def set_reply_weight(self, guild_id: int, user_id: int, reply: str, weight: float) -> bool:
+        return await self._write(self._writer.set_reply_weight, guild_id, user_id, reply, weight)
+
+    async def set_reaction_weight(self, guild_id: int, user_id: int, emoji: str, weight: float) -> bool:
+        return await self._write(self._writer.set_reaction_weight, guild_id, user_id, emoji, weight)
+
+    async def update_selection_mode(self, guild_id: int, user_id: int, mode: str) -> bool:
+        return await self._update('update_selection_mode', guild_id, user_id, mode)
+
+    async def update_burst_size(self, guild_id: int, user_id: int, burst_size: int) -> bool:
+        return await self._update('update_burst_size', guild_id, user_id, burst_size)
+
+    async def update_annoy_methods(self, guild_id: int, user_id: int, methods: List[str]) -> bool:
+        return await self._update('update_annoy_methods', guild_id, user_id, methods)
+
+    async def update_message_mode(self, guild_id: int, user_id: int, mode: str) -> bool:
+        return await self._update('update_message_mode', guild_id, user_id, mode)
+
+    async def update_trigger_limits(
+        self,
+        guild_id: int,
+        user_id: int,
+        cooldown_seconds: float,
+        trigger_probability: float,
+        max_actions: int,
+        action_window_seconds: float
+    ) -> bool:
+        return await self._update(
+            'update_trigger_limits',
+            guild_id, user_id, cooldown_seconds, trigger_probability, max_actions, action_window_seconds
+        )
+
+    async def bulk_upsert(self, guild_id: int, targets: List[Dict[str, Any]]) -> int:
+        return await self._write(self._writer.bulk_upsert, guild_id, targets)
+
+    async def get_target_settings(self, guild_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._read(self._reader.get_target_settings, guild_id, user_id)
+
+    async def get_all_targets(self, guild_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[int, Dict[str, Any]]]:
+        if guild_ids is not None:
+            # Materialize before handing off to the reader thread
+            guild_ids = list(guild_ids)
+        return await self._read(self._reader.get_all_targets, guild_ids)
+
+    async def data_version(self) -> int:
+        # Deliberately doesn't flush: polling this must not defeat write-behind batching
+        return await self._run(self._reader_executor, self._reader.data_version)
+
+    async def latest_change_seq(self) -> int:
+        return await self._read(self._reader.latest_change_seq)
+
+    async def get_changed_targets(self, since_seq: int) -> Optional[Tuple[int, Dict[Tuple[int, int], Optional[Dict[str, Any]]]]]:
+        return await self._read(self._reader.get_changed_targets, since_seq)
+
+    async def prune_changes(self, max_age_seconds: float) -> int:
+        return await self._write(self._writer.prune_changes, max_age_seconds)
+
+    async def get_state(self, key: str) -> Optional[str]:
+        return await self._read(self._reader.get_state, key)
+
+    async def set_state(self, key: str, value: str) -> bool:
+        return await self._write(self._writer.set_state, key, value)
+
+    async def add_trigger_rule(
+        self, guild_id: int, user_id: Optional[int], pattern: str, is_regex: bool, action: str, payload: str
+    ) -> Optional[int]:
+        return await self._write(self._writer.add_trigger_rule, guild_id, user_id, pattern, is_regex, action, payload)
+
+    async def remove_trigger_rule(self, guild_id: int, rule_id: int) -> bool:
+        return await self._write(self._writer.remove_trigger_rule, guild_id, rule_id)
+
+    async def get_trigger_rules(self, guild_ids: Optional[Iterable[int]] = None) -> Dict[int, List[Dict[str, Any]]]:
+        if guild_ids is not None:
+            guild_ids = list(guild_ids)
+        return await self._read(self._reader.get_trigger_rules, guild_ids)
+
+    async def add_schedule(
+        self, guild_id: int, channel_id: int, user_id: int, message: str, interval_seconds: Optional[float], next_run: float
+    ) -> Optional[int]:
+        return await self._write(
+            self._writer.add_schedule, guild_id, channel_id, user_id, message, interval_seconds, next_run
+        )
+
+    async def remove_schedule(self, guild_id: int, schedule_id: int) -> bool:
+        return await self._write(self._writer.remove_schedule, guild_id, schedule_id)
+
+    async def get_schedules(self, guild_id: int) -> List[Dict[str, Any]]:
+        return await self._read(self._reader.get_schedules, guild_id)
+
+    async def count_schedules(self, guild_id: int) -> int:
+        return await self._read(self._reader.count_schedules, guild_id)
+
+    async def get_due_schedules(
+        self, after: Tuple[float, int], until: float, guild_ids: Optional[Iterable[int]] = None, limit: int = 1000
+    ) -> List[tuple]:
+        if guild_ids is not None:
+            guild_ids = list(guild_ids)
+        return await self._read(self._reader.get_due_schedules, after, until, guild_ids, limit)
+
+    async def reschedule(self, runs: List[Tuple[Optional[float], int]]) -> bool:
+        return await self._write(self._writer.reschedule, runs)
+
+    async def purge_finished_schedules(self) -> int:
+        return await self._write(self._writer.purge_finished_schedules)
+
+    async def compact_events(self, event_retention_seconds: float, rollup_retention_seconds: float) -> Tuple[int, int]:
+        return await self._write(self._writer.compact_events, event_retention_seconds, rollup_retention_seconds)
+
+    async def get_event_stats(
+        self, guild_id: int, since_hour: int, user_id: Optional[int] = None, top: int = 5
+    ) -> Optional[Dict[str, Any]]:
+        # Buffered events go to the same writer first, so they show up in the answer
+        await self.flush_events()
+        return await self._read(self._reader.get_event_stats, guild_id, since_hour, user_id, top)
+
+    async def _maintain(self, name: str, *args: Any) -> Any:
+        if self._maintenance is None:
+            # Opened on the maintenance thread, which the connection is then bound to
+            self._maintenance = await asyncio.get_running_loop().run_in_executor(
+                self._maintenance_executor, AnnoyanceDB, self.db_name, True
+            )
+        return await self._run(self._maintenance_executor, getattr(self._maintenance, name), *args)
+
+    async def page_stats(self) -> Dict[str, int]:
+        return await self._read(self._reader.page_stats)
+
+    async def backup_to(
+        self, path: str, pages: int = 256, pause: float = 0.0, progress: Optional[Callable[[int, int], None]] = None
+    ) -> int:
+        """Runs AnnoyanceDB.backup_to on the maintenance thread; progress is called from that thread."""
+        return await self._maintain('backup_to', path, pages, pause, progress)
+
+    async def integrity_check(self, quick: bool = True, max_errors: int = 20) -> List[str]:
+        return await self._maintain('integrity_check', quick, max_errors)
+
+    async def optimize(self, analysis_limit: int = 400):
+        return await self._write(self._writer.optimize, analysis_limit)
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        return await self._write(self._writer.incremental_vacuum, pages)
+
+    async def vacuum(self):
+        return await self._write(self._writer.vacuum)
+
+    def close(self):
+        """Closes every connection and stops the worker threads.
+
+        Pending writes are allowed to finish first, since the writer executor
+        runs jobs in submission order, and queued write-behind updates and
+        buffered events are flushed before the connection closes.
+        """
+        operations = self._take_pending()
+        if operations:
+            self._writer_executor.submit(self._writer.run_batch, operations).result()
+        events = self._take_events()
+        if events:
+            self._writer_executor.submit(self._writer.append_events, events).result()
+        self._writer_executor.submit(self._writer.close).result()
+        self._reader_executor.submit(self._reader.close).result()
+        if self._maintenance is not None:
+            self._maintenance_executor.submit(self._maintenance.close).result()
+        self._writer_executor.shutdown(wait=True)
+        self._reader_executor.shutdown(wait=True)
+        self._maintenance_executor.shutdown(wait=True)
 
 # Example Usage (for testing the database.py directly)
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
     db = AnnoyanceDB(db_name='test_annoy_o_matic.db') # Use a separate test DB
 
     # Add a target
-    db.add_target(123)
-    db.add_target(456)
+    db.add_target(1, 123)
+    db.add_target(1, 456)
 
     # Set specific replies (now a list)
-    db.update_specific_reply(123, ["Hello there, annoyance!", "Another message!", "You're still here?"])
+    db.update_specific_reply(1, 123, ["Hello there, annoyance!", "Another message!", "You're still here?"])
 
     # Set specific reactions (now a list)
-    db.update_specific_reaction(123, ["👋", "😂", "🙄"])
+    db.update_specific_reaction(1, 123, ["👋", "😂", "🙄"])
 
     # Set annoyance methods
-    db.update_annoy_methods(123, ['message']) # Only messages
-    db.update_annoy_methods(456, ['reaction', 'message']) # Both
+    db.update_annoy_methods(1, 123, ['message']) # Only messages
+    db.update_annoy_methods(1, 456, ['reaction', 'message']) # Both
 
     # Set message mode
-    db.update_message_mode(123, 'specific_only')
-    db.update_message_mode(456, 'random_only')
+    db.update_message_mode(1, 123, 'specific_only')
+    db.update_message_mode(1, 456, 'random_only')
+
+    # At most 3 annoyances per minute, 10s apart, on half of the messages
+    db.update_trigger_limits(1, 456, 10, 0.5, 3, 60)
 
     # Get settings for user 123
-    settings_123 = db.get_target_settings(123)
+    settings_123 = db.get_target_settings(1, 123)
     print("\nSettings for user 123:", settings_123)
 
     # Get all targets
     all_targets = db.get_all_targets()
     print("\nAll targets:", all_targets)
 
+    # Edit one reply without rewriting the others
+    db.add_specific_reply(1, 123, "One more thing...")
+    db.remove_specific_reply(1, 123, "Another message!")
+    print("\nReplies for user 123 after editing:", db.get_target_settings(1, 123)["specific_reply"])
+
     # Clear specific messages/reactions
-    db.update_specific_reply(123, [])
-    db.update_specific_reaction(123, [])
-    settings_123_cleared = db.get_target_settings(123)
+    db.update_specific_reply(1, 123, [])
+    db.update_specific_reaction(1, 123, [])
+    settings_123_cleared = db.get_target_settings(1, 123)
     print("\nSettings for user 123 after clearing:", settings_123_cleared)
 
-    db.remove_target(123)
-    db.remove_target(456)
+    db.remove_target(1, 123)
+    db.remove_target(1, 456)
 
     db.close()
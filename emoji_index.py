@@ -0,0 +1,132 @@
+# emoji_index.py
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+# Extended_Pictographic ranges from the Unicode emoji data (emoji-data.txt).
+# Everything in here can start an emoji; sequences are built on top of it.
+_PICTOGRAPHIC_RANGES = (
+    (0x00A9, 0x00A9), (0x00AE, 0x00AE), (0x203C, 0x203C), (0x2049, 0x2049),
+    (0x2122, 0x2122), (0x2139, 0x2139), (0x2194, 0x2199), (0x21A9, 0x21AA),
+    (0x231A, 0x231B), (0x2328, 0x2328), (0x2388, 0x2388), (0x23CF, 0x23CF),
+    (0x23E9, 0x23F3), (0x23F8, 0x23FA), (0x24C2, 0x24C2), (0x25AA, 0x25AB),
+    (0x25B6, 0x25B6), (0x25C0, 0x25C0), (0x25FB, 0x25FE), (0x2600, 0x2605),
+    (0x2607, 0x2612), (0x2614, 0x2685), (0x2690, 0x2705), (0x2708, 0x2712),
+    (0x2714, 0x2714), (0x2716, 0x2716), (0x271D, 0x271D), (0x2721, 0x2721),
+    (0x2728, 0x2728), (0x2733, 0x2734), (0x2744, 0x2744), (0x2747, 0x2747),
+    (0x274C, 0x274C), (0x274E, 0x274E), (0x2753, 0x2755), (0x2757, 0x2757),
+    (0x2763, 0x2767), (0x2795, 0x2797), (0x27A1, 0x27A1), (0x27B0, 0x27B0),
+    (0x27BF, 0x27BF), (0x2934, 0x2935), (0x2B05, 0x2B07), (0x2B1B, 0x2B1C),
+    (0x2B50, 0x2B50), (0x2B55, 0x2B55), (0x3030, 0x3030), (0x303D, 0x303D),
+    (0x3297, 0x3297), (0x3299, 0x3299),
+    (0x1F000, 0x1F0FF), (0x1F10D, 0x1F10F), (0x1F12F, 0x1F12F), (0x1F16C, 0x1F171),
+    (0x1F17E, 0x1F17F), (0x1F18E, 0x1F18E), (0x1F191, 0x1F19A), (0x1F1AD, 0x1F1E5),
+    (0x1F201, 0x1F20F), (0x1F21A, 0x1F21A), (0x1F22F, 0x1F22F), (0x1F232, 0x1F23A),
+    (0x1F23C, 0x1F23F), (0x1F249, 0x1F3FA), (0x1F400, 0x1F53D), (0x1F546, 0x1F64F),
+    (0x1F680, 0x1F6FF), (0x1F774, 0x1F77F), (0x1F7D5, 0x1F7FF), (0x1F80C, 0x1F80F),
+    (0x1F848, 0x1F84F), (0x1F85A, 0x1F85F), (0x1F888, 0x1F88F), (0x1F8AE, 0x1F8FF),
+    (0x1F90C, 0x1F93A), (0x1F93C, 0x1F945), (0x1F947, 0x1FAFF), (0x1FC00, 0x1FFFD),
+)
+_RANGE_STARTS = tuple(start for start, _ in _PICTOGRAPHIC_RANGES)
+
+ZWJ = 0x200D
+VS16 = 0xFE0F
+KEYCAP = 0x20E3
+BLACK_FLAG = 0x1F3F4
+TAG_END = 0xE007F
+SKIN_TONES = range(0x1F3FB, 0x1F400)
+REGIONAL_INDICATORS = range(0x1F1E6, 0x1F200)
+TAG_CHARACTERS = range(0xE0020, 0xE007F)
+KEYCAP_BASES = frozenset(map(ord, '0123456789#*'))
+
+CUSTOM_EMOJI_PATTERN = re.compile(r'<a?:[A-Za-z0-9_]{2,32}:[0-9]{15,21}>')
+
+
+def is_pictographic(cp: int) -> bool:
+    i = bisect_right(_RANGE_STARTS, cp) - 1
+    return i >= 0 and cp <= _PICTOGRAPHIC_RANGES[i][1]
+
+
+def _element_end(text: str, i: int) -> int:
+    """End of one emoji element starting at i: a base plus an optional skin tone or VS16."""
+    i += 1
+    if i < len(text):
+        cp = ord(text[i])
+        if cp in SKIN_TONES or cp == VS16:
+            i += 1
+    return i
+
+
+def match_emoji(text: str, i: int) -> Optional[int]:
+    """Returns the end of the longest Unicode emoji sequence starting at i, or None.
+
+    Follows the UTS #51 grammar: flags (two regional indicators), keycaps,
+    tag sequences such as subdivision flags, and ZWJ chains of elements with
+    optional skin-tone modifiers or VS16.
+    """
+    n = len(text)
+    cp = ord(text[i])
+
+    if cp in REGIONAL_INDICATORS:
+        if i + 1 < n and ord(text[i + 1]) in REGIONAL_INDICATORS:
+            return i + 2
+        return None
+
+    if cp in KEYCAP_BASES:
+        j = i + 1
+        if j < n and ord(text[j]) == VS16:
+            j += 1
+        if j < n and ord(text[j]) == KEYCAP:
+            return j + 1
+        return None
+
+    if cp == BLACK_FLAG and i + 1 < n and ord(text[i + 1]) in TAG_CHARACTERS:
+        j = i + 1
+        while j < n and ord(text[j]) in TAG_CHARACTERS:
+            j += 1
+        if j < n and ord(text[j]) == TAG_END:
+            return j + 1
+
+    if not (is_pictographic(cp) or cp in SKIN_TONES):
+        return None
+    j = _element_end(text, i)
+    # Extend greedily through ZWJ joins, but only onto another valid element
+    while j + 1 < n and ord(text[j]) == ZWJ and is_pictographic(ord(text[j + 1])):
+        j = _element_end(text, j + 1)
+    return j
+
+
+def _scan(text: str) -> Tuple[str, ...]:
+    found: List[str] = []
+    i, n = 0, len(text)
+    while i < n:
+        if text[i] == '<':
+            custom = CUSTOM_EMOJI_PATTERN.match(text, i)
+            if custom:
+                found.append(custom.group())
+                i = custom.end()
+                continue
+        end = match_emoji(text, i)
+        if end is None:
+            i += 1
+        else:
+            found.append(text[i:end])
+            i = end
+    return tuple(found)
+
+
+@lru_cache(maxsize=4096)
+def find_emojis(text: str) -> Tuple[str, ...]:
+    """Every Unicode or custom Discord emoji in text, in order. Other characters are skipped."""
+    return _scan(text)
+
+
+@lru_cache(maxsize=4096)
+def is_emoji(text: str) -> bool:
+    """True if text is exactly one Unicode emoji sequence or one custom Discord emoji."""
+    if not text:
+        return False
+    if CUSTOM_EMOJI_PATTERN.fullmatch(text):
+        return True
+    return match_emoji(text, 0) == len(text)
@@ -0,0 +1,407 @@
+# loadtest.py
+"""End-to-end load test: the real bot from main.py against a local Discord stand-in.
+
+An aiohttp server plays Discord's REST API for the calls the bot makes
+(login, message.reply and add_reaction), with injected latency and 429s.
+discord.py is pointed at it, and a scripted feeder pushes MESSAGE_CREATE
+payloads through discord.py's own gateway parser at the requested rates, so
+every message takes the production path: on_message, the compiled plans,
+the outbound queue and the HTTP client with its rate-limit handling.
+
+Traffic is a list of duration:rate phases, e.g. a warm-up and a ramp:
+
+    python loadtest.py --targets 10000 --phases 30:50,60:200,60:1000 --latency 80 --rate-limit 0.02
+
+Every --report-interval seconds it prints the fed and sent rates, the 429s,
+the action latency (from the message being fed to Discord answering the
+request) and RSS, then a summary of the whole run. The bot's own settings
+come from the environment as usual (OUTBOUND_*, LOW_MEMORY, DB_*), so a
+rollout's configuration can be load-tested as is.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+# main.py refuses to import without a token and opens its DB at import time,
+# so point both somewhere harmless before importing it.
+_LOADTEST_DIR = tempfile.mkdtemp(prefix="annoy-loadtest-")
+os.environ.setdefault('DISCORD_TOKEN', 'loadtest')
+os.environ['DB_PATH'] = os.path.join(_LOADTEST_DIR, 'loadtest.db')
+os.environ['CACHE_SNAPSHOT_PATH'] = ''
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import discord  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+from metrics import process_rss_bytes  # noqa: E402
+
+BOT_USER_ID = 1000
+TARGET_USER_BASE = 10**6
+BYSTANDER_USER_BASE = 10**9
+EPOCH = "2024-01-01T00:00:00+00:00"
+MESSAGES = ("hello", "anyone around?", "lol", "ok but why", "brb", "that's what I said")
+
+# Reply/reaction setups the targets cycle through
+TARGET_VARIANTS = (
+    {"specific_reply": ["stop typing", "lol no"], "specific_reaction": ["😂", "🙄"]},
+    {"specific_reply": [], "specific_reaction": []},
+    {"specific_reply": ["you again?"], "specific_reaction": ["👍"], "message_mode": "specific_only"},
+    {"specific_reply": [], "specific_reaction": ["🤡"], "annoy_methods": ["reaction"]},
+)
+
+
+def user_payload(user_id: int, bot: bool = False) -> Dict[str, Any]:
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "global_name": None,
+            "avatar": None, "bot": bot}
+
+
+def message_payload(message_id: int, channel_id: int, guild_id: Optional[int], author_id: int, content: str) -> Dict[str, Any]:
+    payload = {
+        "id": str(message_id), "channel_id": str(channel_id),
+        "author": user_payload(author_id, bot=author_id == BOT_USER_ID),
+        "member": {"roles": [], "joined_at": EPOCH, "deaf": False, "mute": False, "flags": 0},
+        "content": content, "timestamp": EPOCH, "edited_timestamp": None, "tts": False,
+        "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+        "pinned": False, "type": 0,
+    }
+    if guild_id is not None:
+        # Gateway events carry it; REST responses don't
+        payload["guild_id"] = str(guild_id)
+    return payload
+
+
+def guild_payload(guild_id: int, channel_ids: Sequence[int]) -> Dict[str, Any]:
+    return {
+        "id": str(guild_id), "name": f"Load test {guild_id}", "owner_id": str(BOT_USER_ID), "features": [],
+        "emojis": [], "stickers": [], "members": [], "member_count": 0,
+        "roles": [{"id": str(guild_id), "name": "@everyone", "permissions": "68672", "position": 0, "color": 0,
+                   "hoist": False, "managed": False, "mentionable": False}],
+        "channels": [{"id": str(channel_id), "type": 0, "name": f"load-{channel_id}", "position": position,
+                      "permission_overwrites": [], "nsfw": False, "parent_id": None}
+                     for position, channel_id in enumerate(channel_ids)],
+    }
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> web.Response:
+    # discord.py only decodes bodies whose content type is exactly application/json, without a charset
+    return web.Response(body=json.dumps(data).encode(), status=status,
+                        headers={**(headers or {}), "Content-Type": "application/json"})
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class FakeDiscord:
+    """Serves the REST endpoints the bot uses, with injected latency and 429s.
+
+    Each request waits latency ± jitter seconds. A rate_limit fraction of
+    replies and reactions is answered with a 429 shaped like Discord's, which
+    discord.py sleeps through and retries. Action latency is measured from
+    fed_at[message_id] to the moment a reply or reaction is answered.
+    """
+
+    def __init__(self, fed_at: Dict[int, float], latency: float, jitter: float, rate_limit: float, retry_after: float):
+        self.fed_at = fed_at
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.counters: Dict[str, int] = dict.fromkeys(('replies', 'reactions', 'rate_limited'), 0)
+        self.latencies: List[float] = []
+        self._next_id = 1
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get('/api/v10/users/@me', self.current_user),
+            web.get('/api/v10/oauth2/applications/@me', self.application),
+            web.post('/api/v10/channels/{channel_id}/messages', self.create_message),
+            web.put('/api/v10/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me', self.add_reaction),
+        ])
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Starts serving and returns the API base URL for discord.http.Route.BASE."""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/api/v10"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _wait(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _rate_limited(self) -> Optional[web.Response]:
+        if self.rate_limit <= 0 or random.random() >= self.rate_limit:
+            return None
+        self.counters['rate_limited'] += 1
+        return json_response(
+            {"message": "You are being rate limited.", "retry_after": self.retry_after, "global": False},
+            status=429,
+            headers={"Via": "1.1 google", "X-RateLimit-Scope": "user", "Retry-After": str(self.retry_after)},
+        )
+
+    def _answered(self, message_id: Optional[int]):
+        fed = self.fed_at.get(message_id) if message_id is not None else None
+        if fed is not None:
+            self.latencies.append(time.perf_counter() - fed)
+
+    async def current_user(self, request: web.Request) -> web.Response:
+        return json_response(user_payload(BOT_USER_ID, bot=True))
+
+    async def application(self, request: web.Request) -> web.Response:
+        return json_response({
+            "id": str(BOT_USER_ID), "name": "Annoy-o-Matic load test", "description": "", "icon": None,
+            "bot_public": False, "bot_require_code_grant": False, "owner": user_payload(1),
+            "verify_key": "0" * 64, "flags": 0,
+        })
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        await self._wait()
+        limited = self._rate_limited()
+        if limited is not None:
+            return limited
+        body = await request.json()
+        self.counters['replies'] += 1
+        reference = body.get('message_reference') or {}
+        self._answered(int(reference['message_id']) if reference.get('message_id') else None)
+        self._next_id += 1
+        return json_response(message_payload(
+            self._next_id, int(request.match_info['channel_id']), None, BOT_USER_ID, body.get('content') or ''
+        ))
+
+    async def add_reaction(self, request: web.Request) -> web.Response:
+        await self._wait()
+        limited = self._rate_limited()
+        if limited is not None:
+            return limited
+        self.counters['reactions'] += 1
+        self._answered(int(request.match_info['message_id']))
+        return web.Response(status=204)
+
+
+class GatewayFeeder:
+    """Pushes MESSAGE_CREATE payloads through discord.py's gateway parser on a schedule.
+
+    Messages come from targets with probability target_share and from
+    bystanders otherwise, spread over every guild and channel.
+    """
+
+    def __init__(self, state, guilds: Dict[int, List[int]], targets_by_guild: Dict[int, List[int]],
+                 target_share: float, fed_at: Dict[int, float]):
+        self.state = state
+        self.channels = [(guild_id, channel_id) for guild_id, channel_ids in guilds.items() for channel_id in channel_ids]
+        self.targets_by_guild = targets_by_guild
+        self.target_share = target_share
+        self.fed_at = fed_at
+        self.fed = 0
+        self.next_id = 1
+        self.current_rate = 0.0
+
+    def feed_one(self):
+        guild_id, channel_id = random.choice(self.channels)
+        targets = self.targets_by_guild.get(guild_id)
+        if targets and random.random() < self.target_share:
+            author_id = random.choice(targets)
+        else:
+            author_id = BYSTANDER_USER_BASE + random.randrange(100000)
+        message_id = self.next_id
+        self.next_id += 1
+        self.fed_at[message_id] = time.perf_counter()
+        self.state.parse_message_create(message_payload(message_id, channel_id, guild_id, author_id, random.choice(MESSAGES)))
+        self.fed += 1
+
+    async def run(self, phases: Sequence[Tuple[float, float]], tick: float = 0.01):
+        """Feeds each (duration, rate) phase in turn, in ticks of `tick` seconds."""
+        loop = asyncio.get_running_loop()
+        for duration, rate in phases:
+            self.current_rate = rate
+            started = last = loop.time()
+            credit = 0.0
+            while last - started < duration:
+                await asyncio.sleep(tick)
+                now = loop.time()
+                # Credit for the time that actually passed, so a slow tick doesn't lower the rate
+                credit += (now - last) * rate
+                last = now
+                while credit >= 1:
+                    self.feed_one()
+                    credit -= 1
+        self.current_rate = 0.0
+
+
+def parse_phases(text: str) -> List[Tuple[float, float]]:
+    phases = []
+    for part in text.split(','):
+        duration, _, rate = part.partition(':')
+        phases.append((float(duration), float(rate)))
+    return phases
+
+
+async def populate(guild_count: int, targets: int, channels_per_guild: int) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
+    """Creates the guilds in discord.py's cache and the targets in the DB, then loads them like on_ready."""
+    guilds: Dict[int, List[int]] = {}
+    targets_by_guild: Dict[int, List[int]] = {}
+    for index in range(guild_count):
+        guild_id = 100 + index
+        guilds[guild_id] = [guild_id * 1000 + channel for channel in range(channels_per_guild)]
+        main.bot._connection._add_guild_from_data(guild_payload(guild_id, guilds[guild_id]))
+    for index in range(targets):
+        guild_id = 100 + index % guild_count
+        targets_by_guild.setdefault(guild_id, []).append(TARGET_USER_BASE + index)
+    for guild_id, user_ids in targets_by_guild.items():
+        await main.db.bulk_upsert(guild_id, [
+            dict(TARGET_VARIANTS[user_id % len(TARGET_VARIANTS)], user_id=user_id) for user_id in user_ids
+        ])
+    await main.load_guild_targets(guilds)
+    return guilds, targets_by_guild
+
+
+def format_mib(value: Optional[int]) -> str:
+    return "n/a" if value is None else f"{value / 2**20:.1f}"
+
+
+async def report(fake: FakeDiscord, feeder: GatewayFeeder, interval: float, history: List[Dict[str, Any]]):
+    """Prints one line per interval and keeps it in history for the summary."""
+    print(f"{'time s':>7} {'rate':>7} {'fed/s':>8} {'sent/s':>8} {'429/s':>6} {'p50 ms':>7} {'p99 ms':>8} "
+          f"{'pending':>8} {'dropped':>8} {'RSS MiB':>8}")
+    started = time.perf_counter()
+    last_fed = 0
+    last_sent = 0
+    last_limited = 0
+    last_dropped = 0
+    # (fed time, first message id fed after it), to forget fed_at entries no action can still answer
+    checkpoints: Deque[Tuple[float, int]] = deque()
+    forget_after = main.outbound.max_age + 30
+    forgotten = 1
+    while True:
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        latencies = sorted(fake.latencies)
+        fake.latencies.clear()
+        sent = fake.counters['replies'] + fake.counters['reactions']
+        dropped = sum(value for name, value in main.outbound.counters.items() if name.startswith('dropped'))
+        row = {
+            "time": now - started,
+            "rate": feeder.current_rate,
+            "fed": (feeder.fed - last_fed) / interval,
+            "sent": (sent - last_sent) / interval,
+            "rate_limited": (fake.counters['rate_limited'] - last_limited) / interval,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "pending": main.outbound.pending,
+            "dropped": dropped - last_dropped,
+            "rss": process_rss_bytes(),
+            "latencies": latencies,
+        }
+        history.append(row)
+        last_fed, last_sent, last_limited, last_dropped = feeder.fed, sent, fake.counters['rate_limited'], dropped
+        print(f"{row['time']:>7.0f} {row['rate']:>7.0f} {row['fed']:>8.0f} {row['sent']:>8.1f} {row['rate_limited']:>6.1f} "
+              f"{row['p50']:>7.0f} {row['p99']:>8.0f} {row['pending']:>8} {row['dropped']:>8} {format_mib(row['rss']):>8}")
+
+        checkpoints.append((now, feeder.next_id))
+        while checkpoints and now - checkpoints[0][0] > forget_after:
+            _, below = checkpoints.popleft()
+            for message_id in range(forgotten, below):
+                feeder.fed_at.pop(message_id, None)
+            forgotten = below
+
+
+def print_summary(history: List[Dict[str, Any]], fake: FakeDiscord, elapsed: float, rss_start: Optional[int]):
+    latencies = sorted(latency for row in history for latency in row["latencies"])
+    sent = fake.counters['replies'] + fake.counters['reactions']
+    busy = [row for row in history if row["rate"] > 0]
+    rss_values = [row["rss"] for row in history if row["rss"] is not None]
+    print()
+    print(f"Sent {sent:,} action(s) ({fake.counters['replies']:,} replies, {fake.counters['reactions']:,} reactions) "
+          f"in {elapsed:.0f}s, {fake.counters['rate_limited']:,} answered with 429")
+    if busy:
+        print(f"Sustained: {sum(row['sent'] for row in busy) / len(busy):,.1f} actions/s while feeding "
+              f"{sum(row['fed'] for row in busy) / len(busy):,.0f} msgs/s")
+    print(f"Action latency: p50 {percentile(latencies, 0.50) * 1000:.0f} ms, p90 {percentile(latencies, 0.90) * 1000:.0f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, max {percentile(latencies, 1.0) * 1000:.0f} ms")
+    print("Outbound: " + ", ".join(f"{name}={value:,}" for name, value in main.outbound.counters.items()))
+    if rss_values:
+        print(f"RSS: {format_mib(rss_start)} MiB before traffic, peak {format_mib(max(rss_values))} MiB, "
+              f"end {format_mib(rss_values[-1])} MiB")
+
+
+async def run(args: argparse.Namespace):
+    random.seed(args.seed)
+    fed_at: Dict[int, float] = {}
+    fake = FakeDiscord(fed_at, args.latency / 1000, args.jitter / 1000, args.rate_limit, args.retry_after)
+    discord.http.Route.BASE = await fake.start()
+    bot = main.bot
+    try:
+        # Logs in against the stand-in, which also runs main's setup_hook
+        await bot.login(main.DISCORD_TOKEN)
+        guilds, targets_by_guild = await populate(args.guilds, args.targets, args.channels)
+        print(f"Loaded {args.targets:,} target(s) in {len(guilds)} guild(s) with {args.channels} channel(s) each; "
+              f"latency {args.latency:g}±{args.jitter:g} ms, {args.rate_limit:.1%} 429s")
+
+        feeder = GatewayFeeder(bot._connection, guilds, targets_by_guild, args.target_share, fed_at)
+        history: List[Dict[str, Any]] = []
+        rss_start = process_rss_bytes()
+        started = time.perf_counter()
+        reporter = asyncio.create_task(report(fake, feeder, args.report_interval, history))
+        await feeder.run(parse_phases(args.phases))
+        # Let the queue drain before the summary
+        await asyncio.sleep(args.drain)
+        reporter.cancel()
+        print_summary(history, fake, time.perf_counter() - started, rss_start)
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump([{key: value for key, value in row.items() if key != 'latencies'} for row in history], out, indent=2)
+    finally:
+        await main.outbound.stop()
+        await main.cache_sync.stop()
+        for task in main.background_tasks:
+            task.cancel()
+        await bot.close()
+        await fake.stop()
+        main.db.close()
+        main.log_listener.stop()
+
+
+def main_cli(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Load-test the bot against a local Discord stand-in.")
+    parser.add_argument('--targets', type=int, default=10000, help="Annoyance targets, spread over the guilds")
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--channels', type=int, default=20, help="Text channels per guild")
+    parser.add_argument('--phases', default='30:100',
+                        help="Comma-separated duration_s:msgs_per_s phases, e.g. 30:50,60:500")
+    parser.add_argument('--target-share', type=float, default=0.25, help="Fraction of messages sent by targets")
+    parser.add_argument('--latency', type=float, default=50.0, help="Mean REST latency in ms")
+    parser.add_argument('--jitter', type=float, default=20.0, help="REST latency varies by up to this many ms")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Fraction of sends answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0.5, help="retry_after of injected 429s, in seconds")
+    parser.add_argument('--report-interval', type=float, default=5.0)
+    parser.add_argument('--drain', type=float, default=5.0, help="Seconds to wait for the queue after the last phase")
+    parser.add_argument('--json', help="Also write the per-interval rows to this file")
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,134 @@
+# logging_setup.py
+import json
+import logging
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+# Pass as `extra=` on lines logged once per handled message or sent action.
+# Those are rate-limited so heavy traffic can't turn into logging backpressure.
+PER_MESSAGE = {'per_message': True}
+
+# Attributes every LogRecord has; anything else on a record came from `extra=`
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'per_message'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message and any extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class PerMessageRateLimit(logging.Filter):
+    """Token bucket for PER_MESSAGE records; other records always pass.
+
+    Dropped lines are counted, and the next line that gets through carries
+    that count as `suppressed`, so the log still shows how much was skipped.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'per_message', False):
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        if self.suppressed:
+            record.suppressed = self.suppressed
+            self.suppressed = 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting or ever blocking.
+
+    The stock QueueHandler formats each record on the calling thread; here that
+    is left to the listener, so the event loop only pays for an enqueue. When
+    the queue is full the record is dropped and counted instead.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Parses 'database=WARNING,discord=INFO' into {logger name: level}."""
+    levels = {}
+    for part in spec.split(','):
+        if '=' in part:
+            name, level = part.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(
+    level: str = 'INFO',
+    module_levels: Optional[Dict[str, str]] = None,
+    fmt: str = 'json',
+    per_message_rate: float = 5.0,
+    per_message_burst: float = 20.0,
+    max_queue: int = 10000,
+) -> QueueListener:
+    """Routes every log record through a bounded queue to a stdout writer thread.
+
+    Returns the started listener; stop() it on shutdown to flush what's queued.
+    """
+    if fmt == 'json':
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(name)s: %(message)s')
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=max_queue)
+    handler = DroppingQueueHandler(log_queue)
+    if per_message_rate > 0:
+        handler.addFilter(PerMessageRateLimit(per_message_rate, per_message_burst))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -1,26 +1,109 @@
 # main.py
 import os
+import asyncio
+import logging
 import discord
 import random
-import re # Import regex for emoji parsing
+import time
 import csv
-from io import StringIO
+from datetime import datetime, timezone
+from io import BytesIO, StringIO
+from typing import Dict, Iterable, Optional, Set, Union
 from dotenv import load_dotenv
 from discord.ext import commands
 from discord import app_commands
-from database import AnnoyanceDB
+from database import AsyncAnnoyanceDB, LEGACY_GUILD_ID, RULES_CHANGE_USER_ID, SCHEDULES_CHANGE_USER_ID
+from annoyance_plan import AnnoyancePlan, compile_plan
+from cache_sync import CacheSync
+from content_rules import MAX_REGEX_RULES, RULE_ACTIONS, RuleMatcher, compile_rules, validate_pattern
+from emoji_index import find_emojis, is_emoji
+from maintenance import DatabaseMaintenance, format_progress, format_status
+from message_template import MessageTemplate, validate_template
+from logging_setup import PER_MESSAGE, parse_levels, setup_logging
+from metrics import (
+    MetricsRegistry, MetricsServer, RateLimitLogCounter, label_counters, monitor_loop_lag, process_rss_bytes, sum_partitions
+)
+from outbound import OutboundScheduler
+from scheduler import (
+    MAX_SCHEDULES_PER_GUILD, MIN_INTERVAL_SECONDS, AnnoyanceScheduler, ScheduledJob, ScheduledPost, ScheduledUser
+)
+from startup import command_tree_hash, gc_paused, load_snapshot, save_snapshot
+from target_io import MAX_BURST_SIZE, TargetImportError, export_targets, parse_targets
+from target_list import NameCache, TargetListView
+from target_settings import TargetSettings, pack_settings, shared_values
+
+# Startup time reported in on_ready is measured from here
+STARTED_AT = time.monotonic()
 
 # Loads environment variables from .env file
 load_dotenv()
 
+# Log records are queued and written by a background thread, so a slow stdout
+# never blocks the event loop. LOG_LEVELS sets per-module levels, e.g.
+# "database=WARNING,discord=INFO". Per-message lines are capped at
+# LOG_PER_MESSAGE_RATE lines per second.
+log_listener = setup_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    module_levels=parse_levels(os.getenv('LOG_LEVELS', '')),
+    fmt=os.getenv('LOG_FORMAT', 'json'),
+    per_message_rate=float(os.getenv('LOG_PER_MESSAGE_RATE', '5')),
+)
+log = logging.getLogger('main')
+
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 if DISCORD_TOKEN is None:
     raise ValueError("DISCORD_TOKEN is not set in the environment variables.")
 
 TEST_GUILD_ID = os.getenv('TEST_GUILD_ID') # For guild-specific syncing during development
 
+# Set SHARDED=true to run as an AutoShardedBot. SHARD_COUNT and SHARD_IDS
+# (comma-separated) let several processes split the shards between them.
+SHARDED = os.getenv('SHARDED', 'false').lower() in ('1', 'true', 'yes')
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+SHARD_IDS = os.getenv('SHARD_IDS')
+
+# LOW_MEMORY=true drops the member cache and chunking, which dominate RSS and
+# startup time in large guilds. MAX_MESSAGES sizes discord.py's message cache
+# in either mode (0 disables it); the low-memory default is 0.
+LOW_MEMORY = os.getenv('LOW_MEMORY', 'false').lower() in ('1', 'true', 'yes')
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', '0' if LOW_MEMORY else '1000'))
+
+# Set METRICS_PORT to serve Prometheus metrics on METRICS_HOST (localhost by default)
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# --- METRICS --- #
+# Recorded whether or not the endpoint is enabled; every update is a few additions
+metrics = MetricsRegistry()
+on_message_latency = metrics.histogram(
+    'annoy_on_message_seconds', 'Time spent in on_message, by what happened to the message.', ('outcome',)
+)
+db_latency = metrics.histogram('annoy_db_query_seconds', 'AnnoyanceDB call latency, including thread queueing.', ('operation',))
+loop_lag = metrics.histogram('annoy_event_loop_lag_seconds', 'How late the event loop ran a timer.')
+discord_rate_limits = metrics.counter('annoy_discord_429_total', '429 responses that discord.py retried internally.', ('scope',))
+logging.getLogger('discord.http').addFilter(RateLimitLogCounter(discord_rate_limits))
+
+# The target cache is saved here on shutdown and warms the next start.
+# Set CACHE_SNAPSHOT_PATH to an empty string to always load from the DB.
+CACHE_SNAPSHOT_PATH = os.getenv('CACHE_SNAPSHOT_PATH', os.getenv('DB_PATH', 'annoy_o_matic.db') + '.snapshot')
+
 # --- INITIALIZE DATABASE --- #
-db = AnnoyanceDB()
+# DB_WRITE_BEHIND=true batches config updates instead of committing each one.
+# DB_SYNCHRONOUS=NORMAL trades the last few commits on power loss for far fewer fsyncs.
+db = AsyncAnnoyanceDB(
+    db_name=os.getenv('DB_PATH', 'annoy_o_matic.db'),
+    write_behind=os.getenv('DB_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes'),
+    flush_interval=float(os.getenv('DB_FLUSH_INTERVAL', '2')),
+    flush_threshold=int(os.getenv('DB_FLUSH_THRESHOLD', '500')),
+    synchronous=os.getenv('DB_SYNCHRONOUS') or None,
+    latency=db_latency,
+    event_flush_interval=float(os.getenv('EVENT_FLUSH_INTERVAL', '5')),
+)
+
+# Raw annoyance events are kept EVENT_RETENTION_DAYS, their hourly rollups
+# (what /annoystats reads) ROLLUP_RETENTION_DAYS
+EVENT_RETENTION_DAYS = float(os.getenv('EVENT_RETENTION_DAYS', '7'))
+ROLLUP_RETENTION_DAYS = float(os.getenv('ROLLUP_RETENTION_DAYS', '90'))
 
 # List of random messages to annoy the user with
 random_messages = ["You dopehead", "Bad Boy", "Dingus", "Still here?", "Annoyed yet?"]
@@ -29,108 +112,489 @@ random_messages = ["You dopehead", "Bad Boy", "Dingus", "Still here?", "Annoyed
 # Note: Discord supports custom emojis, but for simplicity, we'll focus on standard ones.
 emojis = ["😂", "👍", "❤️", "🤔", "😁", "😆", "😅", "🤣", "😊", "😇", "😉", "😌", "😍", "🥰", "😘", "😗", "😙", "😚", "😋", "😛", "😝", "😜", "🤪", "🤨", "🧐", "🤓", "😎", "🤩", "🥳", "😏", "😒", "😞", "😔", "😟", "😕", "🙁", "☹️", "😣", "😖", "😫", "😩", "🥺", "😢", "😭", "😤", "😠", "😡", "🤬", "🤯", "😳", "🥵", "🥶", "😱", "😨", "😰", "😥", "😓", "🤗", "🤔", "🤭", "🤫", "🤥", "😶", "😐", "😑", "😬", "🙄", "😯", "😦", "😧", "😮", "😲", "🥱", "😴", "🤤", "😪", "😵", "🤐", "🥴", "🤢", "🤮", "🤧", "😷", "🤒", "🤕", "🤑", "🤠", "😈", "👿", "👹", "👺", "🤡", "💩", "👻", "💀", "☠️", "👽", "👾", "🤖", "🎃", "😺", "😸", "😹", "😻", "😼", "😽", "🙀", "😿", "😾"]
 
+# Catch typos in the fallback list at startup rather than as failed reactions later
+invalid_emojis = [emoji for emoji in emojis if not is_emoji(emoji)]
+if invalid_emojis:
+    log.warning("Ignoring invalid fallback emoji(s): %s", ', '.join(invalid_emojis))
+
+# Shared immutable copies so every compiled plan references the same pools
+random_message_pool = tuple(random_messages)
+emoji_pool = tuple(emoji for emoji in emojis if is_emoji(emoji))
 
 # Sets the intents for the bot
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
+if LOW_MEMORY:
+    # Only what on_message and the slash commands read. Command arguments
+    # arrive as resolved members in the interaction payload, and /listtargets
+    # falls back to its own name cache, so neither needs the member cache.
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    cache_options = dict(
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.none(),
+    )
+else:
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.members = True
+    cache_options = {}
+
+if SHARDED:
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT else None,
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(',')] if SHARD_IDS else None,
+        max_messages=MAX_MESSAGES or None,
+        **cache_options,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, max_messages=MAX_MESSAGES or None, **cache_options)
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Every reply and reaction goes through this queue so bursts can't pile up 429 retries
+outbound = OutboundScheduler(
+    max_pending=int(os.getenv('OUTBOUND_MAX_PENDING', '1000')),
+    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', '40')),
+    channel_rate=float(os.getenv('OUTBOUND_CHANNEL_RATE', '1')),
+    max_age=float(os.getenv('OUTBOUND_MAX_AGE', '10')),
+    policy=os.getenv('OUTBOUND_POLICY', 'drop_oldest'),
+    burst_concurrency=int(os.getenv('OUTBOUND_BURST_CONCURRENCY', '4')),
+)
+outbound.register_metrics(metrics)
 
-target_settings_cache = {}
 
-@bot.event
-async def on_ready():
-    print(f'Bot is logged in as {bot.user}')
-    global target_settings_cache
-    target_settings_cache = db.get_all_targets()
-    print(f"Loaded initial target settings from DB: {target_settings_cache}")
+def record_outbound_result(action, outcome: str, latency: float):
+    message = action.message
+    db.record_event(message.guild.id, message.channel.id, message.author.id, action.kind, action.payload, latency, outcome)
 
-    try:
-        if TEST_GUILD_ID:
-            guild = discord.Object(id=int(TEST_GUILD_ID))
-            synced = await bot.tree.sync(guild=guild)
-            print(f"Synced {len(synced)} guild command(s) to guild {TEST_GUILD_ID}")
+
+outbound.on_result = record_outbound_result
+metrics.gauge('annoy_events_buffered', 'Annoyance events waiting to be written.', lambda: db.buffered_events)
+
+# Display names for /listtargets, for users that aren't in the member cache
+user_name_cache = NameCache()
+
+# Both caches are partitioned by guild: guild_id -> user_id -> value. A shard
+# only ever holds the partitions for the guilds it serves.
+target_settings_cache: Dict[int, Dict[int, TargetSettings]] = {}
+# Compiled per-target plans used by on_message; kept in sync with target_settings_cache
+target_plans: Dict[int, Dict[int, AnnoyancePlan]] = {}
+# Every partition that has been loaded, including guilds without targets
+loaded_guilds: Set[int] = set()
+# guild_id -> all of that guild's content rules, compiled; absent if it has none
+rule_matchers: Dict[int, RuleMatcher] = {}
+# guild_id -> user_id -> times annoyed since the bot started, for {count} in replies
+annoy_counts: Dict[int, Dict[int, int]] = {}
+
+metrics.gauge('annoy_cached_targets', 'Targets held in the settings cache.', lambda: sum_partitions(target_settings_cache))
+metrics.gauge('annoy_cached_plans', 'Compiled annoyance plans.', lambda: sum_partitions(target_plans))
+metrics.gauge('annoy_content_rules', 'Compiled content rules across cached guilds.',
+              lambda: sum(matcher.rule_count for matcher in rule_matchers.values()))
+metrics.gauge('annoy_interned_values', 'Distinct settings values and pickers shared across targets.',
+              lambda: len(shared_values))
+metrics.gauge('annoy_cached_guilds', 'Guild partitions in the cache.', lambda: len(target_settings_cache))
+metrics.gauge('annoy_cached_names', 'Entries in the /listtargets name cache.', lambda: len(user_name_cache))
+metrics.gauge('annoy_gateway_cached_members', 'Members held in discord.py\'s member cache.',
+              lambda: sum(len(guild.members) for guild in bot.guilds))
+metrics.gauge('annoy_gateway_cached_messages', 'Messages held in discord.py\'s message cache.', lambda: len(bot.cached_messages))
+metrics.gauge('annoy_process_rss_bytes', 'Resident set size of the bot process.', lambda: process_rss_bytes() or 0)
+
+
+def get_cached_settings(guild_id: int, user_id: int) -> Optional[TargetSettings]:
+    guild_targets = target_settings_cache.get(guild_id)
+    return guild_targets.get(user_id) if guild_targets else None
+
+
+def cache_target(guild_id: int, user_id: int, settings: Union[dict, TargetSettings]):
+    """Stores a target's settings and recompiles its annoyance plan.
+
+    Settings dicts are packed into TargetSettings first; cached settings are
+    never edited in place, so commands pass a replace()d copy back in here.
+    """
+    settings = pack_settings(settings)
+    target_settings_cache.setdefault(guild_id, {})[user_id] = settings
+    guild_plans = target_plans.setdefault(guild_id, {})
+    guild_plans[user_id] = compile_plan(settings, random_message_pool, emoji_pool, guild_plans.get(user_id))
+
+
+def update_cached_target(guild_id: int, user_id: int, **changes):
+    """Caches a copy of a target's settings with the given fields changed."""
+    cache_target(guild_id, user_id, target_settings_cache[guild_id][user_id].replace(**changes))
+
+
+def uncache_target(guild_id: int, user_id: int):
+    target_settings_cache.get(guild_id, {}).pop(user_id, None)
+    target_plans.get(guild_id, {}).pop(user_id, None)
+    annoy_counts.get(guild_id, {}).pop(user_id, None)
+
+
+def targets_in_guild(guild_id: int) -> Dict[int, TargetSettings]:
+    """The guild's targets plus the legacy ones that also apply in it, as handle_message sees them."""
+    guild_targets = target_settings_cache.get(guild_id, {})
+    legacy_targets = target_settings_cache.get(LEGACY_GUILD_ID)
+    if not legacy_targets:
+        return guild_targets
+    return {**legacy_targets, **guild_targets}
+
+
+async def adopt_legacy_target(guild_id: int, user_id: int) -> bool:
+    """Moves a user's legacy target (from before targets were per guild) into this guild, where commands can edit it."""
+    if get_cached_settings(LEGACY_GUILD_ID, user_id) is None or not await db.adopt_legacy_target(guild_id, user_id):
+        return False
+    uncache_target(LEGACY_GUILD_ID, user_id)
+    settings = await db.get_target_settings(guild_id, user_id)
+    if settings:
+        cache_target(guild_id, user_id, settings)
+    return True
+
+
+async def get_guild_target(guild_id: int, user_id: int) -> Optional[TargetSettings]:
+    """A target's settings in this guild, adopting their legacy target first if that's all they have."""
+    settings = get_cached_settings(guild_id, user_id)
+    if settings is None and await adopt_legacy_target(guild_id, user_id):
+        settings = get_cached_settings(guild_id, user_id)
+    return settings
+
+
+def drop_guild_partitions(guild_ids: Iterable[int]):
+    for guild_id in guild_ids:
+        target_settings_cache.pop(guild_id, None)
+        target_plans.pop(guild_id, None)
+        rule_matchers.pop(guild_id, None)
+        loaded_guilds.discard(guild_id)
+    # Schedules are read for the served guilds only
+    scheduler.reset()
+
+
+async def load_guild_rules(guild_ids: Iterable[int]):
+    """Recompiles the content-rule matchers of the given guilds from the DB."""
+    guild_ids = list(guild_ids)
+    rules = await db.get_trigger_rules(guild_ids)
+    for guild_id in guild_ids:
+        matcher = compile_rules(rules.get(guild_id, ()))
+        if matcher is None:
+            rule_matchers.pop(guild_id, None)
+        else:
+            rule_matchers[guild_id] = matcher
+
+
+async def load_guild_targets(guild_ids: Iterable[int]) -> int:
+    """Replaces the cache partitions of the given guilds with fresh rows from the DB."""
+    guild_ids = list(guild_ids)
+    loaded = await db.get_all_targets(guild_ids)
+    drop_guild_partitions(guild_ids)
+    loaded_guilds.update(guild_ids)
+    await load_guild_rules(guild_ids)
+    scheduler.reset()
+    count = 0
+    with gc_paused():
+        for guild_id, guild_targets in loaded.items():
+            for user_id, settings in guild_targets.items():
+                cache_target(guild_id, user_id, settings)
+            count += len(guild_targets)
+    return count
+
+
+def serves_guild(guild_id: int) -> bool:
+    """True if this process caches the guild: legacy targets, or a guild on one of its shards."""
+    return guild_id in loaded_guilds
+
+
+async def apply_target_changes(changed: Dict[tuple, Optional[dict]]):
+    """Applies targets and content rules that changed in the DB, e.g. from another bot process or a script."""
+    rule_guilds = set()
+    for (guild_id, user_id), settings in changed.items():
+        if not serves_guild(guild_id):
+            continue
+        if user_id == RULES_CHANGE_USER_ID:
+            rule_guilds.add(guild_id)
+        elif user_id == SCHEDULES_CHANGE_USER_ID:
+            scheduler.reset()
+        elif settings is None:
+            uncache_target(guild_id, user_id)
         else:
-            synced = await bot.tree.sync()
-            print(f"Synced {len(synced)} global command(s)")
+            cache_target(guild_id, user_id, settings)
+    if rule_guilds:
+        await load_guild_rules(rule_guilds)
+
+
+async def reload_served_guilds():
+    await load_guild_targets(loaded_guilds | {LEGACY_GUILD_ID})
+
+
+async def warm_from_snapshot() -> bool:
+    """Fills the cache from the snapshot file if it still matches the database.
+
+    The snapshot records the change-log position it was written at, so
+    anything committed since is replayed from the log on the next sync poll.
+    """
+    if not CACHE_SNAPSHOT_PATH:
+        return False
+    started = time.perf_counter()
+    snapshot = load_snapshot(CACHE_SNAPSHOT_PATH)
+    if snapshot is None:
+        return False
+    if snapshot.instance_id != db_instance_id:
+        log.info("Ignoring cache snapshot from a different database")
+        return False
+    changes = await db.get_changed_targets(snapshot.change_seq)
+    if changes is None:
+        log.info("Ignoring cache snapshot older than the change log")
+        return False
+
+    with gc_paused():
+        for guild_id, guild_targets in snapshot.targets.items():
+            for user_id, settings in guild_targets.items():
+                cache_target(guild_id, user_id, settings)
+    loaded_guilds.update(snapshot.guild_ids)
+    scheduler.reset()
+    # Rules aren't in the snapshot; there are few enough to read straight from the DB
+    await load_guild_rules(snapshot.guild_ids)
+    cache_sync.seq, changed = changes
+    await apply_target_changes(changed)
+    log.info(
+        "Warmed %s target(s) in %s guild(s) from the cache snapshot in %.3fs (%s changed since)",
+        sum(len(guild_targets) for guild_targets in snapshot.targets.values()), len(snapshot.guild_ids),
+        time.perf_counter() - started, len(changed),
+    )
+    return True
+
+
+def write_snapshot():
+    if not CACHE_SNAPSHOT_PATH or db_instance_id is None:
+        # Never got as far as reading the database
+        return
+    try:
+        save_snapshot(CACHE_SNAPSHOT_PATH, db_instance_id, cache_sync.seq, loaded_guilds, target_settings_cache)
+        log.info("Saved cache snapshot to %s", CACHE_SNAPSHOT_PATH)
+    except OSError as e:
+        log.error("Could not save cache snapshot to %s: %s", CACHE_SNAPSHOT_PATH, e)
+
+
+async def sync_command_tree():
+    """Syncs the slash commands, unless they're unchanged since the last sync."""
+    guild = discord.Object(id=int(TEST_GUILD_ID)) if TEST_GUILD_ID else None
+    scope = f"guild:{TEST_GUILD_ID}" if TEST_GUILD_ID else "global"
+    state_key = f"command_hash:{bot.application_id}:{scope}"
+    tree_hash = command_tree_hash(bot.tree, guild)
+    if await db.get_state(state_key) == tree_hash:
+        log.info("Slash commands unchanged, skipping the %s sync", scope)
+        return
+    try:
+        synced = await bot.tree.sync(guild=guild)
     except Exception as e:
-        print(f"Error syncing commands: {e}")
+        log.error("Error syncing commands: %s", e)
+        return
+    await db.set_state(state_key, tree_hash)
+    log.info("Synced %s %s command(s)", len(synced), scope)
+
+
+# Picks up target edits made by other processes sharing the database.
+# CACHE_SYNC_INTERVAL=0 turns it off for a single-process deployment.
+cache_sync = CacheSync(
+    db, apply_target_changes, reload_served_guilds,
+    interval=float(os.getenv('CACHE_SYNC_INTERVAL', '1')),
+)
+
+def post_scheduled_annoyance(job: ScheduledJob):
+    """Queues one run of a scheduled annoyance: its message, pinging the target, in its channel."""
+    channel = bot.get_channel(job.channel_id)
+    if channel is None:
+        log.warning("Skipping scheduled annoyance %s: channel %s no longer exists", job.id, job.channel_id)
+        return
+    author = channel.guild.get_member(job.user_id) or ScheduledUser(job.user_id, f"user {job.user_id}")
+    outbound.submit_post(ScheduledPost(channel.guild, channel, author), f"<@{job.user_id}> {job.message}", job.id)
+
+
+# Runs the scheduled annoyances of the served guilds from one task. A run
+# more than SCHEDULE_GRACE_SECONDS late (e.g. after downtime) is skipped.
+scheduler = AnnoyanceScheduler(
+    db, post_scheduled_annoyance, lambda: loaded_guilds,
+    grace=float(os.getenv('SCHEDULE_GRACE_SECONDS', '300')),
+)
+metrics.gauge('annoy_scheduled_loaded', 'Scheduled annoyances due soon enough to be held in memory.', lambda: scheduler.loaded)
+metrics.counter_callback(
+    'annoy_scheduled_runs_total', 'Scheduled annoyance runs by outcome.', lambda: label_counters(scheduler.counters), ('outcome',)
+)
+
+# Backs up, checks and tidies the database every MAINTENANCE_INTERVAL_HOURS
+# (0 = only through /dbmaintenance). Set BACKUP_DIR to an empty string to
+# skip backups.
+maintenance = DatabaseMaintenance(
+    db,
+    interval=float(os.getenv('MAINTENANCE_INTERVAL_HOURS', '24')) * 3600,
+    backup_dir=os.getenv('BACKUP_DIR', os.getenv('DB_PATH', 'annoy_o_matic.db') + '.backups'),
+    keep=int(os.getenv('BACKUP_KEEP', '7')),
+    step_pages=int(os.getenv('BACKUP_STEP_PAGES', '256')),
+)
+
+
+async def hourly_cleanup(interval: float = 3600.0):
+    while True:
+        try:
+            events, rollups = await db.compact_events(EVENT_RETENTION_DAYS * 86400, ROLLUP_RETENTION_DAYS * 86400)
+            if events or rollups:
+                log.info("Compacted %s old event(s) and %s old hourly rollup(s)", events, rollups)
+            finished = await db.purge_finished_schedules()
+            if finished:
+                log.info("Purged %s one-off schedule(s) that already ran", finished)
+        except Exception:
+            log.exception("Hourly cleanup failed")
+        await asyncio.sleep(interval)
+
+
+ready_once = False
+# Identifies the database a cache snapshot belongs to; read in setup_hook
+db_instance_id: Optional[str] = None
+
+metrics_server = MetricsServer(metrics, METRICS_HOST, int(METRICS_PORT)) if METRICS_PORT else None
+background_tasks = []
+
+
+@bot.event
+async def setup_hook():
+    outbound.start()
+    # Marked before on_ready loads anything, so nothing committed in between is missed
+    await cache_sync.mark()
+    global db_instance_id
+    db_instance_id = await db.get_state('instance_id')
+    # Messages can be handled as soon as the gateway connects, without waiting for on_ready
+    await warm_from_snapshot()
+    cache_sync.start()
+    scheduler.start()
+    maintenance.start()
+    background_tasks.append(asyncio.create_task(monitor_loop_lag(loop_lag)))
+    background_tasks.append(asyncio.create_task(hourly_cleanup()))
+    if metrics_server is not None:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            log.error("Could not start the metrics server on %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+
+
+@bot.event
+async def on_shard_ready(shard_id: int):
+    # Only fires for AutoShardedBot: load just the guilds this shard serves.
+    # Partitions that are already cached (from the snapshot, or before a
+    # reconnect) are kept; the cache sync keeps them current.
+    guild_ids = [guild.id for guild in bot.guilds if guild.shard_id == shard_id and guild.id not in loaded_guilds]
+    if guild_ids:
+        count = await load_guild_targets(guild_ids)
+        log.info("Shard %s loaded %s target(s) across %s guild(s)", shard_id, count, len(guild_ids))
+
+
+@bot.event
+async def on_ready():
+    log.info(
+        "Bot is logged in as %s after %.1fs (low-memory mode %s, RSS %s MiB, %s cached member(s))",
+        bot.user, time.monotonic() - STARTED_AT, 'on' if LOW_MEMORY else 'off',
+        round((process_rss_bytes() or 0) / 2**20, 1), sum(len(guild.members) for guild in bot.guilds),
+    )
+    # on_ready fires again after reconnects; everything below only needs doing once
+    global ready_once
+    if ready_once:
+        return
+    ready_once = True
+
+    # Legacy targets from before guild scoping apply everywhere, so every process loads them
+    guild_ids = {LEGACY_GUILD_ID}
+    if not SHARDED:
+        guild_ids.update(guild.id for guild in bot.guilds)
+    missing = guild_ids - loaded_guilds
+    if missing:
+        count = await load_guild_targets(missing)
+        log.info("Loaded %s target(s) across %s guild(s) from DB", count, len(missing))
+    # Guilds left while the bot was offline may still be in the snapshot
+    stale = loaded_guilds - {guild.id for guild in bot.guilds} - {LEGACY_GUILD_ID}
+    drop_guild_partitions(stale)
+    for guild_id in stale:
+        annoy_counts.pop(guild_id, None)
+
+    await sync_command_tree()
+
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    await load_guild_targets([guild.id])
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    drop_guild_partitions([guild.id])
+    annoy_counts.pop(guild.id, None)
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
         return
 
-    user_settings = target_settings_cache.get(message.author.id)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        outcome = await handle_message(message)
+    finally:
+        on_message_latency.observe(time.perf_counter() - started, outcome)
 
-    if user_settings:
-        specific_replies = user_settings.get("specific_reply", []) # Now a list
-        specific_reactions = user_settings.get("specific_reaction", []) # Now a list
-        annoy_methods = user_settings.get("annoy_methods", ['message', 'reaction'])
-        message_mode = user_settings.get("message_mode", 'both')
 
-        available_methods = []
-        if 'message' in annoy_methods:
-            # Message method is available if:
-            #   - message_mode is specific_only AND there are specific_replies
-            #   - message_mode is random_only (random messages are always available)
-            #   - message_mode is both
-            if (message_mode == 'specific_only' and specific_replies) or \
-               (message_mode == 'random_only') or \
-               (message_mode == 'both'):
-                available_methods.append('message')
+def render_reply(payload, message, count: int) -> str:
+    """Fills in a reply template's placeholders; plain replies and emoji pass through untouched."""
+    if payload.__class__ is not MessageTemplate:
+        return payload
+    # {time} is a Discord timestamp, shown in each reader's own timezone
+    return payload.render((message.author.mention, message.channel.mention, str(count), f"<t:{int(time.time())}:t>"))
 
-        if 'reaction' in annoy_methods:
-            # Reaction method is available if:
-            #   - there are specific_reactions
-            #   - or if no specific reactions are set, but random reactions are allowed (which they are by default in the list `emojis`)
-            if specific_reactions or emojis: # Assuming emojis is never empty if reaction is allowed.
-                available_methods.append('reaction')
 
+async def handle_message(message) -> str:
+    """Annoys the author if they are a target or match a content rule.
 
-        if not available_methods:
-            print(f"No active annoyance methods for {message.author.display_name}")
-            return
+    Returns the outcome for on_message's histogram.
+    """
+    plan = None
+    rule = None
+    if message.guild is not None:
+        guild_plans = target_plans.get(message.guild.id)
+        if guild_plans:
+            plan = guild_plans.get(message.author.id)
+        if plan is None and LEGACY_GUILD_ID in target_plans:
+            plan = target_plans[LEGACY_GUILD_ID].get(message.author.id)
+        matcher = rule_matchers.get(message.guild.id)
+        if matcher is not None and message.content:
+            rule = matcher.match(message.content, message.author.id)
 
-        chosen_method = random.choice(available_methods)
+    outcome = 'not_target'
+    if rule is not None:
+        # A matching rule replaces a target's usual annoyance, under the same limits
+        if plan is not None and plan.gate is not None and not plan.gate.allow(time.monotonic()):
+            outcome = 'gated'
+        else:
+            outbound.submit(rule.action, message, rule.payload)
+            outcome = 'rule'
+    elif plan is not None:
+        if not plan.methods:
+            log.info("No active annoyance methods for %s", message.author.display_name,
+                     extra={**PER_MESSAGE, 'user_id': message.author.id})
+            return 'no_methods'
 
-        try:
-            if chosen_method == 'message':
-                reply_options = []
-                if message_mode == 'specific_only':
-                    if specific_replies:
-                        reply_options.extend(specific_replies)
-                elif message_mode == 'random_only':
-                    reply_options.extend(random_messages)
-                elif message_mode == 'both':
-                    if specific_replies:
-                        reply_options.extend(specific_replies)
-                    reply_options.extend(random_messages)
-
-                if reply_options:
-                    reply_message = random.choice(reply_options)
-                    await message.reply(reply_message)
-                    print(f"Replied to {message.author.display_name} in {message.channel.name} with message (as reply).")
-                else:
-                    print(f"No message options available for {message.author.display_name} with mode '{message_mode}'.")
-
-            elif chosen_method == 'reaction':
-                if specific_reactions:
-                    chosen_emoji = random.choice(specific_reactions)
-                    await message.add_reaction(chosen_emoji)
-                    print(f"Reacted to {message.author.display_name} in {message.channel.name} with specific emoji.")
-                else:
-                    random_emoji = random.choice(emojis)
-                    await message.add_reaction(random_emoji)
-                    print(f"Reacted to {message.author.display_name} in {message.channel.name} with random emoji.")
-
-        except discord.Forbidden:
-            print(f"Lacked permissions to reply or react in {message.channel.name}")
-        except Exception as e:
-            print(f"An error occurred during annoyance: {e}")
+        if plan.gate is not None and not plan.gate.allow(time.monotonic()):
+            await bot.process_commands(message)
+            return 'gated'
+
+        guild_counts = annoy_counts.setdefault(message.guild.id, {})
+        count = guild_counts[message.author.id] = guild_counts.get(message.author.id, 0) + 1
+        if plan.burst > 1:
+            outbound.submit_burst(message, tuple(
+                (kind, render_reply(payload, message, count)) for kind, payload in plan.burst_actions()
+            ))
+        else:
+            chosen_method, picker = random.choice(plan.methods)
+            outbound.submit(
+                'reply' if chosen_method == 'message' else 'reaction', message, render_reply(picker.pick(), message, count)
+            )
+        outcome = 'annoyed'
 
     await bot.process_commands(message)
+    return outcome
 
 
 # Define MY_GUILD for guild-specific commands if TEST_GUILD_ID is set
@@ -140,45 +604,53 @@ else:
     MY_GUILD = None # No specific guild, commands will be global
 
 # Utility function to parse emojis from a string
-# This handles standard Unicode emojis and Discord custom emojis (<:name:id>)
+# This handles standard Unicode emojis (including ZWJ sequences, skin tones,
+# flags and keycaps) and Discord custom emojis (<:name:id> or <a:name:id>).
+# Separators such as commas and anything that isn't an emoji are ignored.
 def parse_emojis(text: str):
-    emojis = []
-    # Regex to find standard unicode emojis or custom Discord emojis
-    # Note: This is a simplified regex, full unicode emoji regex is complex.
-    # For custom emojis, it looks for <:name:id> or <a:name:id>
-    emoji_pattern = re.compile(r'<a?:[a-zA-Z0-9_]+:[0-9]+>|\p{Emoji_Presentation}|\p{Extended_Pictographic}', re.UNICODE)
-    
-    # Split by commas and then try to find emojis in each part
-    parts = [part.strip() for part in text.split(',')]
-    
-    for part in parts:
-        found_emojis = emoji_pattern.findall(part)
-        emojis.extend(found_emojis)
-        
-    return emojis
+    return list(find_emojis(text))
+
+
+# Formats a target's trigger limits for command responses
+def format_limits(settings: dict) -> str:
+    max_actions = settings.get('max_actions') or 0
+    rate = f"{max_actions} per {settings.get('action_window_seconds', 60):g}s" if max_actions else "unlimited"
+    return (
+        f"cooldown {settings.get('cooldown_seconds') or 0:g}s, "
+        f"probability {settings.get('trigger_probability', 1):g}, "
+        f"rate {rate}"
+    )
 
 
 # --- SLASH COMMANDS --- #
 
 @bot.tree.command(name="settarget", description="Add a user to the annoyance list.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
 @app_commands.describe(user="The user to add to the annoyance list.")
 async def settarget(interaction: discord.Interaction, user: discord.Member):
-    if user.id in target_settings_cache:
+    had_target = get_cached_settings(interaction.guild_id, user.id) is not None
+    if await adopt_legacy_target(interaction.guild_id, user.id):
+        await interaction.response.send_message(
+            f"{user.mention} was an annoyance target in every server, from before targets were per server. "
+            f"They are now a target in this server only, with {'the settings they had here' if had_target else 'the same settings'}."
+        )
+        return
+    if had_target:
         await interaction.response.send_message(
             f"{user.mention} is already an annoyance target. Use other commands to configure them.",
             ephemeral=True
         )
         return
 
-    is_newly_added = db.add_target(user.id)
+    is_newly_added = await db.add_target(interaction.guild_id, user.id)
     if is_newly_added:
-        settings = db.get_target_settings(user.id)
+        settings = await db.get_target_settings(interaction.guild_id, user.id)
         if settings:
-            target_settings_cache[user.id] = settings
+            cache_target(interaction.guild_id, user.id, settings)
             await interaction.response.send_message(
                 f"Successfully added {user.mention} to the annoyance list. "
                 "Use `/setannoyancemessage`, `/setannoyancereaction`, `/setannoyancemethods`, "
-                "and `/setmessagemode` to configure their annoyances."
+                "`/setmessagemode`, `/setselectionmode` and `/setannoyancelimits` to configure their annoyances."
             )
         else:
             await interaction.response.send_message(
@@ -187,21 +659,22 @@ async def settarget(interaction: discord.Interaction, user: discord.Member):
             )
     else:
         # User already existed in DB, but not cache. Load settings and inform the issuer.
-        settings = db.get_target_settings(user.id)
+        settings = await db.get_target_settings(interaction.guild_id, user.id)
         response_message = f"{user.mention} is already an annoyance target. Use other commands to configure them." if settings \
             else f"Failed to add {user.mention} as an annoyance target. Check bot logs for errors."
         if settings:
-            target_settings_cache[user.id] = settings
+            cache_target(interaction.guild_id, user.id, settings)
         await interaction.response.send_message(response_message, ephemeral=True)
 
 # Command 2: Set specific annoyance messages
 @bot.tree.command(name="setannoyancemessage", description="Set specific annoyance messages for a user.")
+@app_commands.guild_only()
 @app_commands.describe(
     user="The target user.",
-    messages="Semicolon-separated or quoted messages."
+    messages="Semicolon-separated or quoted messages. May use {user}, {channel}, {count} and {time}."
 )
 async def setannoyancemessage(interaction: discord.Interaction, user: discord.Member, messages: str = ""):
-    if user.id not in target_settings_cache:
+    if await get_guild_target(interaction.guild_id, user.id) is None:
         await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
         return
 
@@ -217,9 +690,15 @@ async def setannoyancemessage(interaction: discord.Interaction, user: discord.Me
             message_list = [m.strip() for m in messages.split(';') if m.strip()]
     # else: message_list stays empty (clear)
 
-    success = db.update_specific_reply(user.id, message_list)
+    for m in message_list:
+        error = validate_template(m)
+        if error:
+            await interaction.response.send_message(f"Invalid message '{m}': {error}", ephemeral=True)
+            return
+
+    success = await db.update_specific_reply(interaction.guild_id, user.id, message_list)
     if success:
-        target_settings_cache[user.id]['specific_reply'] = message_list
+        update_cached_target(interaction.guild_id, user.id, specific_reply=message_list, reply_weights=None)
         if message_list:
             await interaction.response.send_message(f"Successfully set specific messages for {user.mention}:\n>>> " + "\n".join(f"- '{m}'" for m in message_list))
         else:
@@ -229,14 +708,73 @@ async def setannoyancemessage(interaction: discord.Interaction, user: discord.Me
             f"Failed to set specific messages for {user.mention}. Check bot logs.", ephemeral=True
         )
 
+# Add or remove a single specific message without resending the whole list
+@bot.tree.command(name="addannoyancemessage", description="Add one specific annoyance message for a user.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    user="The target user.",
+    message="The message to add. May use {user}, {channel}, {count} and {time}.",
+    weight="How often it's picked relative to the other messages (default 1)."
+)
+async def addannoyancemessage(
+    interaction: discord.Interaction,
+    user: discord.Member,
+    message: app_commands.Range[str, 1, 2000],
+    weight: app_commands.Range[float, 0, 1000] = 1.0
+):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    message = message.strip()
+    error = validate_template(message)
+    if error:
+        await interaction.response.send_message(f"Invalid message: {error}", ephemeral=True)
+        return
+    success = await db.add_specific_reply(interaction.guild_id, user.id, message, weight)
+    if success:
+        settings = target_settings_cache[interaction.guild_id][user.id]
+        update_cached_target(
+            interaction.guild_id, user.id,
+            specific_reply=settings.specific_reply + (message,), reply_weights=settings.reply_weights + (weight,)
+        )
+        await interaction.response.send_message(f"Added a specific message for {user.mention}:\n>>> {message}")
+    else:
+        await interaction.response.send_message(
+            f"Failed to add the message for {user.mention}. Check bot logs.", ephemeral=True
+        )
+
+@bot.tree.command(name="removeannoyancemessage", description="Remove one specific annoyance message from a user.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(user="The target user.", message="The exact message to remove.")
+async def removeannoyancemessage(interaction: discord.Interaction, user: discord.Member, message: str):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    message = message.strip()
+    success = await db.remove_specific_reply(interaction.guild_id, user.id, message)
+    if success:
+        settings = target_settings_cache[interaction.guild_id][user.id]
+        kept = [(m, w) for m, w in zip(settings.specific_reply, settings.reply_weights) if m != message]
+        update_cached_target(
+            interaction.guild_id, user.id, specific_reply=[m for m, _ in kept], reply_weights=[w for _, w in kept]
+        )
+        await interaction.response.send_message(f"Removed the specific message from {user.mention}.")
+    else:
+        await interaction.response.send_message(
+            f"{user.mention} has no specific message matching that text.", ephemeral=True
+        )
+
 # Command 3: Set specific annoyance reactions
 @bot.tree.command(name="setannoyancereaction", description="Set one or more specific emoji reactions (comma-separated) to annoy a user with.")
+@app_commands.guild_only()
 @app_commands.describe(
     user="The target user.",
     emojis_input="Comma-separated list of emojis (e.g., 😂, <:custom_emoji:12345>). Leave empty to clear."
 )
 async def setannoyancereaction(interaction: discord.Interaction, user: discord.Member, emojis_input: str = ""):
-    if user.id not in target_settings_cache:
+    if await get_guild_target(interaction.guild_id, user.id) is None:
         await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
         return
 
@@ -248,9 +786,9 @@ async def setannoyancereaction(interaction: discord.Interaction, user: discord.M
             return
         emoji_list = parsed_emojis
 
-    success = db.update_specific_reaction(user.id, emoji_list)
+    success = await db.update_specific_reaction(interaction.guild_id, user.id, emoji_list)
     if success:
-        target_settings_cache[user.id]['specific_reaction'] = emoji_list
+        update_cached_target(interaction.guild_id, user.id, specific_reaction=emoji_list, reaction_weights=None)
         if emoji_list:
             await interaction.response.send_message(f"Successfully set specific reactions for {user.mention}:\n>>> " + ", ".join(emoji_list))
         else:
@@ -263,6 +801,7 @@ async def setannoyancereaction(interaction: discord.Interaction, user: discord.M
 
 # Command 4: Configure annoyance methods (message, reaction, both)
 @bot.tree.command(name="setannoyancemethods", description="Configure which annoyance methods to use for a user.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
 @app_commands.describe(
     user="The target user.",
     messages="Whether to use text messages to annoy them.",
@@ -274,7 +813,7 @@ async def setannoyancemethods(
     messages: bool,
     reactions: bool
 ):
-    if user.id not in target_settings_cache:
+    if await get_guild_target(interaction.guild_id, user.id) is None:
         await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
         return
 
@@ -288,9 +827,9 @@ async def setannoyancemethods(
         await interaction.response.send_message("You must enable at least one annoyance method (messages or reactions).", ephemeral=True)
         return
 
-    success = db.update_annoy_methods(user.id, methods_to_use)
+    success = await db.update_annoy_methods(interaction.guild_id, user.id, methods_to_use)
     if success:
-        target_settings_cache[user.id]['annoy_methods'] = methods_to_use
+        update_cached_target(interaction.guild_id, user.id, annoy_methods=methods_to_use)
         await interaction.response.send_message(
             f"Successfully set annoyance methods for {user.mention}: {', '.join(methods_to_use)}"
         )
@@ -302,6 +841,7 @@ async def setannoyancemethods(
 
 # Command 5: Toggle message mode (specific, random, both)
 @bot.tree.command(name="setmessagemode", description="Configure how text messages are chosen for a user.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
 @app_commands.describe(
     user="The target user.",
     mode="Choose how messages are selected."
@@ -312,13 +852,13 @@ async def setannoyancemethods(
     app_commands.Choice(name="Both Specific and Random", value="both"),
 ])
 async def setmessagemode(interaction: discord.Interaction, user: discord.Member, mode: app_commands.Choice[str]):
-    if user.id not in target_settings_cache:
+    if await get_guild_target(interaction.guild_id, user.id) is None:
         await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
         return
 
-    success = db.update_message_mode(user.id, mode.value)
+    success = await db.update_message_mode(interaction.guild_id, user.id, mode.value)
     if success:
-        target_settings_cache[user.id]['message_mode'] = mode.value
+        update_cached_target(interaction.guild_id, user.id, message_mode=mode.value)
         await interaction.response.send_message(
             f"Successfully set message mode for {user.mention} to '{mode.name}'."
         )
@@ -327,55 +867,484 @@ async def setmessagemode(interaction: discord.Interaction, user: discord.Member,
             f"Failed to update message mode for {user.mention}. Check bot logs.", ephemeral=True
         )
 
+# Weight one specific message or reaction so it's picked more or less often
+@bot.tree.command(name="setannoyanceweight", description="Change how often one specific message or reaction is picked.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    user="The target user.",
+    kind="Whether the item is a message or a reaction.",
+    item="The exact message or emoji.",
+    weight="Relative weight; 2 is picked twice as often as 1, 0 never."
+)
+@app_commands.choices(kind=[
+    app_commands.Choice(name="Message", value="message"),
+    app_commands.Choice(name="Reaction", value="reaction"),
+])
+async def setannoyanceweight(
+    interaction: discord.Interaction,
+    user: discord.Member,
+    kind: app_commands.Choice[str],
+    item: str,
+    weight: app_commands.Range[float, 0, 1000]
+):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    item = item.strip()
+    if kind.value == 'message':
+        items_key, weights_key = 'specific_reply', 'reply_weights'
+        success = await db.set_reply_weight(interaction.guild_id, user.id, item, weight)
+    else:
+        items_key, weights_key = 'specific_reaction', 'reaction_weights'
+        success = await db.set_reaction_weight(interaction.guild_id, user.id, item, weight)
+    if success:
+        settings = target_settings_cache[interaction.guild_id][user.id]
+        update_cached_target(interaction.guild_id, user.id, **{
+            weights_key: [weight if existing == item else old for existing, old in zip(settings[items_key], settings[weights_key])]
+        })
+        await interaction.response.send_message(f"Set the weight of that {kind.name.lower()} for {user.mention} to {weight:g}.")
+    else:
+        await interaction.response.send_message(
+            f"{user.mention} has no specific {kind.name.lower()} matching that text.", ephemeral=True
+        )
+
+# Pick weighted at random, or go through every message/reaction before repeating one
+@bot.tree.command(name="setselectionmode", description="Configure whether messages and reactions can repeat back to back.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(user="The target user.", mode="How the next message or reaction is picked.")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="Weighted Random", value="weighted"),
+    app_commands.Choice(name="Shuffle (no repeats until all are used)", value="shuffle"),
+])
+async def setselectionmode(interaction: discord.Interaction, user: discord.Member, mode: app_commands.Choice[str]):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    success = await db.update_selection_mode(interaction.guild_id, user.id, mode.value)
+    if success:
+        update_cached_target(interaction.guild_id, user.id, selection_mode=mode.value)
+        await interaction.response.send_message(
+            f"Successfully set selection mode for {user.mention} to '{mode.name}'."
+        )
+    else:
+        await interaction.response.send_message(
+            f"Failed to update selection mode for {user.mention}. Check bot logs.", ephemeral=True
+        )
+
+# Several reactions (plus a reply, if messages are enabled) on each triggering message
+@bot.tree.command(name="setannoyanceburst", description="Annoy a user with several reactions at once.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    user="The target user.",
+    size="Reactions per message; above 1, a reply is sent too if messages are enabled. 1 = a single reply or reaction."
+)
+async def setannoyanceburst(interaction: discord.Interaction, user: discord.Member, size: app_commands.Range[int, 1, MAX_BURST_SIZE]):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    success = await db.update_burst_size(interaction.guild_id, user.id, size)
+    if success:
+        update_cached_target(interaction.guild_id, user.id, burst_size=size)
+        await interaction.response.send_message(
+            f"Successfully set the burst size for {user.mention} to {size}."
+            if size > 1 else f"{user.mention} will get a single reply or reaction per message again."
+        )
+    else:
+        await interaction.response.send_message(
+            f"Failed to update the burst size for {user.mention}. Check bot logs.", ephemeral=True
+        )
+
+# Command 6: Limit how often a target gets annoyed
+@bot.tree.command(name="setannoyancelimits", description="Limit how often a user gets annoyed.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    user="The target user.",
+    cooldown_seconds="Minimum seconds between annoyances (0 = no cooldown).",
+    probability="Chance from 0 to 1 that a message gets annoyed at all.",
+    max_actions="Maximum annoyances per window (0 = unlimited).",
+    window_seconds="Length of the window for max_actions, in seconds."
+)
+async def setannoyancelimits(
+    interaction: discord.Interaction,
+    user: discord.Member,
+    cooldown_seconds: app_commands.Range[float, 0, 86400] = 0.0,
+    probability: app_commands.Range[float, 0, 1] = 1.0,
+    max_actions: app_commands.Range[int, 0, 1000] = 0,
+    window_seconds: app_commands.Range[float, 1, 86400] = 60.0
+):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
+
+    success = await db.update_trigger_limits(interaction.guild_id, user.id, cooldown_seconds, probability, max_actions, window_seconds)
+    if success:
+        update_cached_target(
+            interaction.guild_id, user.id,
+            cooldown_seconds=cooldown_seconds,
+            trigger_probability=probability,
+            max_actions=max_actions,
+            action_window_seconds=window_seconds
+        )
+        await interaction.response.send_message(
+            f"Successfully set annoyance limits for {user.mention}: {format_limits(target_settings_cache[interaction.guild_id][user.id])}"
+        )
+    else:
+        await interaction.response.send_message(
+            f"Failed to update annoyance limits for {user.mention}. Check bot logs.", ephemeral=True
+        )
+
+
 @bot.tree.command(name="removetarget", description="Stop annoying a user.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
 @app_commands.describe(user="The user to stop annoying.")
 async def removetarget(interaction: discord.Interaction, user: discord.Member):
-    success = db.remove_target(user.id)
+    success = await db.remove_target(interaction.guild_id, user.id)
     if success:
-        if user.id in target_settings_cache:
-            del target_settings_cache[user.id]
-        await interaction.response.send_message(f"Successfully removed {user.mention} from annoyance targets.")
+        uncache_target(interaction.guild_id, user.id)
+        # Their schedules went with them
+        scheduler.reset()
+    # A legacy target applies in this server too, so it has to go as well to stop the annoyances
+    legacy = get_cached_settings(LEGACY_GUILD_ID, user.id) is not None and await db.remove_target(LEGACY_GUILD_ID, user.id)
+    if legacy:
+        uncache_target(LEGACY_GUILD_ID, user.id)
+    if success or legacy:
+        note = " This included their target from before targets were per server, which applied in every server." if legacy else ""
+        await interaction.response.send_message(f"Successfully removed {user.mention} from annoyance targets.{note}")
     else:
         await interaction.response.send_message(
             f"{user.mention} was not found in the annoyance targets.",
             ephemeral=True
         )
 
-@bot.tree.command(name="listtargets", description="List all users currently being annoyed and their settings.", guild=MY_GUILD if MY_GUILD else None)
+# Largest attachment /importtargets will read
+MAX_IMPORT_BYTES = 5 * 1024 * 1024
+
+@bot.tree.command(name="importtargets", description="Add or update many targets at once from a CSV or JSON file.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(file="A .csv or .json file in the format produced by /exporttargets.")
+async def importtargets(interaction: discord.Interaction, file: discord.Attachment):
+    if file.size > MAX_IMPORT_BYTES:
+        await interaction.response.send_message(f"The file is too large (max {MAX_IMPORT_BYTES // (1024 * 1024)} MB).", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+
+    try:
+        targets = parse_targets(file.filename, await file.read())
+    except TargetImportError as e:
+        await interaction.followup.send(f"Could not import `{file.filename}`: {e}", ephemeral=True)
+        return
+    if not targets:
+        await interaction.followup.send(f"`{file.filename}` does not contain any targets.", ephemeral=True)
+        return
+
+    written = await db.bulk_upsert(interaction.guild_id, targets)
+    if written < 0:
+        await interaction.followup.send("Failed to import targets. Nothing was changed. Check bot logs.", ephemeral=True)
+        return
+    # One partition reload instead of one cache update per row
+    await load_guild_targets([interaction.guild_id])
+    await interaction.followup.send(f"Imported {written} target(s) from `{file.filename}`.", ephemeral=True)
+
+@bot.tree.command(name="exporttargets", description="Download this server's targets as a CSV or JSON file.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(file_format="The file format to export.")
+@app_commands.choices(file_format=[
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="JSON", value="json"),
+])
+async def exporttargets(interaction: discord.Interaction, file_format: str = "json"):
+    guild_targets = targets_in_guild(interaction.guild_id)
+    if not guild_targets:
+        await interaction.response.send_message("No users are currently being annoyed.", ephemeral=True)
+        return
+    data = export_targets(guild_targets, file_format)
+    await interaction.response.send_message(
+        f"Exported {len(guild_targets)} target(s).",
+        file=discord.File(BytesIO(data), filename=f"targets.{file_format}"),
+        ephemeral=True
+    )
+
+@bot.tree.command(name="listtargets", description="List all users currently being annoyed in this server and their settings.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
 async def listtargets(interaction: discord.Interaction):
-    targets_data = db.get_all_targets()
-    if not targets_data:
+    guild_targets = targets_in_guild(interaction.guild_id)
+    if not guild_targets:
         await interaction.response.send_message("No users are currently being annoyed.", ephemeral=True)
         return
 
-    target_list_str = "Currently annoying the following users:\n"
-    for user_id, settings in targets_data.items():
-        try:
-            user = await bot.fetch_user(user_id)
-            user_name = user.display_name
-        except discord.NotFound:
-            user_name = f"Unknown User ({user_id})"
+    # Only the first page's names are resolved now; later pages resolve on demand
+    await interaction.response.defer(ephemeral=True)
+    own_targets = target_settings_cache.get(interaction.guild_id, {})
+    legacy_ids = {user_id for user_id in guild_targets if user_id not in own_targets}
+    view = TargetListView(
+        interaction.user.id, interaction.guild, guild_targets, user_name_cache, format_limits, legacy_ids
+    )
+    await interaction.followup.send(embed=await view.render(bot), view=view, ephemeral=True)
+
+
+# Content rules: answer what someone says, not just who they are
+@bot.tree.command(name="addtriggerrule", description="Reply or react when someone says a keyword or matches a regex.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    pattern="The keyword (matched as a whole word, any case) or regex to look for.",
+    response="The reply text, or the emoji to react with.",
+    action="Whether to reply or react.",
+    user="Only trigger for this user (default: anyone in the server).",
+    regex="Treat the pattern as a regular expression."
+)
+@app_commands.choices(action=[
+    app_commands.Choice(name="Reply", value="reply"),
+    app_commands.Choice(name="Reaction", value="reaction"),
+])
+async def addtriggerrule(
+    interaction: discord.Interaction,
+    pattern: str,
+    response: app_commands.Range[str, 1, 2000],
+    action: str = "reply",
+    user: Optional[discord.Member] = None,
+    regex: bool = False
+):
+    error = validate_pattern(pattern, regex)
+    matcher = rule_matchers.get(interaction.guild_id)
+    if error is None and regex and matcher is not None and matcher.regex_count >= MAX_REGEX_RULES:
+        error = f"This server already has {MAX_REGEX_RULES} regex rules, the most it can have. Remove one or use a keyword rule."
+    if error is None and action not in RULE_ACTIONS:
+        error = "Unknown action."
+    response = response.strip()
+    if error is None and action == 'reaction' and not is_emoji(response):
+        error = "The response for a reaction rule must be a single emoji."
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+
+    rule_id = await db.add_trigger_rule(
+        interaction.guild_id, user.id if user else None, pattern if regex else pattern.strip(), regex, action, response
+    )
+    if rule_id is None:
+        await interaction.response.send_message("Failed to add the rule. Check bot logs.", ephemeral=True)
+        return
+    await load_guild_rules([interaction.guild_id])
+    who = user.mention if user else "anyone"
+    await interaction.response.send_message(f"Added rule #{rule_id}: {action} when {who} says `{pattern}`.")
+
+@bot.tree.command(name="removetriggerrule", description="Remove a content rule.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(rule_id="The rule number shown by /listtriggerrules.")
+async def removetriggerrule(interaction: discord.Interaction, rule_id: int):
+    if await db.remove_trigger_rule(interaction.guild_id, rule_id):
+        await load_guild_rules([interaction.guild_id])
+        await interaction.response.send_message(f"Removed rule #{rule_id}.")
+    else:
+        await interaction.response.send_message(f"This server has no rule #{rule_id}.", ephemeral=True)
+
+@bot.tree.command(name="listtriggerrules", description="List this server's content rules.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+async def listtriggerrules(interaction: discord.Interaction):
+    rules = (await db.get_trigger_rules([interaction.guild_id])).get(interaction.guild_id, [])
+    if not rules:
+        await interaction.response.send_message("This server has no content rules. Add one with `/addtriggerrule`.", ephemeral=True)
+        return
+    lines = []
+    for rule in rules:
+        who = f"<@{rule['user_id']}>" if rule['user_id'] is not None else "anyone"
+        kind = "matches regex" if rule['is_regex'] else "says"
+        lines.append(f"#{rule['id']}: {rule['action']} `{rule['payload'][:50]}` when {who} {kind} `{rule['pattern'][:50]}`")
+    # Stay under the 4096-character embed description limit
+    description = ""
+    for shown, line in enumerate(lines):
+        if len(description) + len(line) > 3900:
+            description += f"…and {len(lines) - shown} more"
+            break
+        description += line + "\n"
+    embed = discord.Embed(title=f"Content rules ({len(rules)})", description=description, colour=discord.Colour.orange())
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+def parse_schedule_time(text: str) -> Optional[float]:
+    """Parses 'YYYY-MM-DD HH:MM' (UTC unless an offset is given) into Unix time."""
+    try:
+        when = datetime.fromisoformat(text.strip())
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+@bot.tree.command(name="scheduleannoyance", description="Ping a target in a channel on a schedule, or once at a set time.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(
+    user="The target user.",
+    channel="Where to post.",
+    message="What to post after pinging them.",
+    every_minutes="Repeat this often. Leave empty for a one-off.",
+    in_minutes="First (or only) run this many minutes from now.",
+    at="First (or only) run at this time, as YYYY-MM-DD HH:MM in UTC."
+)
+async def scheduleannoyance(
+    interaction: discord.Interaction,
+    user: discord.Member,
+    channel: discord.TextChannel,
+    message: app_commands.Range[str, 1, 1800],
+    every_minutes: Optional[app_commands.Range[float, MIN_INTERVAL_SECONDS / 60, 525600.0]] = None,
+    in_minutes: Optional[app_commands.Range[float, 0.0, 525600.0]] = None,
+    at: Optional[str] = None
+):
+    if await get_guild_target(interaction.guild_id, user.id) is None:
+        await interaction.response.send_message(f"{user.mention} is not an annoyance target. Use `/settarget` first.", ephemeral=True)
+        return
 
-        specific_replies_str = ", ".join(f"'{m}'" for m in settings['specific_reply']) if settings['specific_reply'] else 'None'
-        specific_reactions_str = ", ".join(settings['specific_reaction']) if settings['specific_reaction'] else 'None'
+    now = time.time()
+    interval = every_minutes * 60 if every_minutes is not None else None
+    if at is not None:
+        next_run = parse_schedule_time(at)
+        if next_run is None or next_run <= now:
+            await interaction.response.send_message("`at` must be a future time like `2030-01-31 18:00` (UTC).", ephemeral=True)
+            return
+    elif in_minutes is not None:
+        next_run = now + in_minutes * 60
+    elif interval is not None:
+        next_run = now + interval
+    else:
+        await interaction.response.send_message(
+            "Give `every_minutes` for a repeating schedule, or `in_minutes`/`at` for a one-off.", ephemeral=True
+        )
+        return
+    if await db.count_schedules(interaction.guild_id) >= MAX_SCHEDULES_PER_GUILD:
+        await interaction.response.send_message(
+            f"This server already has {MAX_SCHEDULES_PER_GUILD} schedules. Remove some with `/removeschedule` first.", ephemeral=True
+        )
+        return
 
+    message = message.strip()
+    schedule_id = await db.add_schedule(interaction.guild_id, channel.id, user.id, message, interval, next_run)
+    if schedule_id is None:
+        await interaction.response.send_message("Failed to add the schedule. Check bot logs.", ephemeral=True)
+        return
+    scheduler.add(ScheduledJob(schedule_id, interaction.guild_id, channel.id, user.id, message, interval, next_run))
+    repeat = f", then every {every_minutes:g} minute(s)" if interval is not None else ""
+    await interaction.response.send_message(
+        f"Added schedule #{schedule_id}: {user.mention} in {channel.mention} <t:{int(next_run)}:R>{repeat}."
+    )
 
-        target_list_str += (
-            f"\n- **{user_name}** (`{user_id}`)\n"
-            f"  - Specific Messages: {specific_replies_str}\n"
-            f"  - Specific Reactions: {specific_reactions_str}\n"
-            f"  - Annoy Methods: {', '.join(settings['annoy_methods']) or 'None'}\n"
-            f"  - Message Mode: {settings['message_mode']}\n"
+@bot.tree.command(name="removeschedule", description="Remove a scheduled annoyance.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(schedule_id="The schedule number shown by /listschedules.")
+async def removeschedule(interaction: discord.Interaction, schedule_id: int):
+    if await db.remove_schedule(interaction.guild_id, schedule_id):
+        scheduler.discard(schedule_id)
+        await interaction.response.send_message(f"Removed schedule #{schedule_id}.")
+    else:
+        await interaction.response.send_message(f"This server has no pending schedule #{schedule_id}.", ephemeral=True)
+
+@bot.tree.command(name="listschedules", description="List this server's scheduled annoyances.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+async def listschedules(interaction: discord.Interaction):
+    schedules = await db.get_schedules(interaction.guild_id)
+    if not schedules:
+        await interaction.response.send_message("This server has no schedules. Add one with `/scheduleannoyance`.", ephemeral=True)
+        return
+    lines = []
+    for schedule in schedules:
+        repeat = f"every {schedule['interval_seconds'] / 60:g} min" if schedule['interval_seconds'] else "once"
+        lines.append(
+            f"#{schedule['id']}: <@{schedule['user_id']}> in <#{schedule['channel_id']}> {repeat}, "
+            f"next <t:{int(schedule['next_run'])}:R> `{schedule['message'][:50]}`"
+        )
+    # Stay under the 4096-character embed description limit
+    description = ""
+    for shown, line in enumerate(lines):
+        if len(description) + len(line) > 3900:
+            description += f"…and {len(lines) - shown} more"
+            break
+        description += line + "\n"
+    embed = discord.Embed(title=f"Scheduled annoyances ({len(schedules)})", description=description, colour=discord.Colour.orange())
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="annoystats", description="Show what the bot has been doing in this server.", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.guild_only()
+@app_commands.describe(user="Only count this target.", hours="How many hours back to look (default 24).")
+async def annoystats(
+    interaction: discord.Interaction,
+    user: Optional[discord.Member] = None,
+    hours: app_commands.Range[int, 1, 2160] = 24
+):
+    since_hour = int(time.time() // 3600) - hours + 1
+    stats = await db.get_event_stats(interaction.guild_id, since_hour, user.id if user else None)
+    if stats is None:
+        await interaction.response.send_message("Failed to read annoyance stats. Check bot logs.", ephemeral=True)
+        return
+
+    scope = f"for {user.display_name} " if user else ""
+    embed = discord.Embed(title=f"Annoyances {scope}in the last {hours}h", colour=discord.Colour.orange())
+    if not stats["outcomes"]:
+        embed.description = "Nothing yet."
+    for method in ('reply', 'reaction'):
+        rows = [row for row in stats["outcomes"] if row[0] == method]
+        if not rows:
+            continue
+        total = sum(count for _, _, count, _, _ in rows)
+        latency_sum = sum(latency for _, _, _, latency, _ in rows)
+        lines = [f"{outcome}: {count}" for _, outcome, count, _, _ in rows]
+        lines.append(f"Avg latency: {latency_sum / total * 1000:.0f} ms, max {max(row[4] for row in rows) * 1000:.0f} ms")
+        embed.add_field(name=f"{method.capitalize()}s ({total})", value="\n".join(lines), inline=True)
+    if stats["top_targets"] and user is None:
+        embed.add_field(
+            name="Most annoyed",
+            value="\n".join(f"<@{user_id}>: {count}" for user_id, count in stats["top_targets"]),
+            inline=False
         )
-    if len(target_list_str) > 2000:
-        target_list_str = target_list_str[:1900] + "\n... (truncated)"
-    await interaction.response.send_message(target_list_str, ephemeral=True)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="dbmaintenance", description="Back up, check or tidy the bot's database (bot owner only).", guild=MY_GUILD if MY_GUILD else None)
+@app_commands.default_permissions(administrator=True)
+@app_commands.describe(task="What to run. Status shows the last result of each task.")
+@app_commands.choices(task=[
+    app_commands.Choice(name="Status", value="status"),
+    app_commands.Choice(name="Backup", value="backup"),
+    app_commands.Choice(name="Quick check", value="check"),
+    app_commands.Choice(name="Full integrity check", value="integrity"),
+    app_commands.Choice(name="Optimize", value="optimize"),
+    app_commands.Choice(name="Incremental vacuum", value="vacuum"),
+    app_commands.Choice(name="Rebuild (full VACUUM, pauses writes)", value="rebuild"),
+])
+async def dbmaintenance(interaction: discord.Interaction, task: str = "status"):
+    # The database is shared by every server, so server admins aren't enough
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot's owner can run database maintenance.", ephemeral=True)
+        return
+    if task == "status":
+        lines = format_status(maintenance, await db.page_stats())
+        await interaction.response.send_message("\n".join(lines) or "No maintenance has run yet.", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    job = asyncio.create_task(maintenance.run(task))
+    # Progress is shown by editing the response until the task is done
+    while not job.done():
+        await asyncio.wait({job}, timeout=2.0)
+        if not job.done():
+            # Names the other task while this one waits its turn
+            await interaction.edit_original_response(content=format_progress(maintenance) or f"Starting **{task}**…")
+    result = job.result()
+    mark = "✅" if result.ok else "❌"
+    await interaction.edit_original_response(content=f"{mark} **{task}** took {result.seconds:.1f}s: {result.detail}")
 
 
 # --- Run the bot --- #
 if __name__ == '__main__':
     try:
-        bot.run(DISCORD_TOKEN)
+        # Logging is already configured above, so stop discord.py installing its own handler
+        bot.run(DISCORD_TOKEN, log_handler=None)
     except Exception as e:
-        print(f"Failed to start Discord bot: {e}")
-        print("Please ensure your DISCORD_BOT_TOKEN is correct and has 'Message Content Intent' enabled.")
+        log.error("Failed to start Discord bot: %s", e)
+        log.error("Please ensure your DISCORD_BOT_TOKEN is correct and has 'Message Content Intent' enabled.")
+    finally:
+        # After bot.run returns nothing touches the cache anymore
+        write_snapshot()
+        db.close()
+        log_listener.stop()
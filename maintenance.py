@@ -0,0 +1,264 @@
+# maintenance.py
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Everything run() accepts, in the order /dbmaintenance lists them
+MAINTENANCE_TASKS = ('backup', 'check', 'integrity', 'optimize', 'vacuum', 'rebuild')
+# What a scheduled run does; integrity and rebuild are slow enough to be left to an admin
+SCHEDULED_TASKS = ('backup', 'check', 'optimize', 'vacuum')
+
+# bot_state key holding when the last scheduled run started
+_LAST_RUN_KEY = 'maintenance_last_run'
+
+
+class TaskResult(NamedTuple):
+    task: str
+    ok: bool
+    started: float  # Unix time
+    seconds: float
+    detail: str
+
+
+class DatabaseMaintenance:
+    """Backs up, checks and tidies the database on a schedule, without blocking the bot.
+
+    Every `interval` seconds it runs SCHEDULED_TASKS one after another:
+    - backup: an online backup into backup_dir, step_pages pages per step,
+      keeping the newest `keep` files. Skipped when backup_dir is empty.
+    - check: PRAGMA quick_check.
+    - optimize: PRAGMA optimize.
+    - vacuum: frees unused pages with incremental vacuum, vacuum_pages per step.
+
+    Backups and checks run on the database's maintenance thread and
+    connection, so neither the writer nor the reader waits for them. optimize
+    and vacuum need the write lock, so they go through the writer thread in
+    short steps and regular writes queue between them.
+
+    The time of the last run is kept in bot_state, so a restart doesn't
+    reset the schedule, and processes sharing the database take turns
+    rather than each running it. run() starts one task right away, for
+    /dbmaintenance. Only one task runs at a time.
+    """
+
+    def __init__(
+        self,
+        db,
+        interval: float = 86400.0,
+        backup_dir: str = '',
+        keep: int = 7,
+        step_pages: int = 256,
+        step_pause: float = 0.005,
+        vacuum_pages: int = 1000,
+    ):
+        self.db = db
+        self.interval = interval
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.step_pages = step_pages
+        self.step_pause = step_pause
+        self.vacuum_pages = vacuum_pages
+
+        self.results: Dict[str, TaskResult] = {}
+        # The task running now, when it started and its (done, total) steps, if it reports any
+        self.current: Optional[str] = None
+        self.current_started = 0.0
+        self.progress: Optional[Tuple[int, int]] = None
+        self.next_run: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def start(self):
+        """Starts the schedule. Must be called from inside the running loop; does nothing if interval is 0."""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run_schedule())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self, task: str) -> TaskResult:
+        """Runs one maintenance task, after any that is already running. SQLite and file errors end up in the result."""
+        if task not in MAINTENANCE_TASKS:
+            raise ValueError(f"Unknown maintenance task: {task}")
+        async with self._lock:
+            self.current = task
+            self.current_started = time.time()
+            self.progress = None
+            started = time.perf_counter()
+            try:
+                ok, detail = await getattr(self, f'_{task}')()
+            except (sqlite3.Error, OSError) as e:
+                ok, detail = False, str(e)
+            finally:
+                self.current = None
+                self.progress = None
+            result = TaskResult(task, ok, self.current_started, time.perf_counter() - started, detail)
+            self.results[task] = result
+        if ok:
+            log.info("Database %s finished in %.1fs: %s", task, result.seconds, detail)
+        else:
+            log.error("Database %s failed after %.1fs: %s", task, result.seconds, detail)
+        return result
+
+    def _set_progress(self, remaining: int, total: int):
+        # Called from the maintenance thread; replacing the tuple is atomic
+        self.progress = (total - remaining, total)
+
+    async def _backup(self) -> Tuple[bool, str]:
+        if not self.backup_dir:
+            return False, "No backup directory is configured (BACKUP_DIR)."
+        os.makedirs(self.backup_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.db.db_name))[0]
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.backup_dir, f"{base}-{stamp}.db")
+        suffix = 1
+        while os.path.exists(path):
+            # Two backups within a second
+            path = os.path.join(self.backup_dir, f"{base}-{stamp}-{suffix}.db")
+            suffix += 1
+        # Written under another name first, so a backup that didn't finish never looks like one
+        partial = path + '.partial'
+        try:
+            pages = await self.db.backup_to(partial, self.step_pages, self.step_pause, self._set_progress)
+            os.replace(partial, path)
+        except BaseException:
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            raise
+        removed = self._prune_backups(base)
+        detail = f"{pages} pages ({os.path.getsize(path) / 1e6:.1f} MB) to {path}"
+        if removed:
+            detail += f", removed {removed} old backup(s)"
+        return True, detail
+
+    def _prune_backups(self, base: str) -> int:
+        backups = sorted(
+            (name for name in os.listdir(self.backup_dir) if name.startswith(f"{base}-") and name.endswith('.db')),
+            key=lambda name: os.path.getmtime(os.path.join(self.backup_dir, name))
+        )
+        removed = 0
+        for name in backups[:max(0, len(backups) - self.keep)]:
+            try:
+                os.remove(os.path.join(self.backup_dir, name))
+                removed += 1
+            except OSError as e:
+                log.warning("Could not remove old backup %s: %s", name, e)
+        return removed
+
+    async def _check_pages(self, quick: bool) -> Tuple[bool, str]:
+        problems = await self.db.integrity_check(quick)
+        if problems == ['ok']:
+            return True, "ok"
+        return False, "; ".join(problems[:5]) + (f" (and {len(problems) - 5} more)" if len(problems) > 5 else "")
+
+    async def _check(self) -> Tuple[bool, str]:
+        return await self._check_pages(True)
+
+    async def _integrity(self) -> Tuple[bool, str]:
+        return await self._check_pages(False)
+
+    async def _optimize(self) -> Tuple[bool, str]:
+        await self.db.optimize()
+        return True, "Statistics refreshed where stale."
+
+    async def _vacuum(self) -> Tuple[bool, str]:
+        stats = await self.db.page_stats()
+        free = stats['freelist_count']
+        if stats['auto_vacuum'] != 2:
+            return True, f"Skipped: incremental vacuum is off for this database ({free} free pages). Run rebuild once to turn it on."
+        initial = free
+        while free > 0:
+            self.progress = (initial - free, initial)
+            left = await self.db.incremental_vacuum(self.vacuum_pages)
+            if left >= free:
+                break
+            free = left
+        freed = initial - free
+        return True, f"Freed {freed} of {initial} free pages ({freed * stats['page_size'] / 1e6:.1f} MB)."
+
+    async def _rebuild(self) -> Tuple[bool, str]:
+        before = await self.db.page_stats()
+        await self.db.vacuum()
+        after = await self.db.page_stats()
+        return True, f"Rebuilt: {before['page_count']} -> {after['page_count']} pages, incremental vacuum on."
+
+    async def _claim_run(self) -> float:
+        """Returns how long until the next scheduled run is due, claiming it if that's now."""
+        last = await self.db.get_state(_LAST_RUN_KEY)
+        now = time.time()
+        if last is None:
+            # A new database (or first start with maintenance) waits one interval
+            await self.db.set_state(_LAST_RUN_KEY, repr(now))
+            self.next_run = now + self.interval
+            return self.interval
+        self.next_run = float(last) + self.interval
+        if self.next_run > now:
+            return self.next_run - now
+        # Claimed before running, so another process checking meanwhile waits its turn
+        await self.db.set_state(_LAST_RUN_KEY, repr(now))
+        self.next_run = now + self.interval
+        return 0.0
+
+    async def _run_schedule(self):
+        while True:
+            try:
+                wait = await self._claim_run()
+                if wait <= 0:
+                    for task in SCHEDULED_TASKS:
+                        if task == 'backup' and not self.backup_dir:
+                            continue
+                        await self.run(task)
+                    continue
+            except Exception:
+                log.exception("Scheduled database maintenance failed")
+                wait = 300.0
+            # Capped so a schedule another process moved is picked up reasonably soon
+            await asyncio.sleep(min(wait, 3600.0))
+
+
+def format_progress(maintenance: DatabaseMaintenance) -> Optional[str]:
+    """What is running, for how long and how far along, or None if nothing is."""
+    if maintenance.current is None:
+        return None
+    line = f"Running **{maintenance.current}** for {time.time() - maintenance.current_started:.1f}s"
+    if maintenance.progress is not None and maintenance.progress[1]:
+        done, total = maintenance.progress
+        line += f": {done}/{total} pages ({done / total:.0%})"
+    return line
+
+
+def format_status(maintenance: DatabaseMaintenance, stats: Optional[Dict[str, int]]) -> List[str]:
+    """Lines describing the running task, the last result of each task and the file, for /dbmaintenance."""
+    lines = []
+    progress = format_progress(maintenance)
+    if progress is not None:
+        lines.append(progress)
+    for task in MAINTENANCE_TASKS:
+        result = maintenance.results.get(task)
+        if result is not None:
+            when = datetime.fromtimestamp(result.started, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+            mark = "✅" if result.ok else "❌"
+            lines.append(f"{mark} **{task}** {when}, {result.seconds:.1f}s: {result.detail}")
+    if stats is not None:
+        lines.append(
+            f"Database: {stats['page_count'] * stats['page_size'] / 1e6:.1f} MB, {stats['freelist_count']} free pages, "
+            f"incremental vacuum {'on' if stats['auto_vacuum'] == 2 else 'off'}"
+        )
+    if maintenance.next_run is not None:
+        lines.append(f"Next scheduled run: <t:{int(maintenance.next_run)}:R>")
+    return lines
@@ -0,0 +1,74 @@
+# message_template.py
+from string import Formatter
+from typing import NamedTuple, Optional, Sequence, Tuple, Union
+
+# Placeholders a reply may use, in the order render() takes their values
+PLACEHOLDERS = ('user', 'channel', 'count', 'time')
+
+_formatter = Formatter()
+
+
+class MessageTemplate(NamedTuple):
+    """A reply with placeholders, parsed once into literal text and slot numbers.
+
+    Rendering just joins the pieces, filling each slot with values[slot], so
+    nothing is parsed per message.
+    """
+    source: str
+    # Literal strings and indexes into PLACEHOLDERS
+    pieces: Tuple[Union[str, int], ...]
+
+    def render(self, values: Sequence[str]) -> str:
+        return ''.join(piece if piece.__class__ is str else values[piece] for piece in self.pieces)
+
+
+class TemplateError(ValueError):
+    """Raised for a reply that can't be compiled; the message is shown to the user."""
+
+
+def _parse(text: str) -> Tuple[Union[str, int], ...]:
+    try:
+        parsed = list(_formatter.parse(text))
+    except ValueError:
+        raise TemplateError("Unmatched brace. Write {{ and }} for literal braces.") from None
+    pieces = []
+    for literal, field, spec, conversion in parsed:
+        if literal:
+            pieces.append(literal)
+        if field is None:
+            continue
+        if field not in PLACEHOLDERS:
+            raise TemplateError(f"Unknown placeholder {{{field}}}. Use {', '.join(f'{{{p}}}' for p in PLACEHOLDERS)}.")
+        if spec or conversion:
+            raise TemplateError(f"Placeholder {{{field}}} can't have a format spec or conversion.")
+        pieces.append(PLACEHOLDERS.index(field))
+    return tuple(pieces)
+
+
+def validate_template(text: str) -> Optional[str]:
+    """Returns why the reply can't be used as a template, or None if it's fine."""
+    if '{' not in text and '}' not in text:
+        return None
+    try:
+        _parse(text)
+    except TemplateError as e:
+        return str(e)
+    return None
+
+
+def compile_template(text: str) -> Union[str, MessageTemplate]:
+    """Compiles a reply into a MessageTemplate, or returns it unchanged if it has no placeholders.
+
+    Replies saved before templates existed may contain stray braces; those
+    are sent as they are rather than dropped.
+    """
+    if '{' not in text and '}' not in text:
+        return text
+    try:
+        pieces = _parse(text)
+    except TemplateError:
+        return text
+    if all(piece.__class__ is str for piece in pieces):
+        # Only escaped braces
+        return ''.join(pieces)
+    return MessageTemplate(text, pieces)
@@ -0,0 +1,234 @@
+# metrics.py
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from tens of microseconds (cache lookups) up to the
+# multi-second tail of a rate-limited REST call
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Version 0.0.4 of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+# What a gauge callback may return: one value, or {label values: value}
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float('inf'):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """Monotonic counter, optionally split by a fixed set of labels."""
+    __slots__ = ('name', 'help', 'labels', '_values')
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, values)} {_format_value(value)}"
+            for values, value in sorted(self._values.items())
+        ]
+
+
+class Histogram:
+    """Fixed-bucket histogram. observe() is one bisect and three additions."""
+    __slots__ = ('name', 'help', 'labels', 'buckets', '_series')
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = []
+        for values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackGauge:
+    """Gauge whose value is read from a callback at scrape time."""
+    __slots__ = ('name', 'help', 'labels', 'callback')
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, callback: Callable[[], GaugeValue], labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        value = self.callback()
+        if not isinstance(value, dict):
+            return [f"{self.name} {_format_value(value)}"]
+        return [
+            f"{self.name}{_format_labels(self.labels, values)} {_format_value(amount)}"
+            for values, amount in sorted(value.items())
+        ]
+
+
+class CallbackCounter(CallbackGauge):
+    """Counter kept by some other component (e.g. a counters dict), read at scrape time."""
+    __slots__ = ()
+    kind = 'counter'
+
+
+class MetricsRegistry:
+    """Holds every metric and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], GaugeValue], labels: Tuple[str, ...] = ()) -> CallbackGauge:
+        return self._register(CallbackGauge(name, help, callback, labels))
+
+    def counter_callback(self, name: str, help: str, callback: Callable[[], GaugeValue], labels: Tuple[str, ...] = ()) -> CallbackCounter:
+        return self._register(CallbackCounter(name, help, callback, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # One broken callback shouldn't take the whole scrape down
+                lines.append(f"# {metric.name} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class RateLimitLogCounter(logging.Filter):
+    """Counts the 429s discord.py handles internally, by watching its log records.
+
+    discord.py retries rate-limited requests itself and only logs a warning, so
+    this is the only place those 429s are visible.
+    """
+
+    def __init__(self, counter: Counter):
+        super().__init__()
+        self.counter = counter
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.msg if isinstance(record.msg, str) else ""
+        if message.startswith('We are being rate limited'):
+            self.counter.inc('route')
+        elif message.startswith('Global rate limit has been hit'):
+            self.counter.inc('global')
+        return True
+
+
+async def monitor_loop_lag(histogram: Histogram, interval: float = 0.5):
+    """Records how late the event loop wakes up a task that asked to sleep `interval`."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+class MetricsServer:
+    """Serves /metrics from a small aiohttp app on the bot's own event loop."""
+
+    def __init__(self, registry: MetricsRegistry, host: str = '127.0.0.1', port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def sum_partitions(partitions: Dict[int, Dict[int, object]]) -> float:
+    return float(sum(len(partition) for partition in partitions.values()))
+
+
+def label_counters(counters: Dict[str, int]) -> Dict[LabelValues, float]:
+    """Turns a {name: count} dict into gauge samples keyed by a single label."""
+    return {(name,): float(value) for name, value in counters.items()}
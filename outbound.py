@@ -0,0 +1,311 @@
+# outbound.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, NamedTuple, Optional, Tuple
+
+import discord
+
+from logging_setup import PER_MESSAGE
+from metrics import Histogram, MetricsRegistry, label_counters
+
+log = logging.getLogger(__name__)
+
+# What to do when the pending queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+
+# Kind of an action that carries several replies/reactions for one message
+BURST = 'burst'
+# Kind of a scheduled message posted to a channel; its "message" is a scheduler.ScheduledPost
+POST = 'post'
+# Scheduled posts may ping their target, but never @everyone or a role
+POST_MENTIONS = discord.AllowedMentions(everyone=False, roles=False, users=True)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token will be available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class OutboundAction(NamedTuple):
+    kind: str  # 'reply', 'reaction', BURST or POST
+    message: Any  # The discord.Message being annoyed; anything with guild/channel/author for a POST
+    payload: Any  # Reply text or emoji; (kind, payload) pairs for a burst
+    enqueued_at: float
+
+
+class OutboundScheduler:
+    """Central queue for every reply and reaction the bot sends.
+
+    Actions are keyed by (channel_id, kind), so a burst of messages in a
+    channel coalesces into one pending action, the newest. Workers drain the
+    queue under a global token bucket and per-channel buckets. Actions are
+    dropped instead of sent when they are stale or their channel is over
+    budget, so a spamming target never turns into a backlog of 429 retries.
+
+    If on_result is set, it is called with (action, outcome, seconds since
+    submit) for every action a worker sends or drops. Actions coalesced or
+    rejected in submit() never reach a worker and are only counted.
+
+    A burst (see submit_burst) is queued, coalesced and budgeted per channel
+    as one action, but its replies and reactions are sent concurrently, at
+    most burst_concurrency at a time, and each gets its own outcome.
+    """
+
+    def __init__(
+        self,
+        max_pending: int = 1000,
+        global_rate: float = 40.0,
+        global_burst: float = 50.0,
+        channel_rate: float = 1.0,
+        channel_burst: float = 5.0,
+        max_age: float = 10.0,
+        policy: str = DROP_OLDEST,
+        workers: int = 4,
+        report_interval: float = 60.0,
+        burst_concurrency: int = 4,
+    ):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.max_pending = max_pending
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_age = max_age
+        self.policy = policy
+        self.worker_count = workers
+        self.report_interval = report_interval
+        self.burst_concurrency = burst_concurrency
+
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._channel_buckets: Dict[int, TokenBucket] = {}
+        self._order: Deque[Tuple[int, str]] = deque()
+        self._pending: Dict[Tuple[int, str], OutboundAction] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = []
+        self._queue_latency: Optional[Histogram] = None
+        self._send_latency: Optional[Histogram] = None
+        self._burst_latency: Optional[Histogram] = None
+        self.on_result: Optional[Callable[[OutboundAction, str, float], None]] = None
+
+        self.counters: Dict[str, int] = dict.fromkeys((
+            'submitted', 'coalesced', 'sent', 'dropped_full', 'dropped_stale',
+            'dropped_over_budget', 'rate_limited', 'forbidden', 'failed',
+        ), 0)
+
+    def register_metrics(self, registry: MetricsRegistry):
+        """Exports the counters, queue depth and per-action latencies through registry."""
+        self._queue_latency = registry.histogram(
+            'annoy_outbound_queue_seconds', 'Time an action waited between submit and send.', ('kind',)
+        )
+        self._send_latency = registry.histogram(
+            'annoy_outbound_send_seconds', 'Duration of the reply/reaction REST call.', ('kind', 'result')
+        )
+        self._burst_latency = registry.histogram(
+            'annoy_outbound_burst_seconds', 'Time to send every action of a burst concurrently.'
+        )
+        registry.counter_callback(
+            'annoy_outbound_actions_total', 'Outbound actions by outcome.', lambda: label_counters(self.counters), ('outcome',)
+        )
+        registry.gauge('annoy_outbound_pending', 'Actions waiting to be sent.', lambda: self.pending)
+        registry.gauge('annoy_outbound_channel_buckets', 'Channels with a live token bucket.', lambda: len(self._channel_buckets))
+
+    def submit(self, kind: str, message: Any, payload: Any, key: Optional[Tuple[int, str]] = None) -> bool:
+        """Queues an action without blocking. Returns False if it was rejected.
+
+        Actions with the same key coalesce; by default that's (channel_id, kind).
+        """
+        self.counters['submitted'] += 1
+        if key is None:
+            key = (message.channel.id, kind)
+        action = OutboundAction(kind, message, payload, time.monotonic())
+
+        if key in self._pending:
+            # Only the newest action per channel and kind is worth sending
+            self._pending[key] = action
+            self.counters['coalesced'] += 1
+            return True
+
+        if len(self._pending) >= self.max_pending:
+            self.counters['dropped_full'] += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            del self._pending[self._order.popleft()]
+
+        self._pending[key] = action
+        self._order.append(key)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def submit_burst(self, message: Any, actions: Tuple[Tuple[str, str], ...]) -> bool:
+        """Queues several (kind, payload) actions on one message, to be sent concurrently."""
+        return self.submit(BURST, message, actions)
+
+    def submit_post(self, post: Any, text: str, schedule_id: int) -> bool:
+        """Queues a scheduled post. Only runs of the same schedule coalesce, not every post in the channel."""
+        return self.submit(POST, post, text, key=(post.channel.id, f"{POST}:{schedule_id}"))
+
+    def start(self):
+        """Starts the worker tasks. Must be called from inside the running loop."""
+        if self._tasks:
+            return
+        # Created here rather than in __init__ so it binds to the running loop
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        if self.report_interval > 0:
+            self._tasks.append(asyncio.create_task(self._reporter()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _channel_bucket(self, channel_id: int) -> TokenBucket:
+        bucket = self._channel_buckets.get(channel_id)
+        if bucket is None:
+            bucket = self._channel_buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+        return bucket
+
+    async def _next_action(self) -> OutboundAction:
+        while not self._order:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        return self._pending.pop(self._order.popleft())
+
+    async def _worker(self):
+        while True:
+            action = await self._next_action()
+            now = time.monotonic()
+
+            if now - action.enqueued_at > self.max_age:
+                self._finish_all(action, 'dropped_stale', now)
+                continue
+            if not self._channel_bucket(action.message.channel.id).try_take(now):
+                self._finish_all(action, 'dropped_over_budget', now)
+                continue
+
+            if action.kind == BURST:
+                await self._send_burst(action)
+            else:
+                await self._take_global()
+                await self._send(action)
+
+    async def _take_global(self):
+        # The global budget is shared by every channel, so wait for it instead of dropping
+        while not self._global_bucket.try_take(time.monotonic()):
+            await asyncio.sleep(self._global_bucket.wait_time(time.monotonic()))
+
+    @staticmethod
+    def _parts(action: OutboundAction) -> Tuple[OutboundAction, ...]:
+        if action.kind != BURST:
+            return (action,)
+        return tuple(OutboundAction(kind, action.message, payload, action.enqueued_at) for kind, payload in action.payload)
+
+    async def _send_burst(self, action: OutboundAction):
+        """Sends a burst's actions concurrently, so it takes about as long as its slowest call.
+
+        Each part succeeds or fails on its own: a Forbidden on the reactions
+        doesn't stop the reply, and vice versa.
+        """
+        semaphore = asyncio.Semaphore(self.burst_concurrency)
+
+        async def send_part(part: OutboundAction):
+            async with semaphore:
+                await self._take_global()
+                await self._send(part)
+
+        started = time.monotonic()
+        await asyncio.gather(*(send_part(part) for part in self._parts(action)))
+        if self._burst_latency is not None:
+            self._burst_latency.observe(time.monotonic() - started)
+
+    async def _send(self, action: OutboundAction):
+        started = time.monotonic()
+        if self._queue_latency is not None:
+            self._queue_latency.observe(started - action.enqueued_at, action.kind)
+        outcome = await self._deliver(action)
+        finished = time.monotonic()
+        self._finish(action, outcome, finished)
+        if self._send_latency is not None:
+            self._send_latency.observe(finished - started, action.kind, outcome)
+
+    def _finish_all(self, action: OutboundAction, outcome: str, now: float):
+        for part in self._parts(action):
+            self._finish(part, outcome, now)
+
+    def _finish(self, action: OutboundAction, outcome: str, now: float):
+        self.counters[outcome] += 1
+        if self.on_result is not None:
+            try:
+                self.on_result(action, outcome, now - action.enqueued_at)
+            except Exception:
+                log.exception("Outbound result callback failed")
+
+    async def _deliver(self, action: OutboundAction) -> str:
+        """Sends one action and returns the counter its outcome falls under."""
+        message = action.message
+        fields = {**PER_MESSAGE, 'kind': action.kind, 'channel_id': message.channel.id, 'user_id': message.author.id}
+        try:
+            if action.kind == 'reply':
+                await message.reply(action.payload)
+            elif action.kind == POST:
+                await message.channel.send(action.payload, allowed_mentions=POST_MENTIONS)
+            else:
+                await message.add_reaction(action.payload)
+            log.info("Annoyed %s in #%s with a %s", message.author.display_name, message.channel.name, action.kind, extra=fields)
+            return 'sent'
+        except discord.Forbidden:
+            log.warning("Lacked permissions to %s in #%s", action.kind, message.channel.name, extra=fields)
+            return 'forbidden'
+        except discord.HTTPException as e:
+            log.warning("Sending a %s failed: %s", action.kind, e, extra=fields)
+            return 'rate_limited' if e.status == 429 else 'failed'
+        except Exception:
+            log.exception("Unexpected error sending a %s", action.kind, extra=fields)
+            return 'failed'
+
+    def _prune_buckets(self, now: float):
+        # A bucket that has refilled completely carries no state worth keeping
+        idle = [channel_id for channel_id, bucket in self._channel_buckets.items()
+                if bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity]
+        for channel_id in idle:
+            del self._channel_buckets[channel_id]
+
+    async def _reporter(self):
+        last: Optional[Dict[str, int]] = None
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self._prune_buckets(time.monotonic())
+            if self.counters != last:
+                last = dict(self.counters)
+                summary = ", ".join(f"{name}={value}" for name, value in last.items())
+                log.info("Outbound: %s, pending=%s", summary, self.pending, extra={**last, 'pending': self.pending})
@@ -0,0 +1,226 @@
+# scheduler.py
+import asyncio
+import heapq
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Shortest repeat interval a schedule may use
+MIN_INTERVAL_SECONDS = 60.0
+# Pending schedules one guild may have
+MAX_SCHEDULES_PER_GUILD = 500
+
+# Sorts after every real id, for a read position that covers a whole instant
+_LAST_ID = 2**63 - 1
+
+
+class ScheduledJob(NamedTuple):
+    id: int
+    guild_id: int
+    channel_id: int
+    user_id: int
+    message: str
+    interval: Optional[float]  # Seconds between runs; None for a one-off
+    next_run: float  # Unix time
+
+
+class ScheduledUser(NamedTuple):
+    """Stands in for the pinged member when they aren't in the member cache."""
+    id: int
+    display_name: str
+
+
+class ScheduledPost(NamedTuple):
+    """Takes the place of the triggering message in a scheduled post's outbound action."""
+    guild: Any
+    channel: Any
+    author: Any  # The pinged member, or a ScheduledUser
+
+
+def next_slot(job: ScheduledJob, now: float) -> Optional[float]:
+    """The first run time after now on the job's interval grid, or None for a one-off.
+
+    Skipping straight past every missed slot is what keeps a job that fell
+    behind (a slow loop, downtime) from firing several times to catch up.
+    """
+    if job.interval is None:
+        return None
+    missed = max(0, math.floor((now - job.next_run) / job.interval) + 1)
+    return job.next_run + missed * job.interval
+
+
+class AnnoyanceScheduler:
+    """Runs every scheduled annoyance from one task, off a min-heap of due times.
+
+    Only jobs due within `horizon` seconds are held in memory. They are read
+    from the next_run index in (next_run, id) order, at most `batch` at a
+    time, and the read position only moves forward, so tens of thousands of
+    schedules cost one indexed range query every horizon / 2 seconds. A job
+    rescheduled past the read position is dropped from memory and read
+    again when the window gets there.
+
+    Jobs more than `grace` seconds overdue when read (after downtime, say)
+    are not run: recurring ones skip to their next slot and one-offs are
+    marked done. reset() rereads everything from the start, e.g. after the
+    served guilds changed or another process edited the schedules.
+
+    fire(job) is called for each due job; it must not block.
+    """
+
+    def __init__(
+        self,
+        db,
+        fire: Callable[[ScheduledJob], None],
+        guild_ids: Callable[[], Iterable[int]],
+        horizon: float = 300.0,
+        batch: int = 2000,
+        grace: float = 300.0,
+    ):
+        self.db = db
+        self.fire = fire
+        self.guild_ids = guild_ids
+        self.horizon = horizon
+        self.batch = batch
+        self.grace = grace
+
+        self._heap: List[Tuple[float, int]] = []
+        self._jobs: Dict[int, ScheduledJob] = {}
+        # (next_run, id) of the last job read; every pending job up to it is in _jobs
+        self._position: Tuple[float, int] = (0.0, 0)
+        # True while the last read stopped at the batch limit rather than the horizon
+        self._truncated = False
+        self._reset = True
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.counters: Dict[str, int] = dict.fromkeys(('fired', 'skipped_missed', 'failed'), 0)
+
+    @property
+    def loaded(self) -> int:
+        return len(self._jobs)
+
+    def start(self):
+        """Starts the scheduler task. Must be called from inside the running loop."""
+        if self._task is None:
+            # Created here rather than in __init__ so it binds to the running loop
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def reset(self):
+        """Forgets every loaded job and rereads them on the next turn."""
+        self._reset = True
+        self._wake()
+
+    def add(self, job: ScheduledJob):
+        """Picks up a job this process just created, if it falls inside the loaded window."""
+        if (job.next_run, job.id) <= self._position and not self._reset:
+            self._push(job)
+            self._wake()
+
+    def discard(self, job_id: int):
+        # Its heap entry is skipped once it no longer matches a loaded job
+        self._jobs.pop(job_id, None)
+
+    def _push(self, job: ScheduledJob):
+        if self._jobs.get(job.id) == job:
+            # Both read and add()ed when its creation raced a read
+            return
+        self._jobs[job.id] = job
+        heapq.heappush(self._heap, (job.next_run, job.id))
+
+    def _needs_read(self, now: float) -> bool:
+        if self._truncated:
+            return len(self._jobs) <= self.batch // 2
+        return self._position[0] <= now + self.horizon / 2
+
+    async def _read(self, now: float):
+        until = now + self.horizon
+        limit = self.batch - len(self._jobs)
+        rows = await self.db.get_due_schedules(self._position, until, self.guild_ids(), limit) if limit > 0 else []
+        self._truncated = limit <= 0 or len(rows) == limit
+        if rows:
+            self._position = (rows[-1][6], rows[-1][0])
+        if not self._truncated:
+            self._position = (until, _LAST_ID)
+
+        missed: List[Tuple[Optional[float], int]] = []
+        for row in rows:
+            job = ScheduledJob(*row)
+            if job.next_run < now - self.grace:
+                next_run = next_slot(job, now)
+                missed.append((next_run, job.id))
+                self.counters['skipped_missed'] += 1
+                if next_run is None or (next_run, job.id) > self._position:
+                    continue
+                job = job._replace(next_run=next_run)
+            self._push(job)
+        if missed:
+            log.info("Skipped %s scheduled annoyance(s) that were overdue by more than %ss", len(missed), self.grace)
+            await self.db.reschedule(missed)
+
+    async def _fire_due(self, now: float):
+        runs: List[Tuple[Optional[float], int]] = []
+        while self._heap and self._heap[0][0] <= now:
+            next_run, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.next_run != next_run:
+                # Discarded or reset since it was pushed
+                continue
+            try:
+                self.fire(job)
+                self.counters['fired'] += 1
+            except Exception:
+                self.counters['failed'] += 1
+                log.exception("Scheduled annoyance %s failed", job.id)
+            following = next_slot(job, now)
+            runs.append((following, job.id))
+            if following is not None and (following, job.id) <= self._position:
+                self._push(job._replace(next_run=following))
+            else:
+                del self._jobs[job.id]
+        if runs:
+            await self.db.reschedule(runs)
+
+    def _sleep_time(self, now: float) -> float:
+        wait = self.horizon / 2
+        if self._heap:
+            wait = min(wait, self._heap[0][0] - now)
+        if not self._truncated:
+            wait = min(wait, self._position[0] - self.horizon / 2 - now)
+        return max(wait, 0.0)
+
+    async def _run(self):
+        while True:
+            # Cleared before the turn, so a wake-up during it leads straight to another
+            self._wakeup.clear()
+            try:
+                if self._reset:
+                    self._reset = False
+                    self._heap.clear()
+                    self._jobs.clear()
+                    self._position = (0.0, 0)
+                    self._truncated = False
+                now = time.time()
+                if self._needs_read(now):
+                    await self._read(now)
+                await self._fire_due(time.time())
+                wait = self._sleep_time(time.time())
+            except Exception:
+                log.exception("Scheduler turn failed")
+                wait = 5.0
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
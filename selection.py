@@ -0,0 +1,133 @@
+# selection.py
+import random
+from array import array
+from math import gcd
+from typing import Optional, Sequence, Tuple, Union
+
+SELECTION_MODES = ('weighted', 'shuffle')
+
+
+class UniformPicker:
+    """Picks any item with equal probability."""
+    __slots__ = ('items',)
+    mode = 'weighted'
+
+    def __init__(self, items: Tuple[str, ...]):
+        self.items = items
+
+    def pick(self) -> str:
+        return random.choice(self.items)
+
+
+class AliasPicker:
+    """Picks items in proportion to their weights in O(1), using Vose's alias method.
+
+    Building the table is O(n); each pick then costs one random() call, an
+    index and a comparison, however many items there are.
+    """
+    __slots__ = ('items', 'weights', '_probability', '_alias')
+    mode = 'weighted'
+
+    def __init__(self, items: Tuple[str, ...], weights: Tuple[float, ...]):
+        self.items = items
+        self.weights = weights
+        count = len(items)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        probability = array('d', [1.0] * count)
+        alias = array('l', range(count))
+        small = [i for i, value in enumerate(scaled) if value < 1]
+        large = [i for i, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left is 1 up to rounding error and keeps its defaults
+        self._probability = probability
+        self._alias = alias
+
+    def pick(self) -> str:
+        position = random.random() * len(self.items)
+        index = int(position)
+        if position - index >= self._probability[index]:
+            index = self._alias[index]
+        return self.items[index]
+
+
+class ShuffleBag:
+    """Cycles through every item once, in a shuffled order, before repeating any.
+
+    Rather than storing a shuffled copy of the items, each cycle walks the
+    permutation k -> (step * k + offset) mod n with step coprime to n, so the
+    per-target state is three integers. The next cycle never starts with the
+    item the previous one ended on. Weights other than 0 are ignored in this mode.
+    """
+    __slots__ = ('items', '_step', '_offset', '_cursor', '_last')
+    mode = 'shuffle'
+
+    def __init__(self, items: Tuple[str, ...]):
+        self.items = items
+        self._cursor = len(items)
+        self._last = -1
+        self._step = 1
+        self._offset = 0
+
+    def _new_cycle(self):
+        count = len(self.items)
+        step = random.randrange(1, count) if count > 2 else 1
+        while gcd(step, count) != 1:
+            step = random.randrange(1, count)
+        offset = random.randrange(count)
+        if offset == self._last and count > 1:
+            offset = (offset + 1) % count
+        self._step = step
+        self._offset = offset
+        self._cursor = 0
+
+    def pick(self) -> str:
+        count = len(self.items)
+        if self._cursor >= count:
+            self._new_cycle()
+        index = (self._step * self._cursor + self._offset) % count
+        self._cursor += 1
+        self._last = index
+        return self.items[index]
+
+
+Picker = Union[UniformPicker, AliasPicker, ShuffleBag]
+
+
+def build_picker(
+    items: Tuple[str, ...],
+    weights: Optional[Sequence[float]] = None,
+    mode: str = 'weighted',
+    previous: Optional[Picker] = None
+) -> Optional[Picker]:
+    """Builds the picker for a pool, or returns None if the pool is empty.
+
+    Items weighted 0 are never picked, in either mode, so a pool whose
+    weights are all 0 counts as empty. The previous picker is reused when the
+    pool, weights and mode are unchanged, so a shuffle bag keeps its place
+    when another setting is edited.
+    """
+    weights = tuple(weights) if weights is not None else ()
+    if weights and not all(weights):
+        kept = [(item, weight) for item, weight in zip(items, weights) if weight > 0]
+        items = tuple(item for item, _ in kept)
+        weights = tuple(weight for _, weight in kept)
+    if not items:
+        return None
+    if mode == 'shuffle':
+        if previous is not None and previous.mode == 'shuffle' and previous.items == items:
+            return previous
+        return ShuffleBag(items)
+
+    if not weights or all(weight == weights[0] for weight in weights):
+        if isinstance(previous, UniformPicker) and previous.items == items:
+            return previous
+        return UniformPicker(items)
+    if isinstance(previous, AliasPicker) and previous.items == items and previous.weights == weights:
+        return previous
+    return AliasPicker(items, weights)
@@ -0,0 +1,121 @@
+# startup.py
+import gc
+import hashlib
+import json
+import logging
+import marshal
+import os
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from discord import app_commands
+
+from database import flags_to_methods, methods_to_flags
+
+log = logging.getLogger(__name__)
+
+# Bump when the snapshot layout changes; older files are then ignored
+SNAPSHOT_FORMAT = 3
+
+# Stored after (guild_id, user_id, method flags, replies, reactions, reply weights, reaction weights) in every row
+_SCALAR_FIELDS = (
+    "message_mode", "cooldown_seconds", "trigger_probability", "max_actions", "action_window_seconds",
+    "selection_mode", "burst_size",
+)
+
+
+@contextmanager
+def gc_paused():
+    """Pauses the cyclic GC while bulk-building long-lived objects.
+
+    Building 100k+ settings dicts would otherwise trigger a collection every
+    few hundred targets, roughly doubling the load time.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def command_tree_hash(tree: app_commands.CommandTree, guild: Optional[Any] = None) -> str:
+    """SHA-256 of the payload tree.sync() would send for the given scope."""
+    payload = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    payload.sort(key=lambda command: (command.get('type', 1), command['name']))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class Snapshot(NamedTuple):
+    instance_id: str
+    # target_changes seq the snapshot is current up to
+    change_seq: int
+    # Every guild partition that was loaded, including ones with no targets
+    guild_ids: Tuple[int, ...]
+    targets: Dict[int, Dict[int, Dict[str, Any]]]
+
+
+def save_snapshot(
+    path: str,
+    instance_id: str,
+    change_seq: int,
+    guild_ids: Iterable[int],
+    targets: Dict[int, Dict[int, Dict[str, Any]]],
+):
+    """Writes the target cache to path as flat marshal tuples, atomically."""
+    rows = tuple(
+        (guild_id, user_id, methods_to_flags(settings["annoy_methods"]),
+         tuple(settings["specific_reply"]), tuple(settings["specific_reaction"]),
+         tuple(settings["reply_weights"]), tuple(settings["reaction_weights"]))
+        + tuple(settings[field] for field in _SCALAR_FIELDS)
+        for guild_id, guild_targets in targets.items()
+        for user_id, settings in guild_targets.items()
+    )
+    data = marshal.dumps((SNAPSHOT_FORMAT, instance_id, change_seq, tuple(guild_ids), rows))
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def load_snapshot(path: str) -> Optional[Snapshot]:
+    """Reads a snapshot written by save_snapshot, or returns None if it's missing or unusable."""
+    try:
+        with open(path, 'rb') as f, gc_paused():
+            fmt, instance_id, change_seq, guild_ids, rows = marshal.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        log.warning("Ignoring unreadable cache snapshot %s: %s", path, e)
+        return None
+    if fmt != SNAPSHOT_FORMAT:
+        log.info("Ignoring cache snapshot in old format %s", fmt)
+        return None
+
+    targets: Dict[int, Dict[int, Dict[str, Any]]] = {guild_id: {} for guild_id in guild_ids}
+    methods_by_flags: Dict[int, List[str]] = {}
+    with gc_paused():
+        for (guild_id, user_id, flags, replies, reactions, reply_weights, reaction_weights,
+             mode, cooldown, probability, max_actions, window, selection_mode, burst_size) in rows:
+            methods = methods_by_flags.get(flags)
+            if methods is None:
+                methods = methods_by_flags[flags] = flags_to_methods(flags)
+            guild_targets = targets.get(guild_id)
+            if guild_targets is None:
+                guild_targets = targets[guild_id] = {}
+            guild_targets[user_id] = {
+                "specific_reply": list(replies),
+                "specific_reaction": list(reactions),
+                "reply_weights": list(reply_weights),
+                "reaction_weights": list(reaction_weights),
+                "annoy_methods": list(methods),
+                "message_mode": mode,
+                "cooldown_seconds": cooldown,
+                "trigger_probability": probability,
+                "max_actions": max_actions,
+                "action_window_seconds": window,
+                "selection_mode": selection_mode,
+                "burst_size": burst_size,
+            }
+    return Snapshot(instance_id, change_seq, tuple(guild_ids), targets)
@@ -0,0 +1,159 @@
+# target_io.py
+import csv
+import json
+from io import StringIO
+from typing import Any, Dict, List
+
+from emoji_index import is_emoji
+from message_template import validate_template
+from selection import SELECTION_MODES
+from target_settings import MESSAGE_MODES
+
+# Columns used by both the CSV and JSON formats, in export order
+TARGET_FIELDS = (
+    "user_id", "specific_reply", "specific_reaction", "annoy_methods", "message_mode",
+    "cooldown_seconds", "trigger_probability", "max_actions", "action_window_seconds",
+    "reply_weights", "reaction_weights", "selection_mode", "burst_size",
+)
+ANNOY_METHODS = ('message', 'reaction')
+# Largest burst_size /setannoyanceburst and imports accept
+MAX_BURST_SIZE = 10
+
+
+class TargetImportError(ValueError):
+    """Raised when an import file can't be parsed; the message is shown to the user."""
+
+
+def _as_list(value: Any, separator: str) -> List[str]:
+    # CSV cells may hold a JSON array (what export writes) or a plain separated list
+    if value is None or value == "":
+        return []
+    if isinstance(value, list):
+        items = value
+    elif isinstance(value, str) and value.lstrip().startswith('['):
+        try:
+            items = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise TargetImportError(f"Invalid JSON list {value!r}: {e}")
+    else:
+        items = str(value).split(separator)
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+def _as_weights(value: Any, count: int, field: str, line: int) -> List[float]:
+    # Missing weights default to 1 so files exported before weights existed still import
+    raw = _as_list(value, ',')
+    if not raw:
+        return [1.0] * count
+    try:
+        weights = [float(weight) for weight in raw]
+    except ValueError:
+        raise TargetImportError(f"Entry {line}: {field} must be numbers.")
+    if len(weights) != count or any(weight < 0 for weight in weights):
+        raise TargetImportError(f"Entry {line}: {field} needs one non-negative weight per item.")
+    return weights
+
+
+def normalize_target(record: Dict[str, Any], line: int) -> Dict[str, Any]:
+    """Validates one imported record and fills in defaults."""
+    try:
+        user_id = int(record["user_id"])
+    except (KeyError, TypeError, ValueError):
+        raise TargetImportError(f"Entry {line}: missing or invalid user_id.")
+
+    methods = _as_list(record.get("annoy_methods") or "message,reaction", ',')
+    if not methods or any(method not in ANNOY_METHODS for method in methods):
+        raise TargetImportError(f"Entry {line}: annoy_methods must be 'message' and/or 'reaction'.")
+
+    mode = record.get("message_mode") or 'both'
+    if mode not in MESSAGE_MODES:
+        raise TargetImportError(f"Entry {line}: message_mode must be one of {', '.join(MESSAGE_MODES)}.")
+
+    selection_mode = record.get("selection_mode") or 'weighted'
+    if selection_mode not in SELECTION_MODES:
+        raise TargetImportError(f"Entry {line}: selection_mode must be one of {', '.join(SELECTION_MODES)}.")
+
+    try:
+        cooldown = float(record.get("cooldown_seconds") or 0)
+        probability = record.get("trigger_probability")
+        probability = 1.0 if probability in (None, "") else float(probability)
+        max_actions = int(record.get("max_actions") or 0)
+        window = float(record.get("action_window_seconds") or 60)
+        burst_size = int(record.get("burst_size") or 1)
+    except (TypeError, ValueError):
+        raise TargetImportError(f"Entry {line}: limits must be numbers.")
+    if cooldown < 0 or not 0 <= probability <= 1 or max_actions < 0 or window <= 0 or not 1 <= burst_size <= MAX_BURST_SIZE:
+        raise TargetImportError(f"Entry {line}: limits are out of range.")
+
+    reactions = _as_list(record.get("specific_reaction"), ',')
+    invalid = [reaction for reaction in reactions if not is_emoji(reaction)]
+    if invalid:
+        raise TargetImportError(f"Entry {line}: not a valid emoji: {', '.join(invalid)}")
+
+    replies = _as_list(record.get("specific_reply"), ';')
+    for reply in replies:
+        error = validate_template(reply)
+        if error:
+            raise TargetImportError(f"Entry {line}: invalid message {reply!r}: {error}")
+    return {
+        "user_id": user_id,
+        "specific_reply": replies,
+        "specific_reaction": reactions,
+        "annoy_methods": methods,
+        "message_mode": mode,
+        "cooldown_seconds": cooldown,
+        "trigger_probability": probability,
+        "max_actions": max_actions,
+        "action_window_seconds": window,
+        "reply_weights": _as_weights(record.get("reply_weights"), len(replies), "reply_weights", line),
+        "reaction_weights": _as_weights(record.get("reaction_weights"), len(reactions), "reaction_weights", line),
+        "selection_mode": selection_mode,
+        "burst_size": burst_size,
+    }
+
+
+def parse_targets(filename: str, data: bytes) -> List[Dict[str, Any]]:
+    """Parses a .json or .csv import file into normalized target records."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise TargetImportError("The file must be UTF-8 encoded.")
+
+    if filename.lower().endswith('.json'):
+        try:
+            records = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise TargetImportError(f"Invalid JSON: {e}")
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            raise TargetImportError("The JSON file must contain a list of target objects.")
+    elif filename.lower().endswith('.csv'):
+        reader = csv.DictReader(StringIO(text))
+        if not reader.fieldnames or "user_id" not in reader.fieldnames:
+            raise TargetImportError("The CSV file needs a header row with at least a user_id column.")
+        records = list(reader)
+    else:
+        raise TargetImportError("Only .csv and .json files are supported.")
+
+    return [normalize_target(record, line) for line, record in enumerate(records, start=1)]
+
+
+def export_targets(targets: Dict[int, Dict[str, Any]], fmt: str) -> bytes:
+    """Serializes {user_id: settings} to CSV or JSON bytes that parse_targets accepts."""
+    rows = []
+    for user_id, settings in targets.items():
+        row = {field: settings.get(field) for field in TARGET_FIELDS}
+        row["user_id"] = user_id
+        rows.append(row)
+
+    if fmt == 'json':
+        return json.dumps(rows, ensure_ascii=False, indent=2).encode('utf-8')
+
+    out = StringIO()
+    writer = csv.DictWriter(out, fieldnames=TARGET_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        for field in ("specific_reply", "specific_reaction", "reply_weights", "reaction_weights"):
+            row[field] = json.dumps(row[field] or [], ensure_ascii=False)
+        row["annoy_methods"] = ','.join(row["annoy_methods"] or [])
+        writer.writerow(row)
+    return out.getvalue().encode('utf-8')
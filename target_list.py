@@ -0,0 +1,188 @@
+# target_list.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Collection, Dict, List, Optional, Sequence
+
+import discord
+
+PAGE_SIZE = 10
+# Discord rejects embed field values longer than this
+FIELD_VALUE_LIMIT = 1024
+
+
+class NameCache:
+    """Small LRU cache of user display names with a per-entry TTL."""
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[str]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return name
+
+    def put(self, user_id: int, name: str):
+        self._entries[user_id] = (name, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+async def resolve_names(
+    client: discord.Client,
+    guild: Optional[discord.Guild],
+    user_ids: Sequence[int],
+    cache: NameCache,
+    concurrency: int = 5
+) -> Dict[int, str]:
+    """Resolves display names for one page of users.
+
+    Tries the guild member cache and the name cache first. Only the misses hit
+    the REST API, at most `concurrency` requests at a time.
+    """
+    names: Dict[int, str] = {}
+    missing: List[int] = []
+    for user_id in user_ids:
+        member = guild.get_member(user_id) if guild is not None else None
+        name = member.display_name if member is not None else cache.get(user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(user_id: int):
+        async with semaphore:
+            try:
+                user = await client.fetch_user(user_id)
+            except discord.NotFound:
+                names[user_id] = f"Unknown User ({user_id})"
+                return
+            except discord.HTTPException:
+                # Don't cache transient failures
+                names[user_id] = f"User {user_id}"
+                return
+        names[user_id] = user.display_name
+        cache.put(user_id, user.display_name)
+
+    await asyncio.gather(*(fetch(user_id) for user_id in missing))
+    return names
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _weighted_list(items: Sequence[str], weights: Optional[Sequence[float]]) -> str:
+    # Only weights other than the default 1 are shown
+    return ", ".join(
+        item if weight == 1 else f"{item} (×{weight:g})" for item, weight in zip(items, weights or [1.0] * len(items))
+    )
+
+
+def build_page_embed(
+    user_ids: Sequence[int],
+    targets: Dict[int, Dict[str, Any]],
+    names: Dict[int, str],
+    page: int,
+    page_count: int,
+    format_limits: Callable[[Dict[str, Any]], str],
+    legacy_ids: Collection[int] = ()
+) -> discord.Embed:
+    embed = discord.Embed(title="Annoyance targets", colour=discord.Colour.orange())
+    for user_id in user_ids:
+        settings = targets.get(user_id)
+        if settings is None:
+            # Removed since the listing was opened
+            continue
+        specific_replies_str = _weighted_list(
+            [f"'{m}'" for m in settings['specific_reply']], settings.get('reply_weights')
+        ) or 'None'
+        specific_reactions_str = _weighted_list(settings['specific_reaction'], settings.get('reaction_weights')) or 'None'
+        # Clip the free-form lists so a full page stays under the 6000-character embed limit
+        value = (
+            f"Specific Messages: {_clip(specific_replies_str, 240)}\n"
+            f"Specific Reactions: {_clip(specific_reactions_str, 120)}\n"
+            f"Annoy Methods: {', '.join(settings['annoy_methods']) or 'None'}\n"
+            f"Message Mode: {settings['message_mode']}\n"
+            f"Selection: {settings.get('selection_mode', 'weighted')}, burst {settings.get('burst_size', 1)}\n"
+            f"Limits: {format_limits(settings)}"
+        )
+        embed.add_field(
+            # Legacy targets come from before targets were per server and still apply in all of them
+            name=_clip(f"{names.get(user_id, user_id)} ({user_id}){' · every server' if user_id in legacy_ids else ''}", 256),
+            value=_clip(value, FIELD_VALUE_LIMIT),
+            inline=False
+        )
+    embed.set_footer(text=f"Page {page + 1} of {page_count} · {len(targets)} target(s)")
+    return embed
+
+
+class TargetListView(discord.ui.View):
+    """Previous/next buttons over a snapshot of a guild's target ids."""
+
+    def __init__(
+        self,
+        owner_id: int,
+        guild: Optional[discord.Guild],
+        targets: Dict[int, Dict[str, Any]],
+        name_cache: NameCache,
+        format_limits: Callable[[Dict[str, Any]], str],
+        legacy_ids: Collection[int] = ()
+    ):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.guild = guild
+        self.targets = targets
+        self.user_ids = sorted(targets)
+        self.name_cache = name_cache
+        self.format_limits = format_limits
+        self.legacy_ids = legacy_ids
+        self.page = 0
+        self.page_count = max(1, -(-len(self.user_ids) // PAGE_SIZE))
+        self._update_buttons()
+
+    async def render(self, client: discord.Client) -> discord.Embed:
+        page_ids = self.user_ids[self.page * PAGE_SIZE:(self.page + 1) * PAGE_SIZE]
+        names = await resolve_names(client, self.guild, page_ids, self.name_cache)
+        return build_page_embed(
+            page_ids, self.targets, names, self.page, self.page_count, self.format_limits, self.legacy_ids
+        )
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("Run `/listtargets` yourself to browse the list.", ephemeral=True)
+            return False
+        return True
+
+    async def _turn(self, interaction: discord.Interaction, step: int):
+        self.page = min(max(self.page + step, 0), self.page_count - 1)
+        self._update_buttons()
+        # Name lookups can miss the cache, so acknowledge before resolving them
+        await interaction.response.defer()
+        await interaction.edit_original_response(embed=await self.render(interaction.client), view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, -1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, 1)
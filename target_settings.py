@@ -0,0 +1,179 @@
+# target_settings.py
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+from database import flags_to_methods, methods_to_flags
+from selection import SELECTION_MODES
+
+MESSAGE_MODES = ('specific_only', 'random_only', 'both')
+
+# Every key a settings dict from AnnoyanceDB carries, in its order
+SETTINGS_KEYS = (
+    "specific_reply", "specific_reaction", "reply_weights", "reaction_weights", "annoy_methods", "message_mode",
+    "cooldown_seconds", "trigger_probability", "max_actions", "action_window_seconds", "selection_mode", "burst_size",
+)
+
+
+class Interner:
+    """Hands out one shared object per distinct value, so equal values across targets are stored once.
+
+    Every entry is keyed by a kind as well as the value, since values of
+    different kinds can compare equal (5 == 5.0, or a reply list that looks
+    like another kind's key) without being interchangeable.
+
+    Bounded by clearing the table when it fills up. Objects handed out before
+    stay valid and shared; only values interned afterwards stop sharing with
+    them, which is much cheaper than tracking what is still referenced.
+    """
+
+    def __init__(self, max_size: int = 65536):
+        self.max_size = max_size
+        self._values: Dict[Hashable, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def intern(self, kind: str, value: Hashable) -> Any:
+        return self.shared(kind, value, lambda: value)
+
+    def shared(self, kind: str, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Returns the object of this kind stored under key, creating it with factory the first time."""
+        value = self._values.get((kind, key))
+        if value is None:
+            if len(self._values) >= self.max_size:
+                self._values.clear()
+            value = self._values[(kind, key)] = factory()
+        return value
+
+
+# Shared by the settings cache and compiled plans
+shared_values = Interner()
+
+
+def _weights(weights: Optional[Sequence[float]], count: int) -> Optional[Tuple[float, ...]]:
+    # None stands for "all 1", which nearly every target is
+    if not weights or all(weight == 1 for weight in weights):
+        return None
+    return shared_values.intern('weights', tuple(float(weight) for weight in weights[:count]))
+
+
+class TargetSettings:
+    """One target's settings as held in the cache: immutable, slotted and mostly shared.
+
+    Reply/reaction tuples, weights and limits are interned, so targets with
+    the same configuration point at the same objects. Methods and modes are
+    stored as small ints and only decoded to lists and strings when read.
+
+    Supports settings['key'] and settings.get('key') with the same keys as the
+    dicts AnnoyanceDB returns, so code reading either works unchanged. Use
+    replace() to change a field.
+    """
+    __slots__ = (
+        'specific_reply', 'specific_reaction', '_reply_weights', '_reaction_weights',
+        'method_flags', '_message_mode', '_selection_mode', 'burst_size', 'limits',
+    )
+
+    def __init__(
+        self,
+        specific_reply: Tuple[str, ...],
+        specific_reaction: Tuple[str, ...],
+        reply_weights: Optional[Tuple[float, ...]],
+        reaction_weights: Optional[Tuple[float, ...]],
+        method_flags: int,
+        message_mode: int,
+        selection_mode: int,
+        burst_size: int,
+        limits: Tuple[float, float, int, float],
+    ):
+        self.specific_reply = specific_reply
+        self.specific_reaction = specific_reaction
+        self._reply_weights = reply_weights
+        self._reaction_weights = reaction_weights
+        self.method_flags = method_flags
+        self._message_mode = message_mode
+        self._selection_mode = selection_mode
+        self.burst_size = burst_size
+        # (cooldown_seconds, trigger_probability, max_actions, action_window_seconds)
+        self.limits = limits
+
+    @classmethod
+    def from_dict(cls, settings: Dict[str, Any]) -> 'TargetSettings':
+        replies = shared_values.intern('replies', tuple(settings.get("specific_reply") or ()))
+        reactions = shared_values.intern('reactions', tuple(settings.get("specific_reaction") or ()))
+        probability = settings.get("trigger_probability")
+        limits = (
+            float(settings.get("cooldown_seconds") or 0),
+            1.0 if probability is None else float(probability),
+            int(settings.get("max_actions") or 0),
+            float(settings.get("action_window_seconds") or 60),
+        )
+        message_mode = settings.get("message_mode") or 'both'
+        selection_mode = settings.get("selection_mode") or 'weighted'
+        return cls(
+            replies,
+            reactions,
+            _weights(settings.get("reply_weights"), len(replies)),
+            _weights(settings.get("reaction_weights"), len(reactions)),
+            methods_to_flags(settings.get("annoy_methods", ['message', 'reaction'])),
+            MESSAGE_MODES.index(message_mode) if message_mode in MESSAGE_MODES else MESSAGE_MODES.index('both'),
+            SELECTION_MODES.index(selection_mode) if selection_mode in SELECTION_MODES else 0,
+            int(settings.get("burst_size") or 1),
+            shared_values.intern('limits', limits),
+        )
+
+    @property
+    def reply_weights(self) -> Tuple[float, ...]:
+        return self._reply_weights or (1.0,) * len(self.specific_reply)
+
+    @property
+    def reaction_weights(self) -> Tuple[float, ...]:
+        return self._reaction_weights or (1.0,) * len(self.specific_reaction)
+
+    @property
+    def annoy_methods(self):
+        return flags_to_methods(self.method_flags)
+
+    @property
+    def message_mode(self) -> str:
+        return MESSAGE_MODES[self._message_mode]
+
+    @property
+    def selection_mode(self) -> str:
+        return SELECTION_MODES[self._selection_mode]
+
+    @property
+    def cooldown_seconds(self) -> float:
+        return self.limits[0]
+
+    @property
+    def trigger_probability(self) -> float:
+        return self.limits[1]
+
+    @property
+    def max_actions(self) -> int:
+        return self.limits[2]
+
+    @property
+    def action_window_seconds(self) -> float:
+        return self.limits[3]
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in SETTINGS_KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in SETTINGS_KEYS else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in SETTINGS_KEYS}
+
+    def replace(self, **changes: Any) -> 'TargetSettings':
+        """Returns a copy with the given fields (settings dict keys) changed."""
+        settings = self.to_dict()
+        settings.update(changes)
+        return TargetSettings.from_dict(settings)
+
+
+def pack_settings(settings: Any) -> TargetSettings:
+    """Turns a settings dict from AnnoyanceDB, an import or a snapshot into a TargetSettings."""
+    return settings if isinstance(settings, TargetSettings) else TargetSettings.from_dict(settings)
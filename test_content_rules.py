@@ -0,0 +1,36 @@
+# test_content_rules.py
+from content_rules import ContentRule, RuleMatcher, validate_pattern
+
+
+def rule(rule_id, user_id, pattern, is_regex=False):
+    return ContentRule(rule_id, user_id, pattern, is_regex, 'reply', f"reply {rule_id}")
+
+
+def test_longer_keyword_of_another_user_does_not_hide_guild_wide_keyword():
+    matcher = RuleMatcher([rule(1, None, 'foo'), rule(2, 42, 'foo bar')])
+    assert matcher.match('foo bar', 7).id == 1
+    assert matcher.match('foo bar', 42).id == 2
+
+
+def test_regex_of_another_user_does_not_hide_guild_wide_regex():
+    matcher = RuleMatcher([rule(1, 42, 'ab', True), rule(2, None, 'a', True)])
+    assert matcher.match('ab', 7).id == 2
+    assert matcher.match('ab', 42).id == 1
+
+
+def test_user_rules_only_apply_to_their_user():
+    matcher = RuleMatcher([rule(1, 42, 'hello'), rule(2, 42, 'h.llo', True)])
+    assert matcher.match('hello there', 7) is None
+    assert matcher.match('hello there', 42).id == 1
+
+
+def test_keyword_wins_over_regex_at_the_same_position():
+    matcher = RuleMatcher([rule(1, None, 'he', True), rule(2, None, 'hello')])
+    assert matcher.match('well hello', 7).id == 2
+    assert matcher.match('he said hello', 7).id == 1
+
+
+def test_catastrophic_patterns_are_rejected():
+    for pattern in ('(a|aa)+$', '(a+)+', '.*.*x', r'\w+\w+x'):
+        assert validate_pattern(pattern, True) is not None, pattern
+    assert validate_pattern('ab+c', True) is None
@@ -0,0 +1,22 @@
+# test_selection.py
+from selection import AliasPicker, UniformPicker, build_picker
+
+
+def test_all_zero_weights_count_as_empty():
+    assert build_picker(('a',), (0.0,)) is None
+    assert build_picker(('a', 'b'), (0.0, 0.0)) is None
+    assert build_picker(('a', 'b'), (0.0, 0.0), 'shuffle') is None
+
+
+def test_zero_weight_items_are_never_picked():
+    picker = build_picker(('a', 'b', 'c'), (0.0, 1.0, 3.0))
+    assert isinstance(picker, AliasPicker)
+    assert {picker.pick() for _ in range(1000)} <= {'b', 'c'}
+    bag = build_picker(('a', 'b', 'c'), (0.0, 1.0, 1.0), 'shuffle')
+    assert sorted(bag.pick() for _ in range(4)) == ['b', 'b', 'c', 'c']
+
+
+def test_equal_weights_pick_uniformly():
+    picker = build_picker(('a', 'b'), (2.0, 2.0))
+    assert isinstance(picker, UniformPicker)
+    assert build_picker(('a', 'b'), None, previous=picker) is picker
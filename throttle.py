@@ -0,0 +1,58 @@
+# throttle.py
+import random
+from array import array
+from typing import Optional, Tuple
+
+
+class TriggerGate:
+    """Decides in O(1) whether a target's message may trigger an annoyance.
+
+    Keeps the last `max_actions` fire times in a fixed-size ring buffer. The
+    slot at the write index is always the oldest one, so the windowed limit is
+    a single comparison.
+    """
+    __slots__ = ('cooldown', 'probability', 'max_actions', 'window', 'last_fired', '_ring', '_index')
+
+    def __init__(self, cooldown: float, probability: float, max_actions: int, window: float):
+        self.cooldown = cooldown
+        self.probability = probability
+        self.max_actions = max_actions
+        self.window = window
+        self.last_fired = float('-inf')
+        self._ring = array('d', [float('-inf')] * max_actions) if max_actions > 0 else None
+        self._index = 0
+
+    @property
+    def limits(self) -> Tuple[float, float, int, float]:
+        return (self.cooldown, self.probability, self.max_actions, self.window)
+
+    def allow(self, now: float) -> bool:
+        """Returns True and records a firing if the target may be annoyed at `now`."""
+        if self.probability < 1 and random.random() >= self.probability:
+            return False
+        if now - self.last_fired < self.cooldown:
+            return False
+        ring = self._ring
+        if ring is not None:
+            if now - ring[self._index] < self.window:
+                return False
+            ring[self._index] = now
+            self._index = (self._index + 1) % self.max_actions
+        self.last_fired = now
+        return True
+
+
+def build_gate(
+    limits: Tuple[float, float, int, float], previous: Optional[TriggerGate] = None
+) -> Optional[TriggerGate]:
+    """Builds the gate for a target's (cooldown, probability, max_actions, window) limits, or None if it has none.
+
+    The previous gate is reused when the limits did not change, so editing an
+    unrelated setting does not reset cooldowns.
+    """
+    cooldown, probability, max_actions, _ = limits
+    if cooldown <= 0 and probability >= 1 and max_actions <= 0:
+        return None
+    if previous is not None and previous.limits == limits:
+        return previous
+    return TriggerGate(*limits)